@@ -0,0 +1,304 @@
+"""
+benchmark of ingestion throughput, query latency, recall and memory.
+
+synthetic: clustered random vectors, no model needed. measures index
+adds, builds, searches and recall against the flat baseline per index
+type, and search + result resolution through a DataBase.
+e2e: generates a volume of text files on disk, ingests it with
+add_volume and queries it with search(), using the embedding model.
+
+results are written as JSON so runs can be compared, e.g.
+python scripts/benchmark.py synthetic -n 1000000 --specs flat ivf hnsw
+python scripts/benchmark.py e2e --files 2000 --output e2e.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(PROJECT_ROOT / "src"))
+
+import faiss
+
+from infrastructure import metrics
+from infrastructure.database import DataBase
+from infrastructure.vectorindex import Index
+
+from config import VECTOR_DIM, EMBEDDING_MODEL
+
+# ============================================================
+# Measurements
+# ============================================================
+
+def rss_mb() -> float:
+    """current resident set size"""
+    with open("/proc/self/statm") as f:
+        pages = int(f.read().split()[1])
+    return pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in KB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def latencies(run, items: list) -> dict:
+    """runs each item on its own, returns latency percentiles in ms"""
+    times = []
+    for item in items:
+        start = time.perf_counter()
+        run(item)
+        times.append((time.perf_counter() - start) * 1000)
+    return {"p50_ms": float(np.percentile(times, 50)),
+            "p99_ms": float(np.percentile(times, 99)),
+            "mean_ms": float(np.mean(times))}
+
+def timed(run) -> tuple[object, float]:
+    start = time.perf_counter()
+    result = run()
+    return result, time.perf_counter() - start
+
+def environment() -> dict:
+    return {"python": platform.python_version(),
+            "faiss": faiss.__version__,
+            "numpy": np.__version__,
+            "cpus": os.cpu_count(),
+            "machine": platform.machine(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+# ============================================================
+# Synthetic vectors
+# ============================================================
+
+def clustered(n: int, centers: np.ndarray,
+              rng: np.random.Generator) -> np.ndarray:
+    """normalized vectors around cluster centers, like embeddings"""
+    vectors = np.empty((n, centers.shape[1]), dtype="float32")
+    # in steps, 10M x 512 floats do not fit in memory twice
+    for start in range(0, n, 100_000):
+        end = min(n, start + 100_000)
+        labels = rng.integers(len(centers), size=end - start)
+        noise = rng.standard_normal((end - start, centers.shape[1])).astype("float32")
+        vectors[start:end] = centers[labels] + 0.5 * noise
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors
+
+def bench_index(spec: str, vectors: np.ndarray, queries: np.ndarray,
+                directory: str, args) -> dict:
+    index = Index(vectors.shape[1], f"{directory}/{spec}.index", new=True)
+    ids = np.arange(1, len(vectors) + 1)
+    rss_before = rss_mb()
+
+    def add():
+        with index: # bulk mode, written once at the end
+            for start in range(0, len(vectors), args.batch_size):
+                end = start + args.batch_size
+                index.add(vectors[start:end], ids[start:end])
+    _, add_seconds = timed(add)
+    build_seconds = 0.0
+    if spec != "flat":
+        _, build_seconds = timed(lambda: index.rebuild(spec))
+
+    search_args = {"nprobe": args.nprobe, "ef_search": args.ef_search}
+    _, batch_seconds = timed(lambda: index.search(queries, args.k, **search_args))
+    result = {
+        "spec": spec,
+        "vectors": len(vectors),
+        "add_per_sec": len(vectors) / add_seconds,
+        "build_sec": build_seconds,
+        "search": latencies(lambda q: index.search(q, args.k, **search_args),
+                            list(queries)),
+        "batch_qps": len(queries) / batch_seconds,
+        # against the generated vectors, a compressed index would
+        # otherwise be compared with its own approximations
+        "recall_at_k": index.recall(queries, args.k,
+                                    ground_truth=(ids, vectors),
+                                    **search_args),
+        "index_mb": index.nbytes() / 2**20,
+        "rss_delta_mb": rss_mb() - rss_before,
+    }
+    return result
+
+def bench_resolve(vectors: np.ndarray, queries: np.ndarray,
+                  directory: str, args) -> dict:
+    """index search + DataBase.resolve, the search path without encoding"""
+    index = Index(vectors.shape[1], f"{directory}/resolve.index", new=True)
+    database = DataBase(directory, f"{directory}/bench.db", index)
+    files = -(-len(vectors) // args.chunks_per_file)
+
+    def ingest():
+        with database.writer() as conn, index:
+            cursor = conn.cursor()
+            for f in range(files):
+                n = min(args.chunks_per_file, len(vectors) - f * args.chunks_per_file)
+                _, chunk_ids = database.insert(
+                    (f"file_{f}.txt", "txt", f"{directory}/file_{f}.txt"),
+                    n, cursor)
+                start = f * args.chunks_per_file
+                database.transfer_to_vectorindex(vectors[start:start + n],
+                                                 chunk_ids)
+            database.commit(conn)
+    _, ingest_seconds = timed(ingest)
+
+    def query(q):
+        database.resolve(index.search(q, args.k))
+    result = {
+        "files": files,
+        "chunks": len(vectors),
+        "chunks_per_sec": len(vectors) / ingest_seconds,
+        "search_and_resolve": latencies(query, list(queries)),
+    }
+    database.close()
+    return result
+
+def synthetic(args) -> dict:
+    rng = np.random.default_rng(args.seed)
+    centers = rng.standard_normal((args.clusters, args.dim)).astype("float32")
+    vectors = clustered(args.n, centers, rng)
+    # queries near the data, not copies of it
+    queries = clustered(args.queries, centers, rng)
+    with tempfile.TemporaryDirectory() as directory:
+        indexes = [bench_index(spec, vectors, queries, directory, args)
+                   for spec in args.specs]
+        resolve = bench_resolve(vectors, queries, directory, args)
+    return {"mode": "synthetic", "indexes": indexes, "database": resolve}
+
+# ============================================================
+# End to end
+# ============================================================
+
+TOPICS = {
+    "boats": ["sailboats rely on wind power", "cargo ships cross the ocean",
+              "fishing boats leave the harbor at dawn", "the hull keeps the boat afloat"],
+    "airplanes": ["jet engines power commercial airplanes", "the runway was cleared for landing",
+                  "pilots follow the navigation system", "wings generate lift at speed"],
+    "cars": ["electric cars use battery propulsion", "the engine needs maintenance",
+             "sports cars accelerate quickly", "traffic on the highway slowed down"],
+    "animals": ["dogs are loyal pets", "wild animals live in the forest",
+                "the cat slept in the sun", "zoologists study animal behavior"],
+    "music": ["the guitar was out of tune", "an orchestra played the concert",
+              "she recorded the song in a studio", "the piano melody was calm"],
+}
+
+def generate_volume(root: Path, files: int, lines: int, seed: int) -> None:
+    rng = random.Random(seed)
+    topics = list(TOPICS)
+    for f in range(files):
+        topic = topics[f % len(topics)]
+        folder = root / topic
+        folder.mkdir(parents=True, exist_ok=True)
+        text = "\n".join(rng.choice(TOPICS[topic]) for _ in range(lines))
+        (folder / f"{topic}_{f}.txt").write_text(text, encoding="utf-8")
+
+def e2e(args) -> dict:
+    from retrieval.search import search
+    from processing import embeddings as em
+
+    with tempfile.TemporaryDirectory() as directory:
+        if not args.chunk_cache:
+            # start empty, nothing is served from earlier runs
+            em.CHUNK_CACHE.close()
+            em.CHUNK_CACHE.path = f"{directory}/chunks.db"
+        root = Path(args.volume or f"{directory}/volume")
+        if not root.exists():
+            generate_volume(root, args.files, args.lines, args.seed)
+        index = Index(VECTOR_DIM, f"{directory}/e2e.index", new=True)
+        database = DataBase(str(root), f"{directory}/e2e.db", index)
+
+        rss_before = rss_mb()
+        _, ingest_seconds = timed(database.add_volume)
+        counts = database.counts()
+        chunks = sum(c or 0 for _, c, _ in counts)
+        ingest = {"files": len(counts),
+                  "chunks": chunks,
+                  "seconds": ingest_seconds,
+                  "files_per_sec": len(counts) / ingest_seconds,
+                  "chunks_per_sec": chunks / ingest_seconds,
+                  "rss_delta_mb": rss_mb() - rss_before}
+
+        queries = [q for phrases in TOPICS.values() for q in phrases]
+        queries = (queries * (-(-args.queries // len(queries))))[:args.queries]
+        search(database, queries[:1], cache=None) # loads the model
+        _, batch_seconds = timed(lambda: search(database, queries, k=args.k,
+                                                cache=None))
+        query = {"single": latencies(lambda q: search(database, q, k=args.k,
+                                                      cache=None), queries),
+                 "batch_qps": len(queries) / batch_seconds}
+
+        # taken while the index is flat, full precision
+        ground_truth = index.vectors()
+        if args.spec != "flat":
+            _, query["build_sec"] = timed(lambda: index.rebuild(args.spec))
+        query["recall_at_k"] = index.recall(
+            em.create_query_embeddings(queries, cache=None), args.k,
+            ground_truth=ground_truth,
+            nprobe=args.nprobe, ef_search=args.ef_search)
+        database.close()
+    return {"mode": "e2e", "model": EMBEDDING_MODEL, "spec": args.spec,
+            "ingest": ingest, "query": query,
+            "chunk_cache": em.CHUNK_CACHE.stats()}
+
+# ============================================================
+# Main
+# ============================================================
+
+def parse_args():
+    # options of both modes, given after the mode
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--output", help="JSON file, default: stdout")
+    common.add_argument("-k", type=int, default=10)
+    common.add_argument("--queries", type=int, default=200)
+    common.add_argument("--nprobe", type=int, default=None)
+    common.add_argument("--ef-search", type=int, default=None)
+    common.add_argument("--seed", type=int, default=161)
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    modes = parser.add_subparsers(dest="mode", required=True)
+
+    s = modes.add_parser("synthetic", parents=[common],
+                         help="clustered vectors, no model")
+    s.add_argument("-n", type=int, default=100_000, help="number of chunks")
+    s.add_argument("--dim", type=int, default=VECTOR_DIM)
+    s.add_argument("--clusters", type=int, default=100)
+    s.add_argument("--specs", nargs="+", default=["flat", "ivf", "hnsw", "sq8"])
+    s.add_argument("--batch-size", type=int, default=10_000)
+    s.add_argument("--chunks-per-file", type=int, default=10)
+
+    e = modes.add_parser("e2e", parents=[common],
+                         help="generated volume through the model")
+    e.add_argument("--files", type=int, default=500)
+    e.add_argument("--lines", type=int, default=40, help="lines per file")
+    e.add_argument("--volume", help="directory to keep the volume in")
+    e.add_argument("--spec", default="flat",
+                   help="index type to compare with the flat baseline")
+    e.add_argument("--chunk-cache", action="store_true",
+                   help="use the configured chunk embedding cache "
+                        "(CHUNK_CACHE_PATH) instead of a fresh one")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    run = synthetic if args.mode == "synthetic" else e2e
+    metrics.enable()
+    report = {"environment": environment(), "args": vars(args)}
+    report.update(run(args))
+    report["peak_rss_mb"] = peak_rss_mb()
+    # where the time went, per stage
+    report["stages"] = metrics.snapshot()
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(output + "\n", encoding="utf-8")
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
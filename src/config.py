@@ -1,11 +1,125 @@
+import os
 from pathlib import Path
 
 BASE_DIR = Path(__file__).resolve().parents[1]
 
 # EMBEDDING_MODEL = "all-MiniLM-L6-v2"
 EMBEDDING_MODEL = "clip-ViT-B-32"
-MODEL_PATH = f"{str(BASE_DIR)}/embedding_model/{EMBEDDING_MODEL}"
+MODEL_DIR = f"{str(BASE_DIR)}/embedding_model"
+MODEL_PATH = f"{MODEL_DIR}/{EMBEDDING_MODEL}"
 VECTOR_DIM = 512
 
-# number of lines each text chunk consists of (md and txt)
-CHUNK_SIZE = 10
\ No newline at end of file
+# models are loaded on first use, ModelManager.unload_idle() drops
+# models unused for this many seconds
+MODEL_IDLE_TIMEOUT = 600.0
+
+# query embeddings kept in memory by the query cache and its optional
+# on-disk tier (None: memory only), which keeps up to the newest
+# QUERY_CACHE_DISK_SIZE embeddings
+QUERY_CACHE_SIZE = 10_000
+QUERY_CACHE_PATH = None
+QUERY_CACHE_DISK_SIZE = 100_000
+
+# embeddings of ingested chunks keyed on a hash of their content, so
+# duplicate files and repeated paragraphs are encoded once (see
+# embeddings.encode_batch). persisted on disk if a path is set, e.g.
+# f"{str(BASE_DIR)}/embedding_cache/chunks.db" (None: memory only)
+CHUNK_CACHE_SIZE = 100_000
+CHUNK_CACHE_PATH = None
+CHUNK_CACHE_DISK_SIZE = 1_000_000 # ~2 GB of 512 dim embeddings
+
+# search results kept by the result cache, see retrieval.search
+RESULT_CACHE_SIZE = 1024
+
+# async search (retrieval.engine): queries merged into one batch, seconds
+# the first query waits for more and threads running the batches
+BATCH_MAX_SIZE = 64
+BATCH_MAX_WAIT = 0.005
+SEARCH_WORKERS = 2
+
+# number of lines each text chunk consists of (md and txt) and lines
+# shared by consecutive chunks
+CHUNK_SIZE = 10
+CHUNK_OVERLAP = 0
+# pack text chunks to the model's input length (see processing.chunking):
+# text files are read line by line and packed, pdf pages and docx
+# paragraphs are split or merged. MAX_SEQ_LENGTH is used for models that
+# do not report theirs (77: CLIP's text encoder)
+PACK_CHUNKS = True
+MAX_SEQ_LENGTH = 77
+
+# max. number of chunks of a file passed through ingestion together,
+# large text files are streamed in parts of this size
+PART_SIZE = 256
+
+# cores used by FAISS and torch while ingesting and per query (see
+# infrastructure.threads, torch's budget is shared by the whole process),
+# overridable through the environment
+INGEST_THREADS = int(os.environ.get("INGEST_THREADS", 1))
+QUERY_THREADS = int(os.environ.get("QUERY_THREADS", 1))
+
+# ingestion batching: files embedded together and model.encode batch sizes
+FILE_BATCH_SIZE = 64
+TEXT_BATCH_SIZE = 64
+IMAGE_BATCH_SIZE = 64
+
+# images are decoded straight to (about) the model's input size, shorter
+# side in pixels (CLIP: 224), by a pool of threads in the pipeline
+IMAGE_SIZE = 224
+DECODE_THREADS = 4
+
+# ingestion pipeline: parsing processes (one core is left for the model)
+# and max. number of parsed files waiting for the embedding stage
+EXTRACT_WORKERS = max(1, (os.cpu_count() or 2) - 1)
+QUEUE_DEPTH = 128
+
+# SQLite write path: files inserted between commits (the vector index is
+# flushed before each commit) and per connection pragmas
+COMMIT_EVERY = 1000
+SQLITE_SYNCHRONOUS = "NORMAL" # safe with WAL, skips an fsync per commit
+SQLITE_CACHE_SIZE = -65536 # negative: KiB, 64 MiB
+SQLITE_MMAP_SIZE = 268435456 # 256 MiB
+# read-only connections kept by a DataBase for concurrent queries and
+# prepared statements cached per connection
+READ_POOL_SIZE = 8
+STATEMENT_CACHE_SIZE = 256
+
+# store a content hash per file, so re-scans can tell a touched file
+# (new mtime, same content) from a modified one. costs one extra read.
+HASH_FILES = False
+
+# vector index persistence while in bulk mode (see Index.begin):
+# write to disk after this many buffered vectors or seconds, whichever first
+INDEX_FLUSH_EVERY = 50_000
+INDEX_FLUSH_INTERVAL = 300.0
+
+# removed vectors are only tombstoned, the index is rebuilt without them
+# once this fraction of it is tombstoned
+COMPACT_THRESHOLD = 0.2
+
+# approximate index types (see vectorindex.INDEX_SPECS)
+IVF_NLIST = None # None: 4 * sqrt(number of vectors)
+HNSW_M = 32
+PQ_M = 64 # sub-quantizers, VECTOR_DIM must be divisible by it
+TRAIN_SIZE = 100_000 # vectors sampled for training
+# default search-time knobs, can be overridden per search
+NPROBE = 16
+EF_SEARCH = 64
+
+# sharded vector index (see shardedindex.ShardedIndex)
+SHARD_SIZE = 1_000_000 # vectors per shard when sharding by size
+SHARD_ID_RANGE = 1_000_000 # chunk ids per shard when sharding by id range
+SHARD_WORKERS = 4 # threads searching shards in parallel
+
+# record stage timings and counters (see infrastructure.metrics),
+# overridable through the environment
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "0") == "1"
+
+# keyword search (see DataBase.match and the hybrid search modes):
+# store chunk texts in an FTS5 table while ingesting
+FULL_TEXT = False
+# reciprocal rank fusion constant and candidates fused per ranking
+RRF_K = 60
+RRF_DEPTH = 50
+# max. keyword matches the vector search is restricted to (prefilter)
+PREFILTER_LIMIT = 1000
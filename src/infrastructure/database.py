@@ -7,94 +7,481 @@ file metadata from SQLite database.
 """
 
 import os
+import re
+import json
+import hashlib
 import sqlite3
+import threading
 import numpy as np
+from contextlib import contextmanager
 
-import processing.embeddings as em
+from processing.pipeline import Pipeline
+from . import metrics
+from .pool import ConnectionPool
 from .vectorindex import Index
+from config import (FILE_BATCH_SIZE, EXTRACT_WORKERS, QUEUE_DEPTH, HASH_FILES,
+                    COMMIT_EVERY, SQLITE_SYNCHRONOUS, SQLITE_CACHE_SIZE,
+                    SQLITE_MMAP_SIZE, READ_POOL_SIZE, STATEMENT_CACHE_SIZE,
+                    INGEST_THREADS, FULL_TEXT)
+
+# columns used to detect changed files on re-scans,
+# added to databases created before they existed
+TRACKING_COLUMNS = [("size", "INTEGER"),
+                    ("mtime", "INTEGER"), # st_mtime_ns
+                    ("content_hash", "TEXT")]
+
+# chunks and model tokens (None if not counted) per file, for reporting,
+# added to databases created before they existed
+COUNT_COLUMNS = [("chunk_count", "INTEGER"),
+                 ("token_count", "INTEGER")]
+
+# location of a text chunk in its file (see embeddings.text_chunks),
+# added to databases created before they existed
+SPAN_COLUMNS = [("byte_start", "INTEGER"),
+                ("byte_end", "INTEGER"),
+                ("line_start", "INTEGER"),
+                ("line_end", "INTEGER")]
+
+# max. number of ids bound to one IN (...) clause
+SQL_BATCH = 500
+
+# file_type filters (see filter_ids) by kind, matched against the
+# file type descriptions stored by libmagic
+FILE_KINDS = {"image": ("JPEG", "PNG"),
+              "pdf": ("PDF",),
+              "docx": ("Word",),
+              "text": ("ASCII",)}
+
+# terms of a full text query, matched like the FTS5 unicode61 tokenizer
+TERM = re.compile(r"\w+")
 
 class DataBase:
     def __init__(self, volume_root: str, db: str, 
-                 vectorindex: Index):
+                 vectorindex: Index, hash_files: bool = HASH_FILES,
+                 commit_every: int = COMMIT_EVERY,
+                 pool_size: int = READ_POOL_SIZE,
+                 full_text: bool = FULL_TEXT):
+        """
+        commit_every: number of files added between commits, so readers
+        see ingested files while a volume is still being added.
+        pool_size: number of read-only connections for queries.
+        full_text: store file names and chunk texts in an FTS5 table for
+        keyword searches (see match). a database created with it keeps
+        the table up to date. turned on for an existing database, files
+        indexed before are re-ingested by the next add_volume, see
+        backfill_full_text.
+
+        methods taking a conn use the given connection and leave committing
+        to the caller, through commit(conn): index changes not committed
+        that way are undone when a later write is rolled back. ingestion
+        is the exception: add_batch and add_volume commit as they go (see
+        commit_every), also on a given connection. without a conn,
+        queries run on a pooled read-only connection and changes on the
+        shared write connection, one writer at a time, committed when
+        the method returns.
+        """
         self.root = volume_root
         self.db = db
         self.vectorindex = vectorindex
+        self.hash_files = hash_files
+        self.full_text = full_text
+        self.commit_every = commit_every
+        self.uncommitted = 0 # files added since the last commit
+        # (path, id) of the last inserted file, later parts of a
+        # streamed file are added to it
+        self.last_file = None
+        # path -> (size, mtime, content hash) taken before the file is
+        # extracted, stored with it by insert
+        self.signatures = {}
+        # index changes are undone with a rolled back transaction
+        vectorindex.track()
         self.initialise_database()
+        self.pool = ConnectionPool(db, pool_size, setup=tune)
+        self.write_conn = None
+        self.write_lock = threading.RLock()
 
     def initialise_database(self) -> None:
+        os.makedirs(os.path.dirname(self.db) or ".", exist_ok=True)
         conn = sqlite3.connect(self.db)
+        # WAL lets readers query while a volume is ingested,
+        # the mode is stored in the database file
+        conn.execute("PRAGMA journal_mode=WAL")
 
         conn.execute("""
         CREATE TABLE IF NOT EXISTS file (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             file_name TEXT NOT NULL,
             file_type VARCHAR(8) NOT NULL,
-            path TEXT UNIQUE NOT NULL
+            path TEXT UNIQUE NOT NULL,
+            size INTEGER,
+            mtime INTEGER,
+            content_hash TEXT,
+            chunk_count INTEGER,
+            token_count INTEGER
         )
         """)
+        columns = [c[1] for c in conn.execute("PRAGMA table_info(file)")]
+        for column, column_type in TRACKING_COLUMNS + COUNT_COLUMNS:
+            if column not in columns:
+                conn.execute(f"ALTER TABLE file ADD COLUMN {column} {column_type}")
         conn.commit()
         conn.execute("""
         CREATE TABLE IF NOT EXISTS chunk (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             file_id INTEGER NOT NULL,
+            byte_start INTEGER,
+            byte_end INTEGER,
+            line_start INTEGER,
+            line_end INTEGER,
             FOREIGN KEY (file_id)
                 REFERENCES file(id)
         )
         """)
+        columns = [c[1] for c in conn.execute("PRAGMA table_info(chunk)")]
+        for column, column_type in SPAN_COLUMNS:
+            if column not in columns:
+                conn.execute(f"ALTER TABLE chunk ADD COLUMN {column} {column_type}")
+        conn.execute("""
+        CREATE INDEX IF NOT EXISTS chunk_file_id ON chunk (file_id)
+        """)
+        if self.full_text:
+            created = conn.execute(
+                """SELECT 1 FROM sqlite_master WHERE name = 'chunk_text'"""
+                ).fetchone() is None
+            # rowid is the chunk id
+            conn.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS chunk_text
+            USING fts5(file_name, text)
+            """)
+            if created:
+                self.backfill_full_text(conn)
+        self.full_text = conn.execute(
+            """SELECT 1 FROM sqlite_master WHERE name = 'chunk_text'"""
+            ).fetchone() is not None
         conn.commit()
         conn.close()
 
-    def add_volume(self, conn: sqlite3.Connection, 
-                   embedding_model = None) -> None:
-        cursor = conn.cursor()
+    def backfill_full_text(self, conn: sqlite3.Connection) -> None:
+        """
+        fills a chunk_text table added to a database that already holds
+        files. images are only found by file name and are added as they
+        are. chunk texts are not stored elsewhere, the other files are
+        marked as modified so the next add_volume re-ingests them.
+        """
+        image_types = FILE_KINDS["image"]
+        is_image = " OR ".join(["file.file_type LIKE ?"] * len(image_types))
+        params = [f"%{t}%" for t in image_types]
+        conn.execute(
+            f"""INSERT INTO chunk_text (rowid, file_name, text)
+            SELECT chunk.id, file.file_name, '' FROM chunk
+            JOIN file ON file.id = chunk.file_id WHERE {is_image}""", params)
+        conn.execute(
+            f"""UPDATE file SET size = NULL, mtime = NULL, content_hash = NULL
+            WHERE NOT ({is_image})""", params)
+
+    @contextmanager
+    def reader(self, conn: sqlite3.Connection | None = None):
+        if conn is not None:
+            yield conn
+            return
+        with self.pool.connection() as conn:
+            yield conn
+
+    @contextmanager
+    def writer(self, conn: sqlite3.Connection | None = None):
+        if conn is not None:
+            yield conn
+            return
+        with self.write_lock:
+            if self.write_conn is None:
+                self.write_conn = sqlite3.connect(
+                    self.db, check_same_thread=False,
+                    cached_statements=STATEMENT_CACHE_SIZE)
+                tune(self.write_conn)
+            try:
+                yield self.write_conn
+            except BaseException:
+                self.write_conn.rollback()
+                # the rollback also resets the chunk id sequence, vectors
+                # of the rolled back chunks must not stay behind
+                self.vectorindex.rollback()
+                self.uncommitted = 0
+                raise
+            self.write_conn.commit()
+            self.vectorindex.commit()
+            # results cached before the commit miss its chunks
+            self.vectorindex.invalidate()
+
+    def add_volume(self, conn: sqlite3.Connection | None = None, 
+                   embedding_model = None,
+                   batch_size: int = FILE_BATCH_SIZE,
+                   workers: int = EXTRACT_WORKERS,
+                   queue_depth: int = QUEUE_DEPTH,
+                   threads: int | None = INGEST_THREADS) -> None:
+        """
+        indexes new and modified files below the volume root,
+        unchanged files are skipped before they are extracted.
+        threads: thread budget of encoding and index adds, see Pipeline.
+        """
+        with self.writer(conn) as conn:
+            cursor = conn.cursor()
+            pipeline = Pipeline(self, embedding_model, workers, 
+                                queue_depth, batch_size, threads)
+            # one index write for the whole volume instead of one per file
+            with self.vectorindex:
+                entries, stale = self.scan(conn)
+                self.remove_files(stale, cursor)
+                pipeline.run(iter(entries), cursor)
+            # the index was written when leaving bulk mode
+            self.commit(conn)
+            cursor.close()
+
+    def scan(self, conn: sqlite3.Connection) -> tuple[list, list]:
+        """
+        compares the volume with the file table.
+        returns (file name, path) entries of new and modified files
+        and the ids of stored files that were modified or deleted on disk.
+        unchanged files whose mtime moved but whose hash matches only
+        get their stored size/mtime updated.
+        the signatures of the returned files are taken here, an edit
+        made while a file is extracted is found by the next scan.
+        """
+        known = {row[0]: row[1:] for row in conn.execute(
+            "SELECT path, id, size, mtime, content_hash FROM file")}
+        entries = []
+        stale = []
+        self.signatures.clear() # of files a failed ingestion left behind
+        for name, path in self.walk():
+            if path not in known:
+                signature = self.file_signature(path)
+                if signature[0] is not None: # not deleted since the walk
+                    self.signatures[path] = signature
+                    entries.append((name, path))
+                continue
+
+            file_id, size, mtime, content_hash = known.pop(path)
+            signature = self.file_signature(path, hashed=False)
+            if signature[0] is None: # deleted since the walk
+                stale.append(file_id)
+                continue
+            if signature[:2] == (size, mtime):
+                continue
+            if self.hash_files:
+                signature = self.file_signature(path) # with its hash
+                if (content_hash is not None and signature[0] == size
+                        and signature[2] == content_hash):
+                    conn.execute("UPDATE file SET mtime = ? WHERE id = ?",
+                                 (signature[1], file_id))
+                    continue
+            stale.append(file_id)
+            if signature[0] is not None:
+                self.signatures[path] = signature
+                entries.append((name, path))
+
+        # whatever is left under the root was not found on disk anymore
+        prefix = os.path.join(self.root, "")
+        stale.extend(row[0] for path, row in known.items()
+                     if path.startswith(prefix))
+        return entries, stale
+
+    def walk(self):
+        """yields (file name, full path) for every file below the volume root"""
         for dirpath, _, files in os.walk(self.root):
-            file_list = []
-            chunk_embeds = []
             for file in files:
-                full_path = os.path.join(dirpath, file)
-                if not embedding_model:
-                    file_type, embeds = em.embed(full_path)
-                else:
-                    file_type, embeds = em.embed(full_path, embedding_model)
-                chunk_embeds.append(embeds)
-                file_list.append((file, file_type, full_path))
-            self.add_batch(file_list, chunk_embeds, cursor)
-        cursor.close()
+                yield file, os.path.join(dirpath, file)
             
+    def remove_file(self, path: str,
+                    conn: sqlite3.Connection | None = None) -> bool:
+        """
+        removes a file from the database and the vector index.
+        returns False if the path was not indexed.
+        """
+        with self.writer(conn) as conn:
+            row = conn.execute("SELECT id FROM file WHERE path = ?", 
+                               (path, )).fetchone()
+            if row is None:
+                return False
+            cursor = conn.cursor()
+            self.remove_files([row[0]], cursor)
+            cursor.close()
+            return True
+
+    def update_file(self, path: str, conn: sqlite3.Connection | None = None,
+                    embedding_model = None) -> None:
+        """
+        re-indexes a single file, replacing its chunks.
+        a path that no longer exists on disk is only removed.
+        """
+        with self.writer(conn) as conn:
+            self.remove_file(path, conn)
+            signature = self.file_signature(path)
+            if signature[0] is None:
+                return
+            # taken before extraction, see scan
+            self.signatures[path] = signature
+            cursor = conn.cursor()
+            pipeline = Pipeline(self, embedding_model, workers=0)
+            pipeline.run(iter([(os.path.basename(path), path)]), cursor)
+            cursor.close()
+
+    def remove_files(self, file_ids: list[int],
+                     cursor: sqlite3.Cursor) -> None:
+        """deletes files, their chunks and the chunks' vectors"""
+        chunk_ids = []
+        for i in range(0, len(file_ids), SQL_BATCH):
+            batch = file_ids[i:i + SQL_BATCH]
+            id_string = ",".join("?" * len(batch))
+            chunk_ids.extend(row[0] for row in cursor.execute(
+                f"SELECT id FROM chunk WHERE file_id IN ({id_string})", batch))
+            if self.full_text:
+                cursor.execute(
+                    f"""DELETE FROM chunk_text WHERE rowid IN
+                    (SELECT id FROM chunk WHERE file_id IN ({id_string}))""",
+                    batch)
+            cursor.execute(f"DELETE FROM chunk WHERE file_id IN ({id_string})", batch)
+            cursor.execute(f"DELETE FROM file WHERE id IN ({id_string})", batch)
+        self.vectorindex.remove(np.array(chunk_ids, dtype="int64"))
+
     def add_batch(self, files: list[tuple[str, str, str]],
                   chunk_embeds: list[np.ndarray], 
-                  cursor: sqlite3.Cursor) -> None:
-        for i, f in enumerate(files):
-            try:
-                self.add(f, chunk_embeds[i], cursor)
-            except sqlite3.IntegrityError:
-                continue
+                  cursor: sqlite3.Cursor,
+                  spans: list[list] | None = None,
+                  continued: list[bool] | None = None,
+                  tokens: list[int] | None = None,
+                  texts: list[list] | None = None) -> None:
+        """
+        inserts files and their chunks, the vectors of the whole batch
+        are added to the index at once. files already in the database
+        are skipped.
+        spans: per file the location of each chunk, see text_chunks.
+        continued: per file whether it is a later part of the file
+        before it, its chunks are added to that file.
+        tokens: per file the number of model tokens of its chunks.
+        texts: per file its chunks, stored with the file name for full
+        text searches if enabled.
+        commits the cursor's connection every commit_every files, also
+        when it is the caller's: a wider transaction of the caller is
+        split there.
+        """
+        chunk_ids = []
+        embeds = []
+        text_rows = []
+        with metrics.span("sqlite.insert"):
+            for i, (f, e) in enumerate(zip(files, chunk_embeds)):
+                chunk_spans = spans[i] if spans else None
+                n_tokens = tokens[i] if tokens else None
+                if continued and continued[i]:
+                    if self.last_file is None or self.last_file[0] != f[2]:
+                        continue # first part was skipped
+                    ids = self.insert_chunks(self.last_file[1], len(e),
+                                             chunk_spans, cursor)
+                    cursor.execute(
+                        """UPDATE file SET chunk_count = chunk_count + ?,
+                        token_count = token_count + ? WHERE id = ?""",
+                        (len(ids), n_tokens, self.last_file[1]))
+                else:
+                    try:
+                        file_id, ids = self.insert(f, len(e), cursor,
+                                                   chunk_spans, n_tokens)
+                    except sqlite3.IntegrityError:
+                        self.last_file = None
+                        continue
+                    self.last_file = (f[2], file_id)
+                chunk_ids.extend(ids)
+                embeds.append(e)
+                if self.full_text and texts:
+                    # non-text chunks (images) are found by file name
+                    text_rows.extend((chunk_id, f[0],
+                                      t if isinstance(t, str) else "")
+                                     for chunk_id, t in zip(ids, texts[i]))
+            if text_rows:
+                cursor.executemany(
+                    """INSERT INTO chunk_text (rowid, file_name, text)
+                    VALUES(?, ?, ?)""", text_rows)
+        metrics.count("sqlite.chunks", len(chunk_ids))
+
+        if chunk_ids:
+            self.transfer_to_vectorindex(np.vstack(embeds), chunk_ids)
+        self.uncommitted += len(files)
+        if self.uncommitted >= self.commit_every:
+            self.commit(cursor.connection)
 
     def add(self, file: tuple[str, str, str], 
             chunk_embeds: np.ndarray, 
             cursor: sqlite3.Cursor) -> None:
         
-        filename, file_type, path = file
+        file_id, chunk_ids = self.insert(file, len(chunk_embeds), cursor)
+        if chunk_ids:
+            self.transfer_to_vectorindex(chunk_embeds, chunk_ids)
 
-        n = len(chunk_embeds)
+        return file_id
+
+    def insert(self, file: tuple[str, str, str], n: int,
+               cursor: sqlite3.Cursor,
+               spans: list | None = None,
+               tokens: int | None = None) -> tuple[int, list[int]]:
+        """inserts a file and n chunks, returns the file and chunk ids"""
+        filename, file_type, path = file
+        signature = self.signatures.pop(path, None)
+        size, mtime, content_hash = signature or self.file_signature(path)
 
         cursor.execute(
-            """INSERT INTO file (file_name, file_type, path) VALUES(?, ?, ?)""", 
-            (filename, file_type, path))
+            """INSERT INTO file (file_name, file_type, path, 
+            size, mtime, content_hash, chunk_count, token_count)
+            VALUES(?, ?, ?, ?, ?, ?, ?, ?)""", 
+            (filename, file_type, path, size, mtime, content_hash, n, tokens))
         file_id = cursor.lastrowid
-        chunk_ids = []
-        chunk_ids = []
-        for _ in range(n):
-            cursor.execute(
-                "INSERT INTO chunk (file_id) VALUES(?) RETURNING id",
-                (file_id,)
-            )
-            chunk_id = cursor.fetchone()[0]
-            chunk_ids.append(chunk_id)
+        if n == 0: # nothing extracted, e.g. unsupported file type
+            return file_id, []
 
-        self.transfer_to_vectorindex(chunk_embeds, chunk_ids)
+        return file_id, self.insert_chunks(file_id, n, spans, cursor)
 
-        return file_id
+    def insert_chunks(self, file_id: int, n: int, spans: list | None,
+                      cursor: sqlite3.Cursor) -> list[int]:
+        """appends n chunks to a file, returns their ids"""
+        if n == 0:
+            return []
+        rows = [(file_id, *(span or (None,) * 4))
+                for span in (spans or [None] * n)]
+        cursor.executemany(
+            """INSERT INTO chunk (file_id, byte_start, byte_end,
+            line_start, line_end) VALUES(?, ?, ?, ?, ?)""", rows)
+        # ids only grow and there is one writer: the newest n chunks
+        # of the file are the ones just inserted
+        chunk_ids = [row[0] for row in cursor.execute(
+            "SELECT id FROM chunk WHERE file_id = ? ORDER BY id DESC LIMIT ?",
+            (file_id, n))]
+
+        return chunk_ids[::-1]
+
+    def commit(self, conn: sqlite3.Connection) -> None:
+        """
+        commits added files. the index is flushed first, so committed
+        chunks never lack their vectors on disk after a crash.
+        searches that ran before the commit could not resolve the new
+        chunks, the index generation is bumped so their cached results
+        are not served again.
+        """
+        self.vectorindex.flush()
+        with metrics.span("sqlite.commit"):
+            conn.commit()
+        self.vectorindex.commit()
+        self.vectorindex.invalidate()
+        self.uncommitted = 0
+
+    def file_signature(self, path: str, hashed: bool = True) -> tuple:
+        """
+        (size, mtime, content hash) of a file, None for unknown values,
+        all None if the file does not exist.
+        hashed: hash the content if hash_files is set.
+        """
+        try:
+            st = os.stat(path)
+            content_hash = (hash_file(path) if hashed and self.hash_files
+                            else None)
+        except FileNotFoundError:
+            return None, None, None
+        return st.st_size, st.st_mtime_ns, content_hash
 
     def transfer_to_vectorindex(self, chunk_embeds:np.ndarray, 
                                 chunk_ids:list) -> None:
@@ -102,34 +489,161 @@ class DataBase:
         chunk_ids = np.array(chunk_ids)
         self.vectorindex.add(chunk_embeds, chunk_ids)
 
-    def get_file(self, chunk_id: int, conn: sqlite3.Connection) -> tuple:
-        file = conn.execute(
-            """SELECT file_id FROM chunk WHERE id = ?""", (chunk_id, )
-            ).fetchone()
+    def get_file(self, chunk_id: int,
+                 conn: sqlite3.Connection | None = None) -> tuple:
+        with self.reader(conn) as conn:
+            file = conn.execute(
+                """SELECT file_id FROM chunk WHERE id = ?""", (chunk_id, )
+                ).fetchone()
         
         return file[0]
     
     def get_all_files(self, chunk_ids: list[int], 
-                      conn: sqlite3.Connection):
-        file_ids = []
-        for id in chunk_ids:
-            file_ids.append(self.get_file(id, conn))
-        file_ids = list(set(file_ids))
-        id_string = ",".join("?" * len(file_ids))
-        file_paths = conn.execute(
-                f"SELECT path FROM file WHERE id IN ({id_string})", 
-                file_ids,
-            ).fetchall()
-
-        return [fp[0] for fp in file_paths]
+                      conn: sqlite3.Connection | None = None) -> list[str]:
+        """paths of the files of chunk_ids, in order of their first chunk"""
+        with self.reader(conn) as conn:
+            paths = self.chunk_paths(chunk_ids, conn)
+        return list(dict.fromkeys(paths[i] for i in chunk_ids if i in paths))
+
+    def resolve(self, results: list[list[tuple[int, float]]],
+                conn: sqlite3.Connection | None = None) -> list[list[tuple]]:
+        """
+        turns the (chunk id, score) results of a batch of queries into
+        files with one lookup for all queries. per query returns
+        (path, best score, [(chunk id, score), ...]) ranked by best score.
+        """
+        with self.reader(conn) as conn, metrics.span("sqlite.resolve"):
+            paths = self.chunk_paths([i for r in results for i, _ in r], conn)
+        resolved = []
+        for r in results:
+            files = {}
+            for chunk_id, score in sorted(r, key=lambda c: -c[1]):
+                path = paths.get(chunk_id)
+                if path is None: # removed since the search
+                    continue
+                files.setdefault(path, []).append((chunk_id, float(score)))
+            resolved.append([(path, chunks[0][1], chunks)
+                             for path, chunks in files.items()])
+        return resolved
+
+    def chunk_paths(self, chunk_ids: list[int],
+                    conn: sqlite3.Connection) -> dict[int, str]:
+        """maps chunk ids to the paths of their files"""
+        # ids are bound as one json array: the statement text never
+        # changes, so its prepared statement is reused from the cache
+        return dict(conn.execute(
+            """SELECT chunk.id, file.path FROM chunk
+            JOIN file ON file.id = chunk.file_id
+            WHERE chunk.id IN (SELECT value FROM json_each(?))""",
+            (json.dumps([int(i) for i in chunk_ids]),)))
     
+    def locate(self, chunk_ids: list[int],
+               conn: sqlite3.Connection | None = None) -> dict[int, tuple]:
+        """
+        maps chunk ids to (path, first line, last line, byte start,
+        byte end), the location values are None for non-text chunks.
+        """
+        with self.reader(conn) as conn:
+            rows = conn.execute(
+                """SELECT chunk.id, file.path, chunk.line_start, chunk.line_end,
+                chunk.byte_start, chunk.byte_end FROM chunk
+                JOIN file ON file.id = chunk.file_id
+                WHERE chunk.id IN (SELECT value FROM json_each(?))""",
+                (json.dumps([int(i) for i in chunk_ids]),))
+            return {row[0]: row[1:] for row in rows}
+
+    def match(self, queries: list[str], limit: int,
+              conn: sqlite3.Connection | None = None) -> list[list[tuple]]:
+        """
+        keyword search of the full text table. per query returns up to
+        limit (chunk id, BM25 score) of chunks whose text or file name
+        contains any term of the query, best first. empty without
+        full_text.
+        """
+        results = []
+        with self.reader(conn) as conn, metrics.span("sqlite.match"):
+            for query in queries:
+                # terms are quoted, FTS5 query syntax in a query is text
+                terms = [f'"{t}"' for t in TERM.findall(query)]
+                if not self.full_text or not terms:
+                    results.append([])
+                    continue
+                results.append(conn.execute(
+                    """SELECT rowid, -bm25(chunk_text) FROM chunk_text
+                    WHERE chunk_text MATCH ? ORDER BY rank LIMIT ?""",
+                    (" OR ".join(terms), limit)).fetchall())
+        return results
+
+    def filter_ids(self, file_type: str | list[str] | None = None,
+                   path_prefix: str | None = None,
+                   modified_after: float | None = None,
+                   modified_before: float | None = None,
+                   conn: sqlite3.Connection | None = None) -> np.ndarray:
+        """
+        sorted ids of the chunks of files matching all given filters.
+        file_type: kinds of FILE_KINDS or parts of the file type, any of
+        them matches. path_prefix: directory or path prefix.
+        modified_after / modified_before: POSIX timestamps of the mtime.
+        """
+        conditions, params = [], []
+        if file_type is not None:
+            types = [file_type] if isinstance(file_type, str) else file_type
+            patterns = [p for t in types for p in FILE_KINDS.get(t, (t,))]
+            conditions.append("(" + " OR ".join(
+                ["file.file_type LIKE ?"] * len(patterns)) + ")")
+            params += [f"%{p}%" for p in patterns]
+        if path_prefix:
+            # a range scan of the path index instead of LIKE
+            conditions.append("file.path >= ? AND file.path < ?")
+            params += [path_prefix,
+                       path_prefix[:-1] + chr(ord(path_prefix[-1]) + 1)]
+        if modified_after is not None:
+            conditions.append("file.mtime >= ?")
+            params.append(int(modified_after * 1e9))
+        if modified_before is not None:
+            conditions.append("file.mtime < ?")
+            params.append(int(modified_before * 1e9))
+        where = " AND ".join(conditions) or "1"
+
+        with self.reader(conn) as conn, metrics.span("sqlite.filter"):
+            rows = conn.execute(
+                f"""SELECT chunk.id FROM chunk
+                JOIN file ON file.id = chunk.file_id
+                WHERE {where} ORDER BY chunk.id""", params)
+            return np.fromiter((row[0] for row in rows), dtype="int64")
+
+    def counts(self, conn: sqlite3.Connection | None = None) -> list[tuple]:
+        """(path, chunk count, token count) of every file"""
+        with self.reader(conn) as conn:
+            return conn.execute(
+                "SELECT path, chunk_count, token_count FROM file").fetchall()
+
     def get_database(self):
         return self.db
     
     def connect(self):
         conn = sqlite3.connect(self.db)
+        tune(conn)
         return conn
     
     def disconnect(self, conn: sqlite3.Connection):
         conn.commit()
-        conn.close()
\ No newline at end of file
+        conn.close()
+
+    def close(self) -> None:
+        """closes the pooled and the shared write connection"""
+        self.pool.close()
+        with self.write_lock:
+            if self.write_conn is not None:
+                self.write_conn.close()
+                self.write_conn = None
+
+def tune(conn: sqlite3.Connection) -> None:
+    """applies the per connection pragmas of the write path"""
+    conn.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+    conn.execute(f"PRAGMA cache_size={SQLITE_CACHE_SIZE}")
+    conn.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+
+def hash_file(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
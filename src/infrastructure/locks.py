@@ -0,0 +1,53 @@
+"""
+ReadWriteLock class.
+
+lets any number of readers in at once, or one writer alone. used to keep
+searches off an index while FAISS changes it in place (an add may
+reallocate the memory a concurrent search is reading).
+"""
+import threading
+from contextlib import contextmanager
+
+class ReadWriteLock:
+
+    def __init__(self):
+        self.condition = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writing = False
+        # waiting writers hold back new readers, so a steady stream of
+        # searches can not starve ingestion
+        self.waiting_writers = 0
+
+    @contextmanager
+    def shared(self):
+        """
+        held by readers. not reentrant: a thread already holding it
+        would deadlock against a waiting writer.
+        """
+        with self.condition:
+            while self.writing or self.waiting_writers:
+                self.condition.wait()
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.readers -= 1
+                if self.readers == 0:
+                    self.condition.notify_all()
+
+    @contextmanager
+    def exclusive(self):
+        """held by a writer, waits until all readers have left"""
+        with self.condition:
+            self.waiting_writers += 1
+            while self.writing or self.readers:
+                self.condition.wait()
+            self.waiting_writers -= 1
+            self.writing = True
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.writing = False
+                self.condition.notify_all()
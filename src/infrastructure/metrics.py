@@ -0,0 +1,182 @@
+"""
+Instrumentation of ingestion and search.
+
+counters and latency histograms recorded around the stages of a run
+(type detection, extraction, encoding, SQLite, index writes and
+searches). recording is off by default: the no-op recorder costs a
+function call per stage. enable() switches to a recording one, whose
+contents are read with snapshot() or export() (Prometheus text format).
+"""
+import time
+import threading
+from contextlib import nullcontext
+
+from config import METRICS_ENABLED
+
+# upper bounds of the latency buckets, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+           0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
+
+class Span:
+    # times a with block into a histogram of the recorder
+
+    __slots__ = ("metrics", "name", "start")
+
+    def __init__(self, metrics: "Metrics", name: str):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.observe(self.name, time.perf_counter() - self.start)
+
+class Metrics:
+
+    enabled = True
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {} # name -> [bucket counts, sum, count]
+        self.lock = threading.Lock()
+
+    def count(self, name: str, n: int = 1) -> None:
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name: str, seconds: float) -> None:
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = [[0] * len(BUCKETS), 0.0, 0]
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    histogram[0][i] += 1
+                    break
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    def span(self, name: str) -> Span:
+        return Span(self, name)
+
+    def snapshot(self) -> dict:
+        """counters and histograms as a JSON serialisable dict"""
+        with self.lock:
+            return {"counters": dict(self.counters),
+                    "histograms": {name: {"buckets": list(counts),
+                                          "sum": total, "count": n}
+                                   for name, (counts, total, n)
+                                   in self.histograms.items()}}
+
+    def merge(self, snapshot: dict) -> None:
+        """adds the snapshot of another recorder, e.g. of a worker process"""
+        with self.lock:
+            for name, n in snapshot.get("counters", {}).items():
+                self.counters[name] = self.counters.get(name, 0) + n
+            for name, h in snapshot.get("histograms", {}).items():
+                histogram = self.histograms.setdefault(
+                    name, [[0] * len(BUCKETS), 0.0, 0])
+                histogram[0] = [a + b for a, b in zip(histogram[0], h["buckets"])]
+                histogram[1] += h["sum"]
+                histogram[2] += h["count"]
+
+    def export(self) -> str:
+        """Prometheus text exposition format"""
+        snapshot = self.snapshot()
+        lines = []
+        for name, n in sorted(snapshot["counters"].items()):
+            metric = f"sre_{metric_name(name)}_total"
+            lines += [f"# TYPE {metric} counter", f"{metric} {n}"]
+        for name, h in sorted(snapshot["histograms"].items()):
+            metric = f"sre_{metric_name(name)}_seconds"
+            lines.append(f"# TYPE {metric} histogram")
+            cumulative = 0
+            for bound, n in zip(BUCKETS, h["buckets"]):
+                cumulative += n
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f'{metric}_bucket{{le="{le}"}} {cumulative}')
+            lines += [f"{metric}_sum {h['sum']}", f"{metric}_count {h['count']}"]
+        return "\n".join(lines) + "\n" if lines else ""
+
+    def clear(self) -> None:
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+class NullMetrics:
+    # records nothing, the default
+
+    enabled = False
+    null_span = nullcontext()
+
+    def count(self, name: str, n: int = 1) -> None:
+        pass
+
+    def observe(self, name: str, seconds: float) -> None:
+        pass
+
+    def span(self, name: str):
+        return self.null_span
+
+    def snapshot(self) -> dict:
+        return {"counters": {}, "histograms": {}}
+
+    def merge(self, snapshot: dict) -> None:
+        pass
+
+    def export(self) -> str:
+        return ""
+
+    def clear(self) -> None:
+        pass
+
+def metric_name(name: str) -> str:
+    return "".join(c if c.isalnum() else "_" for c in name)
+
+RECORDER = Metrics() if METRICS_ENABLED else NullMetrics()
+
+def enable(recorder: Metrics | None = None) -> Metrics:
+    """starts recording, into recorder if given. returns the recorder"""
+    global RECORDER
+    if recorder is not None:
+        RECORDER = recorder
+    elif not RECORDER.enabled:
+        RECORDER = Metrics()
+    return RECORDER
+
+def disable() -> None:
+    global RECORDER
+    RECORDER = NullMetrics()
+
+def count(name: str, n: int = 1) -> None:
+    RECORDER.count(name, n)
+
+def observe(name: str, seconds: float) -> None:
+    RECORDER.observe(name, seconds)
+
+def span(name: str):
+    """with span("stage"): ... records the duration of the block"""
+    return RECORDER.span(name)
+
+def snapshot() -> dict:
+    return RECORDER.snapshot()
+
+def export() -> str:
+    return RECORDER.export()
+
+def collect(enabled: bool, function, *args):
+    """
+    runs function(*args) in a worker process, returns its result and
+    what it recorded (None if enabled is False), see Metrics.merge.
+    a fresh recorder is used, a forked worker inherits the parent's.
+    """
+    global RECORDER
+    if not enabled:
+        return function(*args), None
+    previous, RECORDER = RECORDER, Metrics()
+    try:
+        return function(*args), RECORDER.snapshot()
+    finally:
+        RECORDER = previous
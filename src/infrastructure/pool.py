@@ -0,0 +1,82 @@
+"""
+ConnectionPool class.
+
+pool of read-only SQLite connections shared by the threads of a process.
+a connection is only ever used by the thread that acquired it, until it
+is released again.
+"""
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from config import READ_POOL_SIZE, STATEMENT_CACHE_SIZE
+
+class ConnectionPool:
+
+    def __init__(self, db: str, size: int = READ_POOL_SIZE, setup = None):
+        """
+        size: max. number of connections, readers wait when all are in use.
+        setup: called with every new connection, e.g. to apply pragmas.
+        """
+        self.db = db
+        self.size = size
+        self.setup = setup
+        self.idle = queue.LifoQueue() # most recently used first, warm caches
+        self.created = 0
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def open(self) -> sqlite3.Connection:
+        # WAL readers never block behind the writer, or each other
+        conn = sqlite3.connect(f"file:{self.db}?mode=ro", uri=True,
+                               check_same_thread=False,
+                               cached_statements=STATEMENT_CACHE_SIZE)
+        if self.setup is not None:
+            self.setup(conn)
+        return conn
+
+    def acquire(self) -> sqlite3.Connection:
+        if self.closed:
+            raise RuntimeError("connection pool is closed")
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            create = self.created < self.size
+            if create:
+                self.created += 1
+        if create:
+            try:
+                return self.open()
+            except BaseException:
+                with self.lock:
+                    self.created -= 1
+                raise
+        return self.idle.get()
+
+    def release(self, conn: sqlite3.Connection) -> None:
+        if conn.in_transaction:
+            conn.rollback()
+        if self.closed:
+            conn.close()
+            return
+        self.idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self) -> None:
+        """closes idle connections, the ones in use are closed on release"""
+        self.closed = True
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
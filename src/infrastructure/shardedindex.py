@@ -0,0 +1,271 @@
+"""
+ShardedIndex class.
+
+splits a vector index into shards (one Index each) that are added to,
+rebuilt and dropped independently. searches fan out to all shards in
+parallel and the results are merged into a global top k.
+"""
+
+import os
+import json
+import heapq
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from .vectorindex import Index
+from .threads import set_threads
+
+from config import SHARD_SIZE, SHARD_ID_RANGE, SHARD_WORKERS, QUERY_THREADS
+
+# how vectors are assigned to shards
+SHARD_BY = ("size", "range", "volume")
+
+class ShardedIndex:
+
+    def __init__(self, d:int, directory:str, new:bool = True,
+                 by:str = "size",
+                 shard_size:int = SHARD_SIZE,
+                 id_range:int = SHARD_ID_RANGE,
+                 workers:int = SHARD_WORKERS,
+                 **index_args):
+        """
+        by: "size" fills a shard up to shard_size vectors before the next
+        one is started, "range" puts ids [i * id_range, (i+1) * id_range)
+        into shard i, "volume" leaves it to the caller: each volume's
+        DataBase uses its own shard(name).
+        workers: threads searching shards in parallel.
+        index_args: passed to every shard's Index, e.g. spec.
+        """
+        if by not in SHARD_BY:
+            raise ValueError(f"by must be one of {SHARD_BY}")
+        self.d = d
+        self.path = directory
+        self.manifest_path = os.path.join(directory, "shards.json")
+        self.by = by
+        self.shard_size = shard_size
+        self.id_range = id_range
+        self.index_args = index_args
+        self.shards = {}
+        self.ranges = {} # name -> [lowest id, highest id] of size shards
+        self.next_shard = 0 # size shard names are never reused
+        self.bulk_depth = 0
+        self.tracking = False # see track
+        # generations of dropped shards, keeps generation increasing
+        self.dropped = 0
+        self.invalidated = 0 # see invalidate
+        self.lock = threading.RLock() # serialises changes of the shard set
+        self.pool = ThreadPoolExecutor(workers)
+        Path(directory).mkdir(parents=True, exist_ok=True)
+        if not new and os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+            self.by = manifest["by"]
+            self.dropped = manifest["dropped"]
+            self.ranges = manifest["ranges"]
+            self.next_shard = manifest["next_shard"]
+            for name in manifest["shards"]:
+                self.shards[name] = Index(d, self.shard_path(name), new=False,
+                                          **index_args)
+        else:
+            self.write_manifest()
+
+    def __enter__(self):
+        self.begin()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(flush=exc_type is None)
+
+    def begin(self) -> None:
+        """bulk mode for all shards, see Index.begin"""
+        with self.lock:
+            self.bulk_depth += 1
+            for shard in self.shards.values():
+                shard.begin()
+
+    def close(self, flush:bool = True) -> None:
+        with self.lock:
+            if self.bulk_depth > 0:
+                self.bulk_depth -= 1
+            for shard in self.shards.values():
+                shard.close(flush)
+
+    def track(self) -> None:
+        """records changes of all shards, see Index.track"""
+        with self.lock:
+            self.tracking = True
+            for shard in self.shards.values():
+                shard.track()
+
+    def commit(self) -> None:
+        with self.lock:
+            for shard in self.shards.values():
+                shard.commit()
+
+    def rollback(self) -> None:
+        with self.lock:
+            for shard in self.shards.values():
+                shard.rollback()
+
+    def flush(self) -> None:
+        for shard in list(self.shards.values()):
+            shard.flush()
+
+    def shard_path(self, name:str) -> str:
+        return os.path.join(self.path, f"{name}.index")
+
+    def shard(self, name:str) -> Index:
+        """the shard called name, created if it does not exist"""
+        with self.lock:
+            if name not in self.shards:
+                shard = Index(self.d, self.shard_path(name), new=True,
+                              **self.index_args)
+                for _ in range(self.bulk_depth):
+                    shard.begin()
+                if self.tracking:
+                    shard.track()
+                self.shards[name] = shard
+                self.write_manifest()
+            return self.shards[name]
+
+    def add(self, vectors:np.ndarray, ids:np.ndarray) -> None:
+        if self.by == "volume":
+            raise ValueError("add to a volume's shard(name) instead")
+        ids = np.asarray(ids, dtype="int64")
+        with self.lock:
+            if self.by == "range":
+                groups = ids // self.id_range
+                for group in np.unique(groups):
+                    rows = groups == group
+                    self.shard(f"range-{group}").add(vectors[rows], ids[rows])
+                return
+
+            start = 0
+            while start < len(ids):
+                name, shard = self.open_shard()
+                end = start + self.shard_size - shard.index.ntotal
+                added = ids[start:end]
+                shard.add(vectors[start:end], added)
+                lo, hi = self.ranges.get(name, (int(added.min()), int(added.max())))
+                self.ranges[name] = [min(lo, int(added.min())),
+                                     max(hi, int(added.max()))]
+                start = end
+            self.write_manifest()
+
+    def open_shard(self) -> tuple[str, Index]:
+        # the newest size shard while it has room, a new one otherwise
+        name = f"size-{self.next_shard - 1}"
+        if name in self.shards and self.shards[name].index.ntotal < self.shard_size:
+            return name, self.shards[name]
+        name = f"size-{self.next_shard}"
+        self.next_shard += 1
+        return name, self.shard(name)
+
+    def remove(self, ids:np.ndarray) -> None:
+        """tombstones ids in the shards holding them"""
+        if len(ids) == 0:
+            return
+        if self.by == "volume":
+            raise ValueError("remove from a volume's shard(name) instead")
+        ids = np.asarray(ids, dtype="int64")
+        with self.lock:
+            if self.by == "range":
+                groups = ids // self.id_range
+                for group in np.unique(groups):
+                    shard = self.shards.get(f"range-{group}")
+                    if shard is not None:
+                        shard.remove(ids[groups == group])
+                return
+            for name, (lo, hi) in self.ranges.items():
+                rows = (ids >= lo) & (ids <= hi)
+                if rows.any() and name in self.shards:
+                    self.shards[name].remove(ids[rows])
+
+    def drop(self, name:str) -> None:
+        """removes a shard and its files"""
+        with self.lock:
+            shard = self.shards.pop(name)
+            self.dropped += shard.generation + 1
+            shard.wait()
+            self.write_manifest()
+        paths = [shard.path, shard.deleted_path]
+        if shard.store is not None:
+            paths += [shard.store.vectors_path, shard.store.ids_path]
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def rebuild(self, name:str, spec:str, **rebuild_args) -> None:
+        """rebuilds one shard, the others stay searchable and writable"""
+        self.shards[name].rebuild(spec, **rebuild_args)
+
+    def write_manifest(self) -> None:
+        with self.lock:
+            tmp_path = f"{self.manifest_path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump({"by": self.by,
+                           "dropped": self.dropped,
+                           "next_shard": self.next_shard,
+                           "shards": list(self.shards),
+                           "ranges": {name: r for name, r in self.ranges.items()
+                                      if name in self.shards}}, f)
+            os.replace(tmp_path, self.manifest_path)
+
+    @property
+    def generation(self) -> int:
+        """changes whenever any shard changes, see Index.generation"""
+        return (self.dropped + self.invalidated
+                + sum(s.generation for s in list(self.shards.values())))
+
+    def invalidate(self) -> None:
+        """bumps generation, see Index.invalidate"""
+        with self.lock:
+            self.invalidated += 1
+
+    def search_shards(self, query:np.ndarray, k:int,
+                      threads:int | None = QUERY_THREADS,
+                      **search_args) -> list[list[tuple[str, int, np.float32]]]:
+        """
+        global top k per query as (shard name, id, score), ids of
+        different volume shards may collide.
+        threads: cores each shard search uses, see set_threads.
+        """
+        if query.ndim == 1:
+            query = query.reshape(1, -1)
+        shards = list(self.shards.items())
+        futures = [(name, self.pool.submit(search_shard, shard, query, k,
+                                           threads, search_args))
+                   for name, shard in shards]
+        per_shard = [(name, future.result()) for name, future in futures]
+
+        return [heapq.nlargest(k, ((name, i, d)
+                                   for name, results in per_shard
+                                   for i, d in results[x]),
+                               key=lambda r: r[2])
+                for x in range(len(query))]
+
+    def search(self, query:np.ndarray, k:int,
+               **search_args) -> list[list[tuple[int, np.float32]]]:
+        """
+        global top k per query, see Index.search. ids of volume shards
+        are only unique within a shard, use search_shards for those.
+        """
+        if self.by == "volume":
+            raise ValueError("ids of volume shards collide, use search_shards")
+        return [[(i, d) for _, i, d in r]
+                for r in self.search_shards(query, k, **search_args)]
+
+    def wait(self) -> None:
+        for shard in list(self.shards.values()):
+            shard.wait()
+
+    def size(self) -> int:
+        return sum(shard.size() for shard in list(self.shards.values()))
+
+def search_shard(shard:Index, query:np.ndarray, k:int, threads:int | None,
+                 search_args:dict) -> list[list[tuple[int, np.float32]]]:
+    # runs in a pool thread, thread budgets are per thread
+    set_threads(threads)
+    return shard.search(query, k, **search_args)
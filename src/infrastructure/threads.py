@@ -0,0 +1,26 @@
+"""
+thread budgets.
+
+sets how many cores FAISS (OpenMP) and torch use. ingestion and queries
+get separate budgets (INGEST_THREADS / QUERY_THREADS), trading per query
+latency against the number of concurrent queries. only the FAISS budget
+is per thread: torch has one budget for the whole process, so ingestion
+and searches running in the same process share the one set last.
+"""
+import os
+import sys
+import faiss
+
+def set_threads(n: int | None) -> None:
+    """
+    OpenMP threads of FAISS calls made by the calling thread, and torch's
+    intra-op threads (process wide, once torch is loaded).
+    None: all cores, also undoing an earlier budget of the thread.
+    """
+    if n is None:
+        n = os.cpu_count() or 1
+    faiss.omp_set_num_threads(n)
+    # never import torch just for this, it is loaded with the first model
+    torch = sys.modules.get("torch")
+    if torch is not None and torch.get_num_threads() != n:
+        torch.set_num_threads(n)
@@ -6,28 +6,266 @@ holds fucntions for interaction with the index.
 """
 
 import os
-
-os.environ["OMP_NUM_THREADS"] = "1"
-os.environ["MKL_NUM_THREADS"] = "1"
-os.environ["OPENBLAS_NUM_THREADS"] = "1"
-os.environ["NUMEXPR_NUM_THREADS"] = "1"
-
+import time
+import threading
 import numpy as np
-from faiss import IndexFlatIP, IndexIDMap2, write_index, read_index
+from faiss import (IndexFlat, IndexHNSW, IndexIVF, IndexIVFFlat, IndexIDMap2,
+                   IDSelectorAnd, IDSelectorBatch, IDSelectorBitmap,
+                   IDSelectorNot, IDSelectorRange, SearchParameters,
+                   IO_FLAG_MMAP_IFC, IO_FLAG_READ_ONLY,
+                   SearchParametersHNSW, SearchParametersIVF,
+                   METRIC_INNER_PRODUCT, clone_index, downcast_index,
+                   index_factory, knn, serialize_index,
+                   swig_ptr, vector_to_array, write_index, read_index)
 from pathlib import Path
 
+from . import metrics
+from .locks import ReadWriteLock
+from .vectorstore import VectorStore
+
+from config import (INDEX_FLUSH_EVERY, INDEX_FLUSH_INTERVAL, COMPACT_THRESHOLD,
+                    IVF_NLIST, HNSW_M, PQ_M, TRAIN_SIZE, NPROBE, EF_SEARCH)
+
+# faiss factory strings of the supported index types.
+# any other spec is passed to faiss.index_factory as is.
+INDEX_SPECS = {
+    "flat": "Flat",
+    "ivf": "IVF{nlist},Flat",
+    "hnsw": "HNSW{hnsw_m}",
+    "ivfpq": "IVF{nlist},PQ{pq_m}",
+    # compressed without coarse quantizer, 8 bit per dimension / pq_m bytes
+    "sq8": "SQ8",
+    "pq": "PQ{pq_m}",
+}
+
+def build_index(d:int, spec:str, n:int = 0) -> IndexIDMap2:
+    """
+    creates an empty inner product index from a spec.
+    n (expected number of vectors) sizes the IVF coarse quantizer
+    unless IVF_NLIST is configured.
+    """
+    nlist = IVF_NLIST or (min(n, int(4 * np.sqrt(n))) if n else 1024)
+    description = INDEX_SPECS.get(spec, spec).format(
+        nlist=nlist, hnsw_m=HNSW_M, pq_m=PQ_M)
+    base_index = index_factory(d, description, METRIC_INNER_PRODUCT)
+    if isinstance(base_index, IndexIVF):
+        base_index.nprobe = NPROBE
+        base_index.make_direct_map() # needed for reconstruct()
+    elif isinstance(base_index, IndexHNSW):
+        base_index.hnsw.efSearch = EF_SEARCH
+    return IndexIDMap2(base_index)
+
+def min_train_size(index:IndexIDMap2) -> int:
+    """
+    fewest vectors index can be trained on: one per IVF list and per
+    PQ codebook entry (256 with 8 bit codes). 0 if it needs no training.
+    """
+    base_index = downcast_index(index.index)
+    n = base_index.nlist if isinstance(base_index, IndexIVF) else 0
+    pq = getattr(base_index, "pq", None)
+    if pq is not None:
+        n = max(n, pq.ksub)
+    return n
+
+def check_train_size(index:IndexIDMap2, n:int, spec:str = "index") -> None:
+    # faiss fails or trains a useless codebook on fewer vectors
+    needed = min_train_size(index)
+    if n < needed:
+        raise ValueError(f"{spec} needs at least {needed} vectors to "
+                         f"train, got {n}")
+
+def id_selector(ids:np.ndarray) -> tuple:
+    """
+    selector restricting a search to ids (sorted, unique), see
+    Index.search. returned as (selector, objects it references).
+    one contiguous run of ids is checked by its bounds, dense sets by
+    a bitmap over all ids up to the largest and sparse sets by a hash set.
+    """
+    ids = np.asarray(ids, dtype="int64")
+    if len(ids) == 0 or ids[-1] - ids[0] + 1 == len(ids):
+        # [first, last + 1), empty when there are no ids
+        bounds = (int(ids[0]), int(ids[-1]) + 1) if len(ids) else (0, 0)
+        return (IDSelectorRange(*bounds),)
+    # a bit per possible id against 8+ bytes per id in a hash set
+    if ids[-1] + 1 <= 64 * len(ids):
+        bits = np.zeros(ids[-1] + 1, dtype=bool)
+        bits[ids] = True
+        bitmap = np.packbits(bits, bitorder="little")
+        return (IDSelectorBitmap(len(bitmap), swig_ptr(bitmap)), bitmap)
+    return (IDSelectorBatch(ids), ids)
+
 class Index:
 
-    def __init__(self, d:int, index_path:str, new:bool = True):
+    def __init__(self, d:int, index_path:str, new:bool = True,
+                 flush_every:int = INDEX_FLUSH_EVERY,
+                 flush_interval:float = INDEX_FLUSH_INTERVAL,
+                 compact_threshold:float = COMPACT_THRESHOLD,
+                 spec:str = "flat",
+                 keep_vectors:bool = False,
+                 read_only:bool = False):
+        """
+        spec: index type for new indexes, one of INDEX_SPECS or a faiss
+        factory string. types other than flat and hnsw have to be
+        trained (train(), or rebuild() an existing index) before adding.
+        keep_vectors: also store full precision vectors on disk, used to
+        re-rank results of compressed indexes (see search) and to
+        rebuild/compact them without loss.
+        read_only: memory-map an existing index instead of reading it
+        into memory. startup is near-instant and processes opening the
+        same file share its pages. the index can not be changed, use
+        reload() to pick up a newer file written by another process.
+        """
         self.path = index_path
+        self.deleted_path = f"{index_path}.deleted"
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.compact_threshold = compact_threshold
+        self.pending = 0 # vectors added or removed since the last write
+        self.bulk_depth = 0
+        self.last_flush = time.monotonic()
+        # ids removed from the index but still physically stored in it,
+        # excluded from searches until the next compaction
+        self.deleted = set()
+        # (added ids, removed ids) since the last commit() while tracked,
+        # see track()
+        self.changes = None
+        self.selector = None
+        self.lock = threading.RLock() # serialises changes, not searches
+        # shared by searches, exclusive while self.index is changed in
+        # place or replaced, so no search reads memory an add reallocates
+        self.search_lock = ReadWriteLock()
+        self.compaction = None
+        self.store = None
+        self.read_only = read_only
+        self.signature = None # identifies the index files that were read
+        self.written_deleted = set() # tombstones in the .deleted file
+        # bumped on every change of the searchable contents, lets caches
+        # of search results tell whether they are still valid
+        self.generation = 0
         idx_path = Path(index_path)
-        if not new and idx_path.exists():
-            self.index = read_index(index_path)
+        if read_only:
+            if not idx_path.exists():
+                raise FileNotFoundError(f"no index at {index_path}")
+            new = False # never truncate files of a read-only index
+        if read_only or (not new and idx_path.exists()):
+            self.load()
         else:
-            base_index = IndexFlatIP(d)
-            self.index = IndexIDMap2(base_index)
+            self.index = build_index(d, spec)
             idx_path.parent.mkdir(parents=True, exist_ok=True)
-            write_index(self.index, index_path)
+            self.write()
+            new = True
+        if keep_vectors:
+            store = VectorStore(d, index_path, new, read_only)
+            if (not read_only and store.size() == 0
+                    and self.index.ntotal > 0):
+                # index written without a store, start from its vectors
+                store.add(*reversed(self.vectors()))
+            self.store = store
+
+    def load(self) -> None:
+        signature = self.file_signature()
+        if self.read_only:
+            # the mapping keeps the file's inode alive, so a writer
+            # replacing the file never pulls pages from under a search
+            index = read_index(self.path, IO_FLAG_MMAP_IFC | IO_FLAG_READ_ONLY)
+        else:
+            index = read_index(self.path)
+        try:
+            deleted = set(np.load(self.deleted_path).tolist())
+        except FileNotFoundError:
+            deleted = set()
+        with self.lock, self.search_lock.exclusive():
+            self.index = index
+            self.deleted = deleted
+            self.written_deleted = set(deleted)
+            self.update_selector()
+            self.generation += 1
+            if self.store is not None:
+                self.store.stale = True
+            self.signature = signature
+
+    def file_signature(self) -> tuple:
+        # writes rename new files over the index and its tombstones,
+        # which changes their inodes
+        st = os.stat(self.path)
+        try:
+            deleted = os.stat(self.deleted_path)
+            deleted = deleted.st_ino, deleted.st_mtime_ns, deleted.st_size
+        except FileNotFoundError:
+            deleted = None
+        return st.st_ino, st.st_mtime_ns, st.st_size, deleted
+
+    def reload(self) -> bool:
+        """
+        re-opens the index if its files were replaced since they were read,
+        returns whether it was. cheap enough to call before every search.
+        """
+        try:
+            if self.file_signature() == self.signature:
+                return False
+        except FileNotFoundError:
+            return False
+        self.load()
+        return True
+
+    def check_writable(self) -> None:
+        if self.read_only:
+            raise RuntimeError("index is opened read-only")
+
+    def __enter__(self):
+        self.begin()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # changes of a failed block are not persisted, see rollback()
+        self.close(flush=exc_type is None)
+
+    def begin(self) -> None:
+        """
+        enter bulk mode: adds are kept in memory and only written to disk
+        on flush(), close() or when a size/time threshold is crossed.
+        calls can be nested, the outermost close() persists the index.
+        """
+        self.bulk_depth += 1
+
+    def flush(self) -> None:
+        if self.pending and not self.read_only:
+            self.write()
+
+    def close(self, flush:bool = True) -> None:
+        if self.bulk_depth > 0:
+            self.bulk_depth -= 1
+        if self.bulk_depth == 0 and flush:
+            self.flush()
+
+    def write(self) -> None:
+        # write next to the old file and rename over it, so a crash
+        # mid-write never leaves a truncated index behind
+        with self.lock:
+            tmp_path = f"{self.path}.tmp"
+            with metrics.span("index.write"):
+                write_index(self.index, tmp_path)
+            # a reader loading in between must not get an index without
+            # the tombstones it needs: new tombstones are written before
+            # the index, dropped ones (e.g. compacted away) after it
+            union = self.deleted | self.written_deleted
+            if union != self.written_deleted:
+                self.write_deleted(union)
+            os.replace(tmp_path, self.path)
+            if union != self.deleted:
+                self.write_deleted(self.deleted)
+            self.written_deleted = set(self.deleted)
+            self.signature = self.file_signature()
+            self.pending = 0
+            self.last_flush = time.monotonic()
+
+    def write_deleted(self, deleted:set) -> None:
+        if deleted:
+            with open(f"{self.deleted_path}.tmp", "wb") as f:
+                np.save(f, np.fromiter(deleted, dtype="int64"))
+            os.replace(f"{self.deleted_path}.tmp", self.deleted_path)
+        elif os.path.exists(self.deleted_path):
+            os.remove(self.deleted_path)
 
     def add(self, vectors:np.ndarray, ids:np.ndarray) -> None:
         if len(ids)!= vectors.shape[0]:
@@ -36,29 +274,331 @@ class Index:
             raise ValueError("vectors must be 2D nd.array of shape (n, d)")
         elif vectors.dtype != np.dtype("float32"):
             raise ValueError("vectors must be of dtype float32")
-        self.index.add_with_ids(vectors, ids)
+        elif not self.index.is_trained:
+            raise RuntimeError("index must be trained before vectors are added")
+        self.check_writable()
+        with self.lock:
+            with metrics.span("index.add"), self.search_lock.exclusive():
+                self.index.add_with_ids(vectors, ids)
+            metrics.count("index.vectors", len(ids))
+            if self.changes is not None:
+                self.changes[0].append(np.asarray(ids, dtype="int64"))
+            if self.store is not None:
+                self.store.add(vectors, ids)
+            self.generation += 1
+            self.pending += len(ids)
+
+            if (self.bulk_depth == 0
+                    or self.pending >= self.flush_every
+                    or time.monotonic() - self.last_flush >= self.flush_interval):
+                self.write()
 
-        write_index(self.index, self.path)
+    def remove(self, ids:np.ndarray) -> None:
+        """
+        tombstones vectors: they stay in the index but are never returned
+        by search. once more than compact_threshold of the index is
+        tombstoned, a compaction is started in the background.
+        """
+        if len(ids) == 0:
+            return
+        self.check_writable()
+        with self.lock:
+            ids = {int(i) for i in ids} - self.deleted
+            if self.changes is not None:
+                self.changes[1].update(ids)
+            with self.search_lock.exclusive():
+                self.deleted.update(ids)
+                self.update_selector()
+            self.generation += 1
+            self.pending += len(ids)
+
+            if self.bulk_depth == 0:
+                self.write()
+            if self.tombstone_ratio() >= self.compact_threshold:
+                self.compact(background=True)
+
+    def track(self) -> None:
+        """
+        records adds and removes from now on, so they can be undone
+        together with the database transaction they belong to: commit()
+        keeps them, rollback() undoes them.
+        """
+        with self.lock:
+            if self.changes is None:
+                self.changes = ([], set())
+
+    def commit(self) -> None:
+        """keeps the adds and removes since the last commit"""
+        with self.lock:
+            if self.changes is None:
+                return
+            self.changes = ([], set())
+            # compaction waits for removes that could still be undone
+            if self.deleted and self.tombstone_ratio() >= self.compact_threshold:
+                self.compact(background=True)
+
+    def rollback(self) -> None:
+        """
+        undoes the adds and removes since the last commit. added vectors
+        are physically removed, so their ids can be used again.
+        """
+        with self.lock:
+            if self.changes is None:
+                return
+            added, removed = self.changes
+            self.changes = ([], set())
+            if not added and not removed:
+                return
+            self.check_writable()
+            with self.search_lock.exclusive():
+                self.deleted -= removed
+                if added:
+                    self.deleted.update(np.concatenate(added).tolist())
+                self.update_selector()
+            self.generation += 1
+            self.pending += 1
+            if added:
+                self.compact() # writes the index unless in bulk mode
+            elif self.bulk_depth == 0:
+                self.write()
+
+    def invalidate(self) -> None:
+        """
+        bumps generation without changing the index, e.g. once the
+        database committed chunks whose vectors were added before
+        """
+        with self.lock:
+            self.generation += 1
+
+    def tombstone_ratio(self) -> float:
+        if self.index.ntotal == 0:
+            return 0.0
+        return len(self.deleted) / self.index.ntotal
+
+    def compact(self, background:bool = False) -> None:
+        """
+        physically removes tombstoned vectors by rebuilding the index.
+        searches keep running against the old index meanwhile, adds and
+        removes wait until the rebuilt index is swapped in.
+        """
+        if background:
+            if self.compaction is None or not self.compaction.is_alive():
+                self.compaction = threading.Thread(target=self.compact,
+                                                   daemon=True)
+                self.compaction.start()
+            return
+
+        self.check_writable()
+        with self.lock:
+            # tombstones that are not committed yet may be restored
+            if not self.deleted or (self.changes is not None
+                                    and self.changes[1]):
+                return
+            if isinstance(self.base_index(), IndexFlat):
+                index = clone_index(self.index)
+                index.remove_ids(np.fromiter(self.deleted, dtype="int64"))
+            else:
+                # removing from IVF/HNSW through the id map is unsupported,
+                # re-add the live vectors to an emptied, still trained copy
+                ids, vectors = self.vectors()
+                base_index = clone_index(self.base_index())
+                base_index.reset()
+                index = IndexIDMap2(base_index)
+                index.add_with_ids(vectors, ids)
+            self.swap(index)
+
+    def train(self, vectors:np.ndarray) -> None:
+        self.check_writable()
+        check_train_size(self.index, len(vectors))
+        with self.lock, self.search_lock.exclusive():
+            self.index.train(vectors)
+
+    def rebuild(self, spec:str, train_size:int = TRAIN_SIZE) -> None:
+        """
+        turns the index into another index type using the vectors it
+        already holds, no re-embedding needed. trainable types are
+        trained on a random sample of up to train_size stored vectors.
+        rebuilding from a compressed (pq) index starts from its
+        approximated vectors. ValueError if there are too few vectors
+        to train spec, see min_train_size.
+        """
+        self.check_writable()
+        with self.lock:
+            if self.changes is not None and self.changes[1]:
+                # the rebuilt index would lack the vectors to restore
+                raise RuntimeError("commit or roll back removes before rebuilding")
+            ids, vectors = self.vectors()
+            index = build_index(self.index.d, spec, len(ids))
+            if not index.is_trained:
+                n = min(train_size, len(ids))
+                check_train_size(index, n, spec)
+                rng = np.random.default_rng(0)
+                sample = rng.choice(len(ids), n, replace=False)
+                index.train(vectors[np.sort(sample)])
+            index.add_with_ids(vectors, ids)
+            self.swap(index)
+
+    def swap(self, index:IndexIDMap2) -> None:
+        if self.store is not None and self.deleted:
+            self.store.compact(self.deleted)
+        # searches see the old index and selector or the new ones,
+        # never a mix that exposes tombstoned vectors
+        with self.search_lock.exclusive():
+            self.index = index
+            self.deleted = set()
+            self.update_selector()
+        self.generation += 1
+        self.pending += 1
+        if self.bulk_depth == 0:
+            self.write()
+
+    def base_index(self):
+        return downcast_index(self.index.index)
+
+    def vectors(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+        ids and vectors of all searchable entries, exact if full
+        precision vectors are kept, reconstructed from the index otherwise
+        """
+        with self.lock:
+            if self.store is not None:
+                ids, vectors = self.store.all()
+            else:
+                ids = vector_to_array(self.index.id_map)
+                vectors = self.index.index.reconstruct_n(0, self.index.ntotal)
+            if self.deleted:
+                keep = ~np.isin(ids, np.fromiter(self.deleted, dtype="int64"))
+                ids, vectors = ids[keep], vectors[keep]
+            return ids, vectors
+
+    def wait(self) -> None:
+        """blocks until a running background compaction has finished"""
+        if self.compaction is not None:
+            self.compaction.join()
+
+    def update_selector(self) -> None:
+        if not self.deleted:
+            self.selector = None
+            return
+        batch = IDSelectorBatch(np.fromiter(self.deleted, dtype="int64"))
+        # keep the wrapped selector alive together with its wrapper
+        self.selector = (IDSelectorNot(batch), batch)
+
+    def search_params(self, selector, base_index, nprobe:int | None,
+                      ef_search:int | None):
+        # IVF and HNSW only accept their own parameter types
+        if isinstance(base_index, IndexIVF):
+            params = SearchParametersIVF(nprobe=nprobe or base_index.nprobe)
+        elif isinstance(base_index, IndexHNSW):
+            params = SearchParametersHNSW(
+                efSearch=ef_search or base_index.hnsw.efSearch)
+        elif selector is not None:
+            params = SearchParameters()
+        else:
+            return None
+        if selector is not None:
+            params.sel = selector[0]
+        return params
 
     def get(self, i:int) -> np.ndarray:
-        return self.index.reconstruct(i)
+        with self.search_lock.shared():
+            return self.index.reconstruct(i)
     
-    def search(self, query: np.ndarray, 
-               k: int) -> list[list[(int, np.float32)]]:
+    def search(self, query: np.ndarray, k: int,
+               nprobe: int | None = None,
+               ef_search: int | None = None,
+               rerank: int | None = None,
+               allowed: tuple | None = None) -> list[list[(int, np.float32)]]:
+        """
+        nprobe: IVF lists visited per query, ef_search: HNSW candidate
+        list size. both trade speed for recall and are ignored by index
+        types they do not apply to.
+        rerank: fetch this many candidates and re-score them exactly with
+        the full precision vectors (requires keep_vectors).
+        allowed: only return these ids, a selector from id_selector().
+        applied while searching, so k results are found if k allowed
+        ids exist.
+        """
         if query.ndim == 1:
             query = query.reshape(1, -1) # turn into 2D array if input is 1D
 
-        D, I = self.index.search(query, k) 
+        n = max(k, rerank) if rerank and self.store is not None else k
+        with self.search_lock.shared():
+            selector = self.selector
+            if allowed is not None:
+                selector = allowed if selector is None else (
+                    IDSelectorAnd(allowed[0], selector[0]), allowed, selector)
+            index = self.index
+            params = self.search_params(selector, downcast_index(index.index),
+                                        nprobe, ef_search)
+            with metrics.span("index.search"):
+                D, I = index.search(query, n, params=params)
         # D = similarity score, not distance as in other indexes
+        if n > k:
+            with metrics.span("index.rerank"):
+                D, I = self.rerank(query, I, k)
+        metrics.count("index.queries", len(query))
 
-        print(f"D: {D}")
-        print(f"I: {I}")
-
+        # -1 marks empty slots when fewer than k vectors match
         results = [[(int(i), np.float32(d)) 
-                    for i, d in zip(I[x],D[x])] 
+                    for i, d in zip(I[x],D[x]) if i != -1] 
                     for x in range(len(D))] 
         
         return results
     
+    def rerank(self, query: np.ndarray, I: np.ndarray,
+               k: int) -> tuple[np.ndarray, np.ndarray]:
+        D_exact = np.full((len(I), k), -np.inf, dtype="float32")
+        I_exact = np.full((len(I), k), -1, dtype="int64")
+        for x, candidates in enumerate(I):
+            candidates = candidates[candidates != -1]
+            scores = self.store.get(candidates) @ query[x]
+            top = np.argsort(-scores, kind="stable")[:k]
+            D_exact[x, :len(top)] = scores[top]
+            I_exact[x, :len(top)] = candidates[top]
+        return D_exact, I_exact
+
+    def recall(self, queries: np.ndarray, k: int,
+               ground_truth: tuple[np.ndarray, np.ndarray] | None = None,
+               **search_args) -> float:
+        """
+        recall@k of search(queries, k, **search_args) against an exact
+        search over full precision vectors.
+        ground_truth: (ids, vectors) to search exactly, e.g. vectors()
+        taken before rebuilding into a compressed type. defaults to the
+        kept vectors (keep_vectors) or the index itself if it stores
+        vectors uncompressed. a compressed index can not be its own
+        ground truth, ValueError then.
+        """
+        if ground_truth is None:
+            if self.store is None and not self.exact():
+                raise ValueError("recall of a compressed index needs "
+                                 "keep_vectors or a ground_truth")
+            ground_truth = self.vectors()
+        ids, vectors = ground_truth
+        if self.deleted:
+            keep = ~np.isin(ids, np.fromiter(self.deleted, dtype="int64"))
+            ids, vectors = ids[keep], vectors[keep]
+        _, exact = knn(queries, np.ascontiguousarray(vectors), k,
+                       metric=METRIC_INNER_PRODUCT)
+        results = self.search(queries, k, **search_args)
+        hits = sum(len(set(ids[e[e != -1]]) & {i for i, _ in r})
+                   for e, r in zip(exact, results))
+        return hits / (len(queries) * k)
+
+    def exact(self) -> bool:
+        """whether the index stores vectors uncompressed (flat, hnsw, ivf)"""
+        base_index = self.base_index()
+        if isinstance(base_index, IndexHNSW):
+            base_index = downcast_index(base_index.storage)
+        return isinstance(base_index, (IndexFlat, IndexIVFFlat))
+
+    def nbytes(self) -> int:
+        """memory held by the index, estimated by its serialized size"""
+        with self.search_lock.shared():
+            return serialize_index(self.index).nbytes
+
     def size(self):
-        return self.index.ntotal
\ No newline at end of file
+        """number of searchable (not tombstoned) vectors"""
+        with self.lock:
+            return self.index.ntotal - len(self.deleted)
\ No newline at end of file
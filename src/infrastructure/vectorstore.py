@@ -0,0 +1,107 @@
+"""
+VectorStore class.
+
+append-only on-disk store of full precision vectors next to a (compressed)
+vector index. read through a memory map, so only looked up rows are paged in.
+"""
+
+import os
+import threading
+import numpy as np
+
+class VectorStore:
+
+    def __init__(self, d:int, path:str, new:bool = True,
+                 read_only:bool = False):
+        """
+        read_only: only map existing files, never create or truncate
+        them. missing files read as an empty store.
+        """
+        self.d = d
+        self.vectors_path = f"{path}.vectors"
+        self.ids_path = f"{path}.ids"
+        self.read_only = read_only
+        if not read_only:
+            for p in (self.vectors_path, self.ids_path):
+                if new or not os.path.exists(p):
+                    open(p, "wb").close()
+        self.stale = True # files changed since they were last mapped
+        self.lock = threading.Lock()
+
+    def check_writable(self) -> None:
+        if self.read_only:
+            raise RuntimeError("vector store is opened read-only")
+
+    def add(self, vectors:np.ndarray, ids:np.ndarray) -> None:
+        self.check_writable()
+        with open(self.vectors_path, "ab") as f:
+            f.write(np.ascontiguousarray(vectors, dtype="float32").tobytes())
+        with open(self.ids_path, "ab") as f:
+            f.write(np.asarray(ids, dtype="int64").tobytes())
+        self.stale = True
+
+    def load(self) -> None:
+        with self.lock:
+            if self.stale:
+                self.map_files()
+
+    def map_files(self) -> None:
+        # reset first: an add() while mapping marks the store stale again
+        self.stale = False
+        # a crash between the two appends leaves rows without an id,
+        # only rows present in both files count
+        n = min(file_size(self.vectors_path) // (4 * self.d),
+                file_size(self.ids_path) // 8)
+        if n:
+            self.vectors = np.memmap(self.vectors_path, dtype="float32",
+                                     mode="r", shape=(n, self.d))
+        else:
+            self.vectors = np.empty((0, self.d), dtype="float32")
+        if n:
+            self.ids = np.fromfile(self.ids_path, dtype="int64", count=n)
+        else:
+            self.ids = np.empty(0, dtype="int64")
+        self.order = np.argsort(self.ids, kind="stable")
+        self.sorted_ids = self.ids[self.order]
+
+    def get(self, ids:np.ndarray) -> np.ndarray:
+        """full precision vectors of ids, shape (len(ids), d)"""
+        self.load()
+        # one consistent snapshot, a concurrent reload replaces all of them
+        with self.lock:
+            sorted_ids, order, vectors = self.sorted_ids, self.order, self.vectors
+        ids = np.asarray(ids, dtype="int64")
+        pos = np.searchsorted(sorted_ids, ids)
+        pos = np.minimum(pos, len(sorted_ids) - 1)
+        if len(ids) and (len(sorted_ids) == 0
+                         or np.any(sorted_ids[pos] != ids)):
+            raise KeyError("ids not in vector store")
+        return np.asarray(vectors[order[pos]])
+
+    def all(self) -> tuple[np.ndarray, np.ndarray]:
+        self.load()
+        with self.lock:
+            return self.ids, self.vectors
+
+    def compact(self, deleted:set) -> None:
+        """rewrites the store without the deleted ids"""
+        self.check_writable()
+        ids, vectors = self.all()
+        keep = ~np.isin(ids, np.fromiter(deleted, dtype="int64"))
+        for path, data in ((self.vectors_path, vectors[keep]),
+                           (self.ids_path, ids[keep])):
+            with open(f"{path}.tmp", "wb") as f:
+                f.write(np.ascontiguousarray(data).tobytes())
+            os.replace(f"{path}.tmp", path)
+        self.stale = True
+
+    def size(self) -> int:
+        self.load()
+        return len(self.ids)
+
+def file_size(path:str) -> int:
+    # a read-only store does not create missing files
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return 0
@@ -1,13 +1,12 @@
-import processing.embeddings as em
 from infrastructure.vectorindex import Index
+from processing.models import MODELS
 
 import numpy as np
 
-from config import EMBEDDING_MODEL, VECTOR_DIM, INDEX_PATH
-from sentence_transformers import SentenceTransformer
+from config import EMBEDDING_MODEL, VECTOR_DIM
 
 def main():
     pass
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,142 @@
+"""
+EmbeddingCache class.
+
+bounded in-memory LRU cache of embeddings keyed on model name and a text
+key, with an optional SQLite tier on disk that survives restarts and
+keeps the most recently stored embeddings.
+"""
+import sqlite3
+import threading
+import numpy as np
+from collections import OrderedDict
+from pathlib import Path
+
+class EmbeddingCache:
+
+    def __init__(self, max_size: int, path: str | None = None,
+                 max_disk: int | None = None):
+        """
+        max_size: number of embeddings kept in memory.
+        path: SQLite file of the disk tier, None keeps the cache in memory only.
+        max_disk: number of embeddings kept on disk, the oldest stored are
+        evicted first. None: unbounded.
+        """
+        self.max_size = max_size
+        self.path = path
+        self.max_disk = max_disk
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.conn = None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def connect(self) -> sqlite3.Connection:
+        # opened on first use, shared by all threads under the lock
+        if self.conn is None:
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            self.conn = sqlite3.connect(self.path, check_same_thread=False)
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS embedding (
+                    model TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    vector BLOB NOT NULL,
+                    PRIMARY KEY (model, key)
+                )
+            """)
+            self.conn.commit()
+        return self.conn
+
+    def get_many(self, model: str, keys: list[str]) -> list[np.ndarray | None]:
+        """cached embeddings of keys, None for misses"""
+        found = [None] * len(keys)
+        with self.lock:
+            missing = []
+            for i, key in enumerate(keys):
+                vector = self.entries.get((model, key))
+                if vector is None:
+                    missing.append(i)
+                    continue
+                self.entries.move_to_end((model, key))
+                found[i] = vector
+            self.hits += len(keys) - len(missing)
+
+            if missing and self.path is not None:
+                stored = self.load(model, {keys[i] for i in missing})
+                still_missing = []
+                for i in missing:
+                    vector = stored.get(keys[i])
+                    if vector is None:
+                        still_missing.append(i)
+                        continue
+                    self.remember((model, keys[i]), vector)
+                    found[i] = vector
+                self.disk_hits += len(missing) - len(still_missing)
+                missing = still_missing
+            self.misses += len(missing)
+        return found
+
+    def put_many(self, model: str, keys: list[str], vectors: np.ndarray) -> None:
+        with self.lock:
+            for key, vector in zip(keys, vectors):
+                vector = np.array(vector, dtype="float32")
+                vector.flags.writeable = False # shared between callers
+                self.remember((model, key), vector)
+            if self.path is not None:
+                conn = self.connect()
+                conn.executemany(
+                    "INSERT OR REPLACE INTO embedding (model, key, vector) "
+                    "VALUES (?, ?, ?)",
+                    [(model, key, np.asarray(v, dtype="float32").tobytes())
+                     for key, v in zip(keys, vectors)])
+                if self.max_disk is not None:
+                    # rowids grow with every insert (a replace gets a new
+                    # one), the newest max_disk rowids are kept
+                    conn.execute(
+                        "DELETE FROM embedding WHERE rowid <= "
+                        "(SELECT max(rowid) FROM embedding) - ?",
+                        (self.max_disk,))
+                conn.commit()
+
+    def remember(self, key: tuple[str, str], vector: np.ndarray) -> None:
+        self.entries[key] = vector
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def load(self, model: str, keys: set[str]) -> dict[str, np.ndarray]:
+        conn = self.connect()
+        stored = {}
+        keys = list(keys)
+        # stay below SQLite's limit of host parameters per statement
+        for start in range(0, len(keys), 500):
+            batch = keys[start:start + 500]
+            rows = conn.execute(
+                f"SELECT key, vector FROM embedding WHERE model = ? "
+                f"AND key IN ({','.join('?' * len(batch))})",
+                [model, *batch])
+            for key, blob in rows:
+                stored[key] = np.frombuffer(blob, dtype="float32")
+        return stored
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {"hits": self.hits,
+                    "disk_hits": self.disk_hits,
+                    "misses": self.misses,
+                    "size": len(self.entries),
+                    "hit_rate": (self.hits + self.disk_hits) / lookups
+                                if lookups else 0.0}
+
+    def clear(self) -> None:
+        """empties the memory tier and resets the counters"""
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.disk_hits = self.misses = 0
+
+    def close(self) -> None:
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
@@ -0,0 +1,128 @@
+"""
+Packer class.
+
+packs text chunks to the input length of the embedding model: small
+chunks (lines, short paragraphs) are merged and chunks longer than the
+model reads are split, so no forward pass is spent on text the encoder
+truncates or on a single word.
+"""
+import re
+
+from config import MAX_SEQ_LENGTH, CHUNK_OVERLAP
+
+# rough token count when the model's tokenizer is not available
+WORD = re.compile(r"\w+|[^\w\s]")
+
+def approximate_count(text: str) -> int:
+    return len(WORD.findall(text))
+
+class Packer:
+
+    def __init__(self, count = approximate_count,
+                 max_tokens: int = MAX_SEQ_LENGTH,
+                 overlap: int = CHUNK_OVERLAP):
+        """
+        count: number of tokens of a text, without special tokens.
+        max_tokens: input length of the model, including the start and
+        end tokens added by the tokenizer.
+        overlap: number of units (lines, paragraphs) a packed chunk
+        repeats from the one before it.
+        """
+        self.count = count
+        self.budget = max(1, max_tokens - 2)
+        self.overlap = overlap
+
+    @classmethod
+    def for_model(cls, model, overlap: int = CHUNK_OVERLAP) -> "Packer":
+        """packer using the tokenizer and max_seq_length of a model"""
+        max_tokens = getattr(model, "max_seq_length", None)
+        if not isinstance(max_tokens, int) or max_tokens <= 2:
+            max_tokens = MAX_SEQ_LENGTH
+        tokenizer = getattr(model, "tokenizer", None)
+        # CLIP models hold a processor wrapping the tokenizer
+        tokenizer = getattr(tokenizer, "tokenizer", tokenizer)
+        count = approximate_count
+        try:
+            if isinstance(len(tokenizer.tokenize("a test")), int):
+                count = lambda text: len(tokenizer.tokenize(text))
+        except Exception:
+            pass
+        return cls(count, max_tokens, overlap)
+
+    def pack(self, chunks: list, spans: list) -> tuple[list, list, list[int]]:
+        """
+        packs the text chunks of a file (part). returns the packed chunks,
+        their spans and token counts. empty chunks are dropped, a span
+        covers all chunks packed into it (None if one of them has none).
+        other chunks (images) are passed on as they are.
+        """
+        if not all(isinstance(c, str) for c in chunks):
+            return chunks, spans, [0] * len(chunks)
+
+        packed, packed_spans, tokens = [], [], []
+        units = [] # current chunk as (text, span, tokens) units
+        carried = 0 # units repeated from the chunk before
+        for unit in self.units(chunks, spans):
+            if units and sum(u[2] for u in units) + unit[2] > self.budget:
+                if len(units) > carried:
+                    self.emit(units, packed, packed_spans, tokens)
+                    units = self.carry(units)
+                if sum(u[2] for u in units) + unit[2] > self.budget:
+                    units = []
+                carried = len(units)
+            units.append(unit)
+        if len(units) > carried:
+            self.emit(units, packed, packed_spans, tokens)
+        return packed, packed_spans, tokens
+
+    def units(self, chunks: list[str], spans: list):
+        # chunks split down to lines, then words, until they fit
+        for text, span in zip(chunks, spans):
+            for piece in self.split(text.strip(), ("\n", " ")):
+                yield piece, span, self.count(piece)
+
+    def split(self, text: str, separators: tuple):
+        if not text:
+            return
+        if not separators or self.count(text) <= self.budget:
+            yield text
+            return
+        separator, rest = separators[0], separators[1:]
+        pieces = [p.strip() for p in text.split(separator) if p.strip()]
+        if len(pieces) == 1:
+            yield from self.split(pieces[0], rest)
+            return
+        # words are packed back together here, lines are by pack()
+        if separator == " ":
+            current = []
+            for word in pieces:
+                if current and self.count(" ".join(current + [word])) > self.budget:
+                    yield " ".join(current)
+                    current = []
+                current.append(word)
+            yield " ".join(current)
+            return
+        for piece in pieces:
+            yield from self.split(piece, rest)
+
+    def carry(self, units: list) -> list:
+        # repeat the last units, never more than half of a chunk
+        carried, n = [], 0
+        for unit in reversed(units[-self.overlap:] if self.overlap else []):
+            if n + unit[2] > self.budget // 2:
+                break
+            carried.insert(0, unit)
+            n += unit[2]
+        return carried
+
+    def emit(self, units: list, packed: list, spans: list, tokens: list) -> None:
+        packed.append("\n".join(u[0] for u in units))
+        tokens.append(sum(u[2] for u in units))
+        unit_spans = [u[1] for u in units]
+        if any(s is None for s in unit_spans):
+            spans.append(None)
+        else:
+            spans.append((min(s[0] for s in unit_spans),
+                          max(s[1] for s in unit_spans),
+                          min(s[2] for s in unit_spans),
+                          max(s[3] for s in unit_spans)))
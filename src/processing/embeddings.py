@@ -3,45 +3,252 @@ Embeddings module for creating embeddings from files.
 
 Contains helper functions for reading, chunking and embedding data and queries.
 """
+import time
+import hashlib
 import numpy as np
-import os
 import docx
-from pathlib import Path
+from collections import deque
+from typing import TYPE_CHECKING
 from pypdf import PdfReader
-from PIL import Image
+from PIL import Image, ImageOps
 
-from sentence_transformers import SentenceTransformer
 from magic import from_file
 
-from config import EMBEDDING_MODEL, MODEL_PATH, CHUNK_SIZE
+from .cache import EmbeddingCache
+from .models import MODELS
+from infrastructure import metrics
 
-if not os.path.exists(MODEL_PATH):
-    path = Path(MODEL_PATH)
-    path.parent.mkdir(parents=True, exist_ok=True)
-    MODEL = SentenceTransformer(EMBEDDING_MODEL)
-    MODEL.save(MODEL_PATH)
-else:
-    MODEL = SentenceTransformer(MODEL_PATH)
+from config import (VECTOR_DIM, CHUNK_SIZE, CHUNK_OVERLAP, PART_SIZE,
+                    TEXT_BATCH_SIZE, IMAGE_BATCH_SIZE, IMAGE_SIZE,
+                    QUERY_CACHE_SIZE, QUERY_CACHE_PATH, QUERY_CACHE_DISK_SIZE,
+                    CHUNK_CACHE_SIZE, CHUNK_CACHE_PATH, CHUNK_CACHE_DISK_SIZE)
 
-def embed(path: str, 
-          model: SentenceTransformer = MODEL) -> tuple[int, np.ndarray]:
-    filetype = str(from_file(path))
+if TYPE_CHECKING:
+    from sentence_transformers import SentenceTransformer
 
-    chunks = []
-    if filetype.__contains__("Word"):
-        chunks = extract_docx(path)
-    elif filetype.__contains__("PDF"):
-        chunks = extract_pdf(path)
-    elif filetype.__contains__("ASCII"):
-        chunks = extract_txt_md(path)
-    elif filetype.__contains__("JPEG") or filetype.__contains__("PNG"):
-        img = Image.open(path).convert("RGB")
-        chunks = [img]
-    
-    embeddings = model.encode(chunks, convert_to_numpy=True, normalize_embeddings=True)
+def __getattr__(name: str):
+    # MODEL used to be loaded at import, keep it available (loads lazily)
+    if name == "MODEL":
+        return MODELS.get()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# query embeddings of models loaded through MODELS, see create_query_embeddings
+QUERY_CACHE = EmbeddingCache(QUERY_CACHE_SIZE, QUERY_CACHE_PATH,
+                             QUERY_CACHE_DISK_SIZE)
+
+# chunk embeddings of models loaded through MODELS, see encode_batch
+CHUNK_CACHE = EmbeddingCache(CHUNK_CACHE_SIZE, CHUNK_CACHE_PATH,
+                             CHUNK_CACHE_DISK_SIZE)
+
+# longer lines are read in pieces, so a file without line breaks
+# can not be pulled into memory at once
+LINE_LIMIT = 1 << 20
+
+def embed(path: str,
+          model: "SentenceTransformer | None" = None) -> tuple[int, np.ndarray]:
+    """model: None uses the default model of MODELS, see encode_batch"""
+    filetype, chunks = extract(path)
+
+    embeddings = encode_batch([chunks], model)[0]
 
     return filetype, embeddings
 
+def embed_batch(paths: list[str],
+                model: "SentenceTransformer | None" = None) -> list[tuple[str, np.ndarray]]:
+    """
+    embeds many files at once: chunks of all files are encoded together
+    so small files do not each cost a forward pass of their own.
+    """
+    extracted = [extract(p) for p in paths]
+    embeddings = encode_batch([chunks for _, chunks in extracted], model)
+    return [(filetype, e) for (filetype, _), e in zip(extracted, embeddings)]
+
+def encode_batch(documents: list[list],
+                 model: "SentenceTransformer | str | None" = None,
+                 cache: EmbeddingCache | None = CHUNK_CACHE) -> list[np.ndarray]:
+    """
+    encodes the chunks of several documents in shared batches and
+    scatters the embeddings back, one (n_chunks, d) array per document.
+    text chunks and images are encoded in separate calls.
+    model: a model, the name of a model managed by MODELS or None for
+    the default one. embeddings of named models are looked up in cache
+    (None disables it) by the hash of each chunk's content, only chunks
+    not seen before are encoded, duplicates once.
+    """
+    if not documents:
+        return []
+
+    offsets = np.cumsum([0] + [len(chunks) for chunks in documents])
+    texts, text_pos = [], []
+    images, image_pos = [], []
+    for i, chunks in enumerate(documents):
+        for j, chunk in enumerate(chunks):
+            if isinstance(chunk, str):
+                texts.append(chunk)
+                text_pos.append(offsets[i] + j)
+            else:
+                images.append(chunk)
+                image_pos.append(offsets[i] + j)
+
+    name = None
+    if isinstance(model, (str, type(None))):
+        name = model or MODELS.default
+        model = None # loaded when there are misses to encode
+    flat = None
+    for inputs, pos, batch_size in ((texts, text_pos, TEXT_BATCH_SIZE),
+                                    (images, image_pos, IMAGE_BATCH_SIZE)):
+        if not inputs:
+            continue
+        kind = "text" if inputs is texts else "image"
+        metrics.count(f"encode.{kind}.inputs", len(inputs))
+        if name is not None and cache is not None:
+            vectors = encode_cached(inputs, name, cache, batch_size, kind)
+        else:
+            if model is None:
+                model = MODELS.get(name)
+            with metrics.span(f"encode.{kind}"):
+                vectors = model.encode(inputs, batch_size=batch_size,
+                                       convert_to_numpy=True,
+                                       normalize_embeddings=True)
+        if flat is None:
+            flat = np.empty((offsets[-1], vectors.shape[1]), dtype="float32")
+        flat[pos] = vectors
+
+    if flat is None:
+        flat = np.empty((0, VECTOR_DIM), dtype="float32")
+    return np.split(flat, offsets[1:-1])
+
+def encode_cached(inputs: list, name: str, cache: EmbeddingCache,
+                  batch_size: int, kind: str) -> np.ndarray:
+    # encodes the chunks missing from cache, each distinct content once
+    keys = [content_key(c) for c in inputs]
+    found = cache.get_many(name, keys)
+    missing = {}
+    for chunk, key, vector in zip(inputs, keys, found):
+        if vector is None:
+            missing.setdefault(key, chunk)
+    metrics.count(f"encode.{kind}.cache_hits",
+                  sum(v is not None for v in found))
+    if missing:
+        with metrics.span(f"encode.{kind}"):
+            vectors = MODELS.get(name).encode(
+                list(missing.values()), batch_size=batch_size,
+                convert_to_numpy=True, normalize_embeddings=True)
+        cache.put_many(name, list(missing), vectors)
+        encoded = dict(zip(missing, vectors))
+        found = [encoded[k] if v is None else v for k, v in zip(keys, found)]
+    return np.vstack(found).astype("float32")
+
+def content_key(chunk: "str | Image.Image") -> str:
+    """sha256 of a text chunk or of the pixels of a decoded image"""
+    if isinstance(chunk, str):
+        return "text:" + hashlib.sha256(chunk.encode("utf-8")).hexdigest()
+    digest = hashlib.sha256(f"{chunk.mode}{chunk.size}".encode())
+    digest.update(chunk.tobytes())
+    return "image:" + digest.hexdigest()
+
+def extract(path: str) -> tuple[str, list]:
+    """
+    detects the type of a file and reads it into chunks
+    (strings for documents, a PIL image for pictures).
+    """
+    filetype = detect(path)
+    chunks = []
+    for _, part, _ in extract_parts(path, filetype):
+        chunks.extend(part)
+
+    return filetype, chunks
+
+def extract_parts(path: str, filetype: str | None = None,
+                  part_size: int = PART_SIZE, lines: int = CHUNK_SIZE,
+                  overlap: int = CHUNK_OVERLAP):
+    """
+    yields a file as (filetype, chunks, spans) parts, at least one.
+    text files are streamed in parts of at most part_size chunks of
+    lines lines, other types are read as one part. spans holds (byte
+    start, byte end, first line, last line) per text chunk and None for
+    other chunks. empty and whitespace-only chunks are skipped.
+    """
+    filetype = filetype or detect(path)
+    if not is_text(filetype):
+        chunks = []
+        kind = "other"
+        if filetype.__contains__("Word"):
+            kind = "docx"
+            with metrics.span("extract.docx"):
+                chunks = extract_docx(path)
+        elif filetype.__contains__("PDF"):
+            kind = "pdf"
+            with metrics.span("extract.pdf"):
+                chunks = extract_pdf(path)
+        elif is_image(filetype):
+            kind = "image"
+            with metrics.span("extract.image"):
+                chunks = [load_image(path)]
+        chunks = [c for c in chunks if not isinstance(c, str) or c.strip()]
+        metrics.count(f"extract.{kind}.files")
+        metrics.count(f"extract.{kind}.chunks", len(chunks))
+        yield filetype, chunks, [None] * len(chunks)
+        return
+
+    metrics.count("extract.text.files")
+    chunks, spans = [], []
+    first = True # no part yielded yet
+    # time spent reading parts, not consuming them
+    start = time.perf_counter()
+    for text, span in text_chunks(path, lines, overlap):
+        if not text:
+            continue
+        chunks.append(text)
+        spans.append(span)
+        if len(chunks) == part_size:
+            metrics.observe("extract.text", time.perf_counter() - start)
+            metrics.count("extract.text.chunks", len(chunks))
+            yield filetype, chunks, spans
+            chunks, spans = [], []
+            first = False
+            start = time.perf_counter()
+    if chunks or first:
+        metrics.observe("extract.text", time.perf_counter() - start)
+        metrics.count("extract.text.chunks", len(chunks))
+        yield filetype, chunks, spans
+
+def extract_all(path: str, filetype: str | None = None,
+                part_size: int = PART_SIZE, lines: int = CHUNK_SIZE,
+                overlap: int = CHUNK_OVERLAP) -> list[tuple]:
+    """all parts of a file, see extract_parts"""
+    return list(extract_parts(path, filetype, part_size, lines, overlap))
+
+def detect(path: str) -> str:
+    with metrics.span("detect"):
+        return str(from_file(path))
+
+def is_text(filetype: str) -> bool:
+    return filetype.__contains__("ASCII")
+
+def is_image(filetype: str) -> bool:
+    return filetype.__contains__("JPEG") or filetype.__contains__("PNG")
+
+def load_image(path: str, size: int = IMAGE_SIZE) -> Image.Image:
+    """
+    decodes an image upright (EXIF orientation applied) with its shorter
+    side scaled down to size. JPEGs are decoded at reduced resolution
+    right away, the model never sees more than size pixels anyway.
+    """
+    with Image.open(path) as img:
+        w, h = img.size
+        scale = min(w, h) / size
+        if scale > 1 and img.format == "JPEG":
+            # picks the smallest DCT scale still at least this large
+            img.draft("RGB", (int(w / scale), int(h / scale)))
+        img = ImageOps.exif_transpose(img).convert("RGB")
+    w, h = img.size
+    scale = min(w, h) / size
+    if scale > 1:
+        img = img.resize((max(size, round(w / scale)), max(size, round(h / scale))),
+                         Image.Resampling.BICUBIC, reducing_gap=2.0)
+    return img
+
 def extract_docx(path: str) -> list[str]:
     doc = docx.Document(path)
     text = [p.text for p in doc.paragraphs]
@@ -54,21 +261,75 @@ def extract_pdf(path: str) -> list[str]:
     return pages
         
 def extract_txt_md(path: str) -> list[str]:
-    with open(path, 'r') as f:
-        lines = f.readlines()
-        size = len(lines)
-        paragraphs = []
-        i = 0 
-        while i < size:
-            if i + CHUNK_SIZE > size:
-               paragraphs.append(str(lines[i:]))
-            else:
-                paragraphs.append(str(lines[i:i+CHUNK_SIZE]))
-            i += CHUNK_SIZE
-    return paragraphs
+    return [text for text, _ in text_chunks(path)]
+
+def text_chunks(path: str, chunk_size: int = CHUNK_SIZE,
+                overlap: int = CHUNK_OVERLAP):
+    """
+    streams a text file as chunks of chunk_size lines, consecutive chunks
+    share overlap lines. yields (text, (byte start, byte end, first line,
+    last line)), lines count from 1 and the byte range excludes its end.
+    only one chunk is held in memory, whatever the size of the file
+    (lines longer than LINE_LIMIT bytes count as several lines).
+    """
+    if not 0 <= overlap < chunk_size:
+        raise ValueError("overlap must be smaller than chunk_size")
+
+    window = deque() # (bytes, byte offset, line number) of buffered lines
+    offset = 0
+    line = 1
+    fresh = 0 # lines not yet part of a yielded chunk
+    with open(path, "rb") as f:
+        for piece in iter(lambda: f.readline(LINE_LIMIT), b""):
+            window.append((piece, offset, line))
+            offset += len(piece)
+            if piece.endswith(b"\n"):
+                line += 1
+            fresh += 1
+            if len(window) == chunk_size:
+                yield text_chunk(window, offset)
+                fresh = 0
+                while len(window) > overlap:
+                    window.popleft()
+    if fresh:
+        yield text_chunk(window, offset)
+
+def text_chunk(window: deque, end: int) -> tuple[str, tuple]:
+    text = b"".join(piece for piece, _, _ in window)
+    span = (window[0][1], end, window[0][2], window[-1][2])
+    return text.decode("utf-8", errors="replace").strip(), span
+
+def create_query_embeddings(queries: list[str],
+                            model: "SentenceTransformer | str | None" = None,
+                            cache: EmbeddingCache | None = QUERY_CACHE) -> np.ndarray:
+    """
+    model: a model, the name of a model managed by MODELS or None for
+    the default one. embeddings of named models are looked up in cache
+    (None disables it), keyed on the model name and the query text with
+    whitespace normalized. only the misses are encoded, in one call.
+    """
+    if not isinstance(model, (str, type(None))):
+        return encode_queries(queries, model)
+
+    name = model or MODELS.default
+    keys = [" ".join(q.split()) for q in queries]
+    if cache is None:
+        return encode_queries(keys, MODELS.get(name))
+
+    found = cache.get_many(name, keys)
+    missing = list(dict.fromkeys(k for k, v in zip(keys, found) if v is None))
+    if missing:
+        vectors = encode_queries(missing, MODELS.get(name))
+        cache.put_many(name, missing, vectors)
+        encoded = dict(zip(missing, vectors))
+        found = [encoded[k] if v is None else v for k, v in zip(keys, found)]
+    return np.vstack(found).astype("float32")
 
-def create_query_embeddings(queries: list[str], 
-                            model:SentenceTransformer = MODEL) -> np.ndarray:
-    vectors = model.encode(queries, convert_to_numpy=True, normalize_embeddings=True)
+def encode_queries(queries: list[str],
+                   model: "SentenceTransformer") -> np.ndarray:
+    metrics.count("encode.query.inputs", len(queries))
+    with metrics.span("encode.query"):
+        vectors = model.encode(queries, convert_to_numpy=True,
+                               normalize_embeddings=True)
     vector_matrix = np.vstack(vectors).astype("float32")
     return vector_matrix
\ No newline at end of file
@@ -0,0 +1,101 @@
+"""
+Model manager.
+
+loads embedding models on first use instead of at import time, so code
+that never embeds (path lookups, admin scripts, tests) starts quickly.
+models are cached by name and can be warmed up or unloaded explicitly.
+"""
+import time
+import threading
+from pathlib import Path
+
+from config import EMBEDDING_MODEL, MODEL_DIR, MODEL_IDLE_TIMEOUT
+
+def model_path(name: str) -> str:
+    return f"{MODEL_DIR}/{name}"
+
+def load_model(name: str):
+    """
+    loads a model from the local model directory, downloading and
+    saving it there first if it is missing.
+    """
+    # sentence_transformers pulls in torch, only import it when needed
+    from sentence_transformers import SentenceTransformer
+
+    path = Path(model_path(name))
+    if path.exists():
+        return SentenceTransformer(str(path))
+    path.parent.mkdir(parents=True, exist_ok=True)
+    model = SentenceTransformer(name)
+    model.save(str(path))
+    return model
+
+class ModelManager:
+
+    def __init__(self, default: str = EMBEDDING_MODEL,
+                 idle_timeout: float = MODEL_IDLE_TIMEOUT, loader = load_model):
+        """
+        default: model returned by get() when no name is given.
+        idle_timeout: seconds since last use after which unload_idle()
+        drops a model.
+        loader: function loading a model by name.
+        """
+        self.default = default
+        self.idle_timeout = idle_timeout
+        self.loader = loader
+        self.models = {}
+        self.last_used = {}
+        self.lock = threading.Lock() # guards the caches, not loading
+        self.loading = {} # name -> lock, so a model is only loaded once
+
+    def get(self, name: str | None = None):
+        """returns a model, loading it on first use"""
+        name = name or self.default
+        with self.lock:
+            if name in self.models:
+                self.last_used[name] = time.monotonic()
+                return self.models[name]
+            loading = self.loading.setdefault(name, threading.Lock())
+
+        # other models stay available while this one loads
+        with loading:
+            with self.lock:
+                if name in self.models:
+                    self.last_used[name] = time.monotonic()
+                    return self.models[name]
+            model = self.loader(name)
+            with self.lock:
+                self.models[name] = model
+                self.last_used[name] = time.monotonic()
+            return model
+
+    def warmup(self, *names: str) -> None:
+        """loads models ahead of their first use (default model if none given)"""
+        for name in names or (self.default,):
+            self.get(name)
+
+    def unload(self, name: str | None = None) -> bool:
+        """drops a model, returns whether it was loaded"""
+        name = name or self.default
+        with self.lock:
+            self.last_used.pop(name, None)
+            return self.models.pop(name, None) is not None
+
+    def unload_idle(self, idle_timeout: float | None = None) -> list[str]:
+        """drops models unused for idle_timeout seconds, returns their names"""
+        idle_timeout = self.idle_timeout if idle_timeout is None else idle_timeout
+        now = time.monotonic()
+        with self.lock:
+            idle = [name for name, used in self.last_used.items()
+                    if now - used >= idle_timeout]
+            for name in idle:
+                del self.models[name]
+                del self.last_used[name]
+        return idle
+
+    def loaded(self) -> list[str]:
+        with self.lock:
+            return list(self.models)
+
+# shared by the embedding functions when no model is passed
+MODELS = ModelManager()
@@ -0,0 +1,219 @@
+"""
+Ingestion pipeline.
+
+runs volume ingestion as three stages connected by bounded queues:
+file parsing in a pool of worker processes and image decoding in a pool
+of threads (PIL releases the GIL, no pickling of pixels), a single embedding
+stage and a writer stage that inserts into SQLite and the vector index.
+files travel as parts of at most PART_SIZE chunks, text files are
+streamed part by part, so memory use does not grow with file size.
+"""
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from sqlite3 import Cursor
+
+import processing.embeddings as em
+from processing.chunking import Packer
+from processing.models import MODELS
+from infrastructure import metrics
+from infrastructure.threads import set_threads
+
+from config import (FILE_BATCH_SIZE, EXTRACT_WORKERS, QUEUE_DEPTH,
+                    INGEST_THREADS, PART_SIZE, PACK_CHUNKS, CHUNK_SIZE,
+                    CHUNK_OVERLAP, DECODE_THREADS)
+
+DONE = object() # end-of-stream marker passed down the queues
+
+class Pipeline:
+
+    def __init__(self, database, embedding_model = None,
+                 workers: int = EXTRACT_WORKERS,
+                 queue_depth: int = QUEUE_DEPTH,
+                 batch_size: int = FILE_BATCH_SIZE,
+                 threads: int | None = INGEST_THREADS,
+                 part_size: int = PART_SIZE,
+                 pack: bool = PACK_CHUNKS,
+                 decode_threads: int = DECODE_THREADS):
+        """
+        workers: number of parsing processes, 0 parses in a thread instead.
+        queue_depth: max. number of parsed files (parts) in flight or
+        waiting for the embedding stage.
+        batch_size: number of files encoded together.
+        threads: cores used for encoding and index adds, None: all.
+        part_size: max. number of chunks of a file passed on together.
+        pack: pack text chunks to the model's input length (see Packer),
+        text files are then read line by line.
+        decode_threads: number of threads decoding images.
+        """
+        self.database = database
+        self.model = embedding_model # None: default model, loaded on first batch
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self.batch_size = batch_size
+        self.threads = threads
+        self.part_size = part_size
+        self.packer = None # created with the model, see encode
+        self.pack = pack
+        self.decode_threads = decode_threads
+        # line chunks are packed, overlap is applied by the packer then
+        self.lines, self.overlap = (1, 0) if pack else (CHUNK_SIZE, CHUNK_OVERLAP)
+        self.stop = threading.Event()
+        self.error = None
+
+    def run(self, entries, cursor: Cursor) -> None:
+        """
+        ingests (file name, path) entries. the writer runs in the
+        calling thread, so the cursor's connection is never shared.
+        """
+        extracted = queue.Queue(maxsize=self.queue_depth)
+        # the writer only ever needs the next batch, keep this short
+        embedded = queue.Queue(maxsize=2)
+
+        stages = [threading.Thread(target=self.guard,
+                                   args=(self.extract_stage, entries, extracted)),
+                  threading.Thread(target=self.guard,
+                                   args=(self.embed_stage, extracted, embedded))]
+        for stage in stages:
+            stage.start()
+        try:
+            self.write_stage(embedded, cursor)
+        except BaseException as e:
+            self.fail(e)
+        finally:
+            for stage in stages:
+                stage.join()
+
+        if self.error is not None:
+            raise self.error
+
+    def extract_stage(self, entries, out: queue.Queue) -> None:
+        if self.workers == 0:
+            for name, path in entries:
+                if self.stop.is_set():
+                    return
+                self.put_parts(out, name, path, em.extract_parts(
+                    path, None, self.part_size, self.lines, self.overlap))
+            return
+
+        with (ProcessPoolExecutor(self.workers) as pool,
+              ThreadPoolExecutor(self.decode_threads) as decoders):
+            pending = deque()
+            try:
+                for name, path in entries:
+                    if self.stop.is_set():
+                        return
+                    filetype = em.detect(path)
+                    if em.is_text(filetype):
+                        # cheap to parse, streamed here instead of being
+                        # read whole by a worker. in order after the
+                        # files submitted before it
+                        while pending:
+                            self.put_result(out, pending.popleft())
+                        self.put_parts(out, name, path, em.extract_parts(
+                            path, filetype, self.part_size, self.lines,
+                            self.overlap))
+                        continue
+                    args = (em.extract_all, path, filetype, self.part_size,
+                            self.lines, self.overlap)
+                    if em.is_image(filetype):
+                        future = decoders.submit(*args)
+                    else:
+                        # what a worker records is sent back with its result
+                        future = pool.submit(metrics.collect,
+                                             metrics.RECORDER.enabled, *args)
+                    pending.append((name, path, future))
+                    if len(pending) >= self.queue_depth:
+                        self.put_result(out, pending.popleft())
+                while pending:
+                    self.put_result(out, pending.popleft())
+            finally:
+                if self.stop.is_set():
+                    pool.shutdown(cancel_futures=True)
+                    decoders.shutdown(cancel_futures=True)
+
+    def put_result(self, out: queue.Queue, job: tuple) -> None:
+        name, path, future = job
+        parts = future.result()
+        if isinstance(parts, tuple): # from a worker, see metrics.collect
+            parts, recorded = parts
+            if recorded is not None:
+                metrics.RECORDER.merge(recorded)
+        self.put_parts(out, name, path, parts)
+
+    def put_parts(self, out: queue.Queue, name: str, path: str, parts) -> None:
+        # parts after the first continue the file, see DataBase.add_batch
+        for i, (filetype, chunks, spans) in enumerate(parts):
+            if self.stop.is_set():
+                return
+            self.put(out, (name, path, filetype, chunks, spans, i > 0))
+
+    def embed_stage(self, inp: queue.Queue, out: queue.Queue) -> None:
+        batch = []
+        while (item := self.get(inp)) is not DONE:
+            batch.append(item)
+            if len(batch) == self.batch_size:
+                self.put(out, self.encode(batch))
+                batch = []
+        if batch:
+            self.put(out, self.encode(batch))
+
+    def encode(self, batch: list[tuple]) -> tuple[list, ...]:
+        # per batch, torch is only loaded with the first one
+        set_threads(self.threads)
+        files = [(name, file_type, path) for name, path, file_type, *_ in batch]
+        documents = [item[3] for item in batch]
+        spans = [item[4] for item in batch]
+        tokens = None
+        if self.pack:
+            if self.packer is None:
+                model = self.model
+                if model is None or isinstance(model, str):
+                    model = MODELS.get(model)
+                self.packer = Packer.for_model(model)
+            packed = [self.packer.pack(d, s) for d, s in zip(documents, spans)]
+            documents = [d for d, _, _ in packed]
+            spans = [s for _, s, _ in packed]
+            tokens = [sum(t) for _, _, t in packed]
+        embeds = em.encode_batch(documents, self.model)
+        continued = [item[5] for item in batch]
+        return files, embeds, spans, continued, tokens, documents
+
+    def write_stage(self, inp: queue.Queue, cursor: Cursor) -> None:
+        set_threads(self.threads)
+        while (item := self.get(inp)) is not DONE:
+            files, embeds, spans, continued, tokens, texts = item
+            self.database.add_batch(files, embeds, cursor, spans, continued,
+                                    tokens, texts)
+
+    def guard(self, stage, inp, out: queue.Queue) -> None:
+        # runs a stage in its thread, always signalling the next stage
+        try:
+            stage(inp, out)
+        except BaseException as e:
+            self.fail(e)
+        finally:
+            self.put(out, DONE)
+
+    def fail(self, error: BaseException) -> None:
+        if self.error is None:
+            self.error = error
+        self.stop.set()
+
+    def put(self, q: queue.Queue, item) -> None:
+        # blocks while the queue is full, gives up once the pipeline stops
+        while not self.stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def get(self, q: queue.Queue):
+        while not self.stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return DONE
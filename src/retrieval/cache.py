@@ -0,0 +1,51 @@
+"""
+ResultCache class.
+
+bounded LRU cache of search results. every entry is tagged with the
+generation of the vector index it was computed from (see Index.generation),
+entries of older generations are never returned.
+"""
+import threading
+from collections import OrderedDict
+
+class ResultCache:
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.entries = OrderedDict() # key -> (generation, result)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple, generation: int):
+        """cached result of key, None if missing or stale"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != generation:
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: tuple, generation: int, result) -> None:
+        with self.lock:
+            self.entries[key] = (generation, result)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "size": len(self.entries),
+                    "hit_rate": self.hits / lookups if lookups else 0.0}
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.misses = 0
@@ -0,0 +1,100 @@
+"""
+SearchEngine class.
+
+asyncio front end of search(). queries arriving within a short window are
+merged into one batch, so they share one model.encode and one index search,
+and the results are handed back to the waiting callers. the model, FAISS
+and SQLite calls run in an executor, the event loop is never blocked.
+"""
+import asyncio
+from concurrent.futures import Executor, ThreadPoolExecutor
+
+from infrastructure.database import DataBase
+from . import search as s
+
+from config import BATCH_MAX_SIZE, BATCH_MAX_WAIT, SEARCH_WORKERS
+
+class SearchEngine:
+
+    def __init__(self, database: DataBase,
+                 max_batch: int = BATCH_MAX_SIZE,
+                 max_wait: float = BATCH_MAX_WAIT,
+                 executor: Executor | None = None,
+                 **search_args):
+        """
+        max_batch: max. number of queries searched together, a full
+        batch is started right away.
+        max_wait: seconds the first query of a batch waits for others.
+        executor: runs the batches, defaults to SEARCH_WORKERS threads.
+        search_args: passed on to search(), e.g. nprobe or cache.
+        """
+        self.database = database
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.own_executor = executor is None
+        self.executor = executor or ThreadPoolExecutor(SEARCH_WORKERS)
+        self.search_args = search_args
+        # queries waiting for their batch, per (k, include_scores),
+        # only searches with the same arguments can share a batch
+        self.pending = {}
+        self.timers = {}
+        self.running = set()
+
+    async def search(self, query: str, k: int = 5,
+                     include_scores: bool = False) -> list:
+        """results of a single query, see retrieval.search.search"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        key = (k, include_scores)
+        batch = self.pending.setdefault(key, [])
+        batch.append((query, future))
+        if len(batch) >= self.max_batch:
+            self.dispatch(key)
+        elif len(batch) == 1:
+            self.timers[key] = loop.call_later(self.max_wait,
+                                               self.dispatch, key)
+        return await future
+
+    def dispatch(self, key: tuple) -> None:
+        timer = self.timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self.pending.pop(key, None)
+        if batch:
+            task = asyncio.ensure_future(self.run(batch, *key))
+            # keep a reference, the loop only holds tasks weakly
+            self.running.add(task)
+            task.add_done_callback(self.running.discard)
+
+    async def run(self, batch: list[tuple], k: int,
+                  include_scores: bool) -> None:
+        loop = asyncio.get_running_loop()
+        queries = [query for query, _ in batch]
+        try:
+            results = await loop.run_in_executor(
+                self.executor, lambda: s.search(self.database, queries, k=k,
+                                                include_scores=include_scores,
+                                                **self.search_args))
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done(): # the caller may have been cancelled
+                future.set_result(result)
+
+    async def close(self) -> None:
+        """searches what is still waiting and releases the executor"""
+        for key in list(self.pending):
+            self.dispatch(key)
+        if self.running:
+            await asyncio.gather(*self.running, return_exceptions=True)
+        if self.own_executor:
+            self.executor.shutdown()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
@@ -3,14 +3,68 @@ Search Engine
 
 receives a query / List of queries and returns files that semantically match the query
 """
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from infrastructure import metrics
 from infrastructure.database import DataBase
+from infrastructure.vectorindex import id_selector
+from infrastructure.threads import set_threads
 from processing.embeddings import create_query_embeddings
+from .cache import ResultCache
 
 from sqlite3 import Connection
 
+from config import (RESULT_CACHE_SIZE, QUERY_THREADS, SEARCH_WORKERS,
+                    RRF_K, RRF_DEPTH, PREFILTER_LIMIT)
+
+# results of repeated searches, invalidated by any change of the index
+RESULT_CACHE = ResultCache(RESULT_CACHE_SIZE)
+
+# runs the keyword side of hybrid searches next to the vector side
+KEYWORD_SEARCHES = ThreadPoolExecutor(SEARCH_WORKERS)
+
+MODES = ("vector", "hybrid", "prefilter")
+
 def search(database: DataBase,
            query: str | list[str],
-           conn: Connection) -> list[str]:
+           conn: Connection | None = None,
+           k: int = 5,
+           nprobe: int | None = None,
+           ef_search: int | None = None,
+           rerank: int | None = None,
+           cache: ResultCache | None = RESULT_CACHE,
+           include_scores: bool = False,
+           threads: int | None = QUERY_THREADS,
+           file_type: str | list[str] | None = None,
+           path_prefix: str | None = None,
+           modified_after: float | None = None,
+           modified_before: float | None = None,
+           mode: str = "vector") -> list[list]:
+    """
+    conn: connection to resolve results with, None uses a pooled one.
+    k: number of chunks retrieved per query.
+    nprobe / ef_search / rerank: recall/speed knobs of IVF, HNSW and
+    compressed indexes, see Index.search.
+    cache: results are looked up per query and only the misses are
+    searched, None disables caching.
+    returns the matching file paths per query, ranked by their best chunk.
+    include_scores: return (path, score, [(chunk id, score), ...]) per
+    file instead, see DataBase.resolve.
+    threads: cores used to encode and search the queries, None: all.
+    file_type / path_prefix / modified_after / modified_before: only
+    search chunks of matching files, see DataBase.filter_ids. the
+    filter is applied inside the index search, k results are returned
+    if k matching chunks exist.
+    mode: "vector" searches the embeddings only. "hybrid" also runs a
+    keyword search (DataBase.match, needs full_text) concurrently and
+    fuses both rankings with reciprocal rank fusion, scores are then
+    fused scores. "prefilter" restricts the vector search to the
+    chunks matching a query's keywords, queries without matches are
+    searched unrestricted.
+    """
+    if mode not in MODES:
+        raise ValueError(f"mode must be one of {MODES}")
 
     if isinstance(query, str):
         queries = [query]
@@ -18,13 +72,94 @@ def search(database: DataBase,
         queries = query
     else:
         raise TypeError("queries must be of type str or list[str]")
-    
+
+    vectorindex = database.vectorindex
+    # read before searching: results of a search that overlaps a change
+    # are stored under the old generation and never served
+    generation = vectorindex.generation
+    filters = (tuple(file_type) if isinstance(file_type, list) else file_type,
+               path_prefix, modified_after, modified_before)
+    keys = [(database.db, vectorindex.path, " ".join(q.split()),
+             k, nprobe, ef_search, rerank, filters, mode) for q in queries]
+    files = [None] * len(queries)
+    if cache is not None:
+        files = [cache.get(key, generation) for key in keys]
+    missing = [x for x, f in enumerate(files) if f is None]
+    metrics.count("search.queries", len(queries))
+    metrics.count("search.cache_hits", len(queries) - len(missing))
+    if missing:
+        set_threads(threads)
+        batch = [queries[x] for x in missing]
+        allowed_ids = None
+        if any(f is not None for f in filters):
+            allowed_ids = database.filter_ids(*filters, conn=conn)
+        search_args = {"nprobe": nprobe, "ef_search": ef_search,
+                       "rerank": rerank}
+        if mode == "hybrid":
+            results = hybrid_search(database, batch, k, allowed_ids, search_args)
+        elif mode == "prefilter":
+            results = prefiltered_search(database, batch, k, allowed_ids,
+                                         search_args)
+        else:
+            results = vector_search(database, batch, k, allowed_ids, search_args)
+
+        for x, resolved in zip(missing, database.resolve(results, conn)):
+            files[x] = resolved
+            if cache is not None:
+                cache.put(keys[x], generation, resolved)
+
+    if include_scores:
+        return [list(f) for f in files]
+    return [[path for path, _, _ in f] for f in files]
+
+def vector_search(database: DataBase, queries: list[str], k: int,
+                  allowed_ids: np.ndarray | None,
+                  search_args: dict) -> list[list[tuple]]:
     query_embeddings = create_query_embeddings(queries)
+    allowed = None if allowed_ids is None else id_selector(allowed_ids)
+    return database.vectorindex.search(query_embeddings, k, allowed=allowed,
+                                       **search_args)
 
-    results = database.vectorindex.search(query_embeddings, 5)
+def keyword_search(database: DataBase, queries: list[str], limit: int,
+                   allowed_ids: np.ndarray | None) -> list[list[tuple]]:
+    # on a pooled connection, may run in another thread than the caller
+    results = database.match(queries, limit)
+    if allowed_ids is None:
+        return results
+    filtered = []
+    for r in results:
+        keep = np.isin([i for i, _ in r], allowed_ids)
+        filtered.append([match for match, kept in zip(r, keep) if kept])
+    return filtered
 
-    chunk_ids = [[i for i, _ in r] for r in results]
+def hybrid_search(database: DataBase, queries: list[str], k: int,
+                  allowed_ids: np.ndarray | None,
+                  search_args: dict) -> list[list[tuple]]:
+    depth = max(k, RRF_DEPTH)
+    keywords = KEYWORD_SEARCHES.submit(keyword_search, database, queries,
+                                       depth, allowed_ids)
+    vectors = vector_search(database, queries, depth, allowed_ids, search_args)
+    return [fuse([v, kw], k) for v, kw in zip(vectors, keywords.result())]
+
+def prefiltered_search(database: DataBase, queries: list[str], k: int,
+                       allowed_ids: np.ndarray | None,
+                       search_args: dict) -> list[list[tuple]]:
+    matches = keyword_search(database, queries, PREFILTER_LIMIT, allowed_ids)
+    query_embeddings = create_query_embeddings(queries)
+    results = []
+    for embedding, match in zip(query_embeddings, matches):
+        ids = allowed_ids
+        if match:
+            ids = np.unique([i for i, _ in match])
+        allowed = None if ids is None else id_selector(ids)
+        results.extend(database.vectorindex.search(embedding, k, allowed=allowed,
+                                                   **search_args))
+    return results
 
-    files = [database.get_all_files(per_query_ids, conn)
-             for per_query_ids in chunk_ids]
-    return files
\ No newline at end of file
+def fuse(rankings: list[list[tuple]], k: int) -> list[tuple[int, float]]:
+    """reciprocal rank fusion of (id, score) rankings, top k (id, fused score)"""
+    scores = {}
+    for ranking in rankings:
+        for rank, (i, _) in enumerate(ranking):
+            scores[i] = scores.get(i, 0.0) + 1.0 / (RRF_K + rank + 1)
+    return sorted(scores.items(), key=lambda s: -s[1])[:k]
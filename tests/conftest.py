@@ -0,0 +1,24 @@
+import pytest
+import numpy as np
+
+from unittest.mock import Mock
+
+from processing import embeddings
+from config import VECTOR_DIM
+
+@pytest.fixture(autouse=True)
+def memory_embedding_caches(monkeypatch):
+    # tests never write a configured disk tier, tests of it use tmp_path
+    monkeypatch.setattr(embeddings.QUERY_CACHE, "path", None)
+    monkeypatch.setattr(embeddings.CHUNK_CACHE, "path", None)
+
+@pytest.fixture
+def fake_model():
+    fake_model = Mock()
+
+    def fake_encode(inputs, convert_to_numpy=True, normalize_embeddings=True,
+                    **kwargs):
+        return np.ones((len(inputs), VECTOR_DIM), dtype="float32")
+
+    fake_model.encode.side_effect = fake_encode
+    return fake_model
@@ -0,0 +1,57 @@
+import pytest
+import numpy as np
+
+from processing.cache import EmbeddingCache
+
+@pytest.fixture
+def vectors():
+    return np.arange(6, dtype="float32").reshape(3, 2)
+
+def test_lru_evicts_least_recently_used(vectors):
+    cache = EmbeddingCache(max_size=2)
+    cache.put_many("m", ["a", "b"], vectors[:2])
+    cache.get_many("m", ["a"])
+    cache.put_many("m", ["c"], vectors[2:])
+
+    found = cache.get_many("m", ["a", "b", "c"])
+
+    assert np.array_equal(found[0], vectors[0])
+    assert found[1] is None
+    assert np.array_equal(found[2], vectors[2])
+
+def test_keys_are_per_model(vectors):
+    cache = EmbeddingCache(max_size=10)
+    cache.put_many("m", ["a"], vectors[:1])
+
+    assert cache.get_many("other", ["a"]) == [None]
+
+def test_disk_tier_survives_restart(tmp_path, vectors):
+    path = str(tmp_path / "cache.db")
+    cache = EmbeddingCache(max_size=10, path=path)
+    cache.put_many("m", ["a", "b"], vectors[:2])
+    cache.close()
+
+    reopened = EmbeddingCache(max_size=10, path=path)
+    found = reopened.get_many("m", ["a", "b", "c"])
+
+    assert np.array_equal(found[1], vectors[1])
+    assert found[2] is None
+    assert reopened.stats() == {"hits": 0, "disk_hits": 2, "misses": 1,
+                                "size": 2, "hit_rate": 2 / 3}
+    reopened.close()
+
+def test_disk_tier_keeps_newest_embeddings(tmp_path, vectors):
+    cache = EmbeddingCache(max_size=10, path=str(tmp_path / "cache.db"),
+                           max_disk=2)
+    cache.put_many("m", ["a", "b"], vectors[:2])
+    cache.put_many("m", ["a"], vectors[:1]) # stored again, now the newest
+    cache.put_many("m", ["c"], vectors[2:])
+    cache.clear()
+
+    found = cache.get_many("m", ["a", "b", "c"])
+
+    assert np.array_equal(found[0], vectors[0])
+    assert found[1] is None
+    assert np.array_equal(found[2], vectors[2])
+    assert cache.conn.execute("SELECT count(*) FROM embedding").fetchone() == (2,)
+    cache.close()
@@ -0,0 +1,60 @@
+import pytest
+
+from unittest.mock import Mock
+
+from processing.chunking import Packer, approximate_count
+
+@pytest.fixture
+def packer():
+    return Packer(max_tokens=8, overlap=0) # 6 tokens per chunk
+
+def test_small_chunks_are_merged(packer):
+    spans = [(0, 4, 1, 1), (4, 10, 2, 2), (10, 14, 3, 3)]
+
+    chunks, packed_spans, tokens = packer.pack(["a b", "c d e", "f g"], spans)
+
+    assert chunks == ["a b\nc d e", "f g"]
+    assert packed_spans == [(0, 10, 1, 2), (10, 14, 3, 3)]
+    assert tokens == [5, 2]
+
+def test_long_chunks_are_split(packer):
+    text = "one two three four five six seven eight\nnine"
+
+    chunks, spans, tokens = packer.pack([text], [None])
+
+    assert chunks == ["one two three four five six", "seven eight\nnine"]
+    assert spans == [None, None]
+    assert max(tokens) <= 6
+
+def test_empty_chunks_are_skipped(packer):
+    chunks, spans, _ = packer.pack(["", "  \n ", "a"], [None, None, None])
+
+    assert chunks == ["a"]
+
+def test_overlap_repeats_last_units():
+    packer = Packer(max_tokens=8, overlap=1)
+
+    chunks, _, _ = packer.pack(["a b", "c d", "e f", "g h"], [None] * 4)
+
+    assert chunks == ["a b\nc d\ne f", "e f\ng h"]
+
+def test_images_pass_through(packer):
+    image = object()
+
+    assert packer.pack([image], [None]) == ([image], [None], [0])
+
+def test_for_model_uses_tokenizer_and_length():
+    model = Mock()
+    model.max_seq_length = 10
+    model.tokenizer.tokenizer.tokenize.side_effect = lambda text: list(text)
+
+    packer = Packer.for_model(model)
+
+    assert packer.budget == 8
+    assert packer.count("abc") == 3
+
+def test_for_model_falls_back_to_approximate_count():
+    packer = Packer.for_model(object())
+
+    assert packer.budget == 75
+    assert packer.count is approximate_count
@@ -1,12 +1,16 @@
 import os
 import pytest
 import sqlite3
+import threading
 import numpy as np
 
 from infrastructure.database import DataBase
 from infrastructure.vectorindex import Index
 
+from config import VECTOR_DIM
+
 TEST_VOLUME = "tests/data/semantic_test_dataset"
+TEST_DOCS = "tests/data/docs"
 TEST_DB = 'tests/data/db/test.db'
 TEST_IDX = "tests/data/idx/test.idx"
 TEST_DIM = 10
@@ -37,6 +41,13 @@ def database():
 
       os.remove(TEST_IDX)
 
+@pytest.fixture
+def volume(tmp_path):
+      for i in range(3):
+            # two chunks of at most 77 tokens each
+            (tmp_path / f"{i}.txt").write_text(f"file number {i}\n" * 40)
+      return tmp_path
+
 @pytest.fixture
 def conn(database: DataBase):
       conn = sqlite3.connect(database.get_database())
@@ -94,7 +105,7 @@ def test_add(conn: sqlite3.Connection, database: DataBase):
       c = conn.cursor()
       for file, embeds in zip(TEST_VALUES_FILE_INPUT, TEST_CHUNK_EMBEDS):
             database.add(file, embeds, c)
-      files = conn.execute("""SELECT * FROM file""").fetchall()
+      files = conn.execute("""SELECT id, file_name, file_type, path FROM file""").fetchall()
       embed_ids = conn.execute("""SELECT id FROM chunk WHERE file_id=1""").fetchall()
       embed_ids = [id[0] for id in embed_ids]
 
@@ -108,7 +119,7 @@ def test_add_batch(conn: sqlite3.Connection, database: DataBase):
       c = conn.cursor()
       database.add_batch(TEST_VALUES_FILE_INPUT, TEST_CHUNK_EMBEDS, c)
 
-      files = conn.execute("""SELECT * FROM file""").fetchall()
+      files = conn.execute("""SELECT id, file_name, file_type, path FROM file""").fetchall()
       embed_ids = conn.execute("""SELECT id FROM chunk WHERE file_id=1""").fetchall()
       embed_ids = [id[0] for id in embed_ids]
 
@@ -146,6 +157,20 @@ def test_get_all(conn: sqlite3.Connection, database: DataBase):
       assert filepaths == correct_paths
       assert single_path == correct_single_path
 
+def test_resolve_ranks_files_by_best_chunk(conn: sqlite3.Connection,
+                                          database: DataBase):
+      c = conn.cursor()
+      database.add_batch(TEST_VALUES_FILE_INPUT, TEST_CHUNK_EMBEDS, c)
+      results = [[(7, 0.9), (4, 0.8), (5, 0.7)], [(1, 0.5)], []]
+
+      resolved = database.resolve(results, conn)
+
+      assert resolved[0] == [
+            (TEST_VALUES_FILE_IN_DB[2][3], 0.9, [(7, 0.9)]),
+            (TEST_VALUES_FILE_IN_DB[1][3], 0.8, [(4, 0.8), (5, 0.7)])]
+      assert [path for path, _, _ in resolved[1]] == [TEST_VALUES_FILE_IN_DB[0][3]]
+      assert resolved[2] == []
+
 def test_add_volume():
     
       idx = Index(512, TEST_IDX)
@@ -165,4 +190,355 @@ def test_add_volume():
 
       assert len(files) > 0
       assert len(chunks) > 0
-      assert search_result != None
\ No newline at end of file
+      assert search_result != None
+
+def test_add_volume_batches_files(fake_model):
+      idx = Index(VECTOR_DIM, TEST_IDX)
+      database = DataBase(TEST_DOCS, TEST_DB, idx)
+      conn = sqlite3.connect(database.get_database())
+
+      database.add_volume(conn, fake_model, batch_size=4)
+      files = conn.execute("SELECT * FROM file").fetchall()
+      chunks = conn.execute("SELECT * FROM chunk").fetchall()
+
+      conn.execute("""DROP TABLE IF EXISTS file""")
+      conn.execute("""DROP TABLE IF EXISTS chunk""")
+      conn.commit()
+      conn.close()
+      os.remove(TEST_IDX)
+
+      n_files = len(os.listdir(TEST_DOCS))
+      assert len(files) == n_files
+      assert len(chunks) == idx.size()
+      # one text and at most one image call per batch of 4 files
+      assert fake_model.encode.call_count <= 2 * -(-n_files // 4)
+
+
+def test_database_uses_wal(database: DataBase):
+      conn = database.connect()
+      mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+      conn.close()
+
+      assert mode == "wal"
+
+def test_add_batch_commits_for_readers(volume):
+      idx = Index(TEST_DIM, TEST_IDX)
+      database = DataBase(str(volume), TEST_DB, idx, commit_every=2)
+      conn = database.connect()
+      reader = database.connect()
+      c = conn.cursor()
+
+      database.add_batch(TEST_VALUES_FILE_INPUT[:1], TEST_CHUNK_EMBEDS[:1], c)
+      before = reader.execute("SELECT COUNT(*) FROM file").fetchone()[0]
+      database.add_batch(TEST_VALUES_FILE_INPUT[1:], TEST_CHUNK_EMBEDS[1:], c)
+      after = reader.execute("SELECT COUNT(*) FROM chunk").fetchone()[0]
+      flushed = Index(TEST_DIM, TEST_IDX, new=False).size()
+
+      reader.close()
+      teardown(database, conn)
+
+      assert before == 0
+      assert after == 7
+      assert flushed == 7
+
+def test_readers_do_not_block_behind_writer(volume):
+      idx = Index(TEST_DIM, TEST_IDX)
+      database = DataBase(str(volume), TEST_DB, idx)
+      with database.writer() as conn:
+            database.add_batch(TEST_VALUES_FILE_INPUT[:1], TEST_CHUNK_EMBEDS[:1],
+                               conn.cursor())
+      read = []
+
+      with database.writer() as conn:
+            database.add_batch(TEST_VALUES_FILE_INPUT[1:], TEST_CHUNK_EMBEDS[1:],
+                               conn.cursor())
+            reader = threading.Thread(
+                  target=lambda: read.append(database.get_all_files([1, 4])))
+            reader.start()
+            reader.join(timeout=5)
+      after = database.get_all_files([1, 4])
+
+      database.close()
+      teardown(database, database.connect())
+
+      assert read == [[TEST_VALUES_FILE_IN_DB[0][3]]]
+      assert after == [TEST_VALUES_FILE_IN_DB[0][3], TEST_VALUES_FILE_IN_DB[1][3]]
+
+def test_streamed_parts_extend_their_file(volume):
+      idx = Index(TEST_DIM, TEST_IDX)
+      database = DataBase(str(volume), TEST_DB, idx)
+      conn = database.connect()
+      spans = [[(0, 10, 1, 10), (10, 20, 11, 20), (20, 30, 21, 30)],
+               [(30, 40, 31, 40), (40, 45, 41, 45)]]
+      files = [TEST_VALUES_FILE_INPUT[0]] * 2
+
+      database.add_batch(files, TEST_CHUNK_EMBEDS[:2], conn.cursor(),
+                         spans, [False, True])
+      n_files = conn.execute("SELECT COUNT(*) FROM file").fetchone()[0]
+      located = database.locate([4, 5], conn)
+      teardown(database, conn)
+
+      assert n_files == 1
+      assert idx.size() == 5
+      assert located == {4: ("data/file1", 31, 40, 30, 40),
+                         5: ("data/file1", 41, 45, 40, 45)}
+
+def test_later_parts_of_skipped_files_are_dropped(volume):
+      idx = Index(TEST_DIM, TEST_IDX)
+      database = DataBase(str(volume), TEST_DB, idx)
+      conn = database.connect()
+      files = [TEST_VALUES_FILE_INPUT[0]] * 2
+
+      database.add_batch(files[:1], TEST_CHUNK_EMBEDS[:1], conn.cursor())
+      database.add_batch(files, TEST_CHUNK_EMBEDS[:2], conn.cursor(),
+                         None, [False, True])
+      n_chunks = conn.execute("SELECT COUNT(*) FROM chunk").fetchone()[0]
+      teardown(database, conn)
+
+      assert n_chunks == 3
+
+def ingest(volume, model, hash_files=False):
+      idx = Index(VECTOR_DIM, TEST_IDX, new=False)
+      database = DataBase(str(volume), TEST_DB, idx, hash_files)
+      conn = sqlite3.connect(database.get_database())
+      database.add_volume(conn, model, workers=0)
+      conn.commit()
+      return database, conn
+
+def teardown(database, conn):
+      database.vectorindex.wait()
+      conn.execute("""DROP TABLE IF EXISTS file""")
+      conn.execute("""DROP TABLE IF EXISTS chunk""")
+      conn.execute("""DROP TABLE IF EXISTS chunk_text""")
+      conn.commit()
+      conn.close()
+      os.remove(TEST_IDX)
+      if os.path.exists(database.vectorindex.deleted_path):
+            os.remove(database.vectorindex.deleted_path)
+
+def test_failed_add_volume_leaves_no_vectors_behind(fake_model, volume,
+                                                     monkeypatch):
+      idx = Index(VECTOR_DIM, TEST_IDX)
+      database = DataBase(str(volume), TEST_DB, idx)
+      add_batch = database.add_batch
+      batches = []
+
+      def failing_add_batch(*args, **kwargs):
+            batches.append(args)
+            if len(batches) == 2:
+                  raise RuntimeError("ingestion failed")
+            add_batch(*args, **kwargs)
+      monkeypatch.setattr(database, "add_batch", failing_add_batch)
+      with pytest.raises(RuntimeError):
+            database.add_volume(None, fake_model, batch_size=1, workers=0)
+      monkeypatch.undo()
+      on_disk = Index(VECTOR_DIM, TEST_IDX, new=False).index.ntotal
+
+      database.add_volume(None, fake_model, workers=0)
+      conn = database.connect()
+      chunk_ids = sorted(r[0] for r in conn.execute("SELECT id FROM chunk"))
+      ids = sorted(database.vectorindex.vectors()[0].tolist())
+      ntotal = database.vectorindex.index.ntotal
+      database.close()
+      teardown(database, conn)
+
+      assert on_disk == 0
+      assert ntotal == len(chunk_ids) == 6
+      assert ids == chunk_ids
+
+def test_rescan_skips_unchanged_files(fake_model, volume):
+      database, conn = ingest(volume, fake_model)
+      calls = fake_model.encode.call_count
+      conn.close()
+
+      database, conn = ingest(volume, fake_model)
+      n_files = conn.execute("SELECT COUNT(*) FROM file").fetchone()[0]
+      teardown(database, conn)
+
+      assert fake_model.encode.call_count == calls
+      assert n_files == 3
+
+def test_rescan_replaces_modified_files(fake_model, volume):
+      database, conn = ingest(volume, fake_model)
+      old_chunks = [r[0] for r in conn.execute(
+            "SELECT chunk.id FROM chunk JOIN file ON file.id = chunk.file_id "
+            "WHERE file.file_name = '0.txt'")]
+      conn.close()
+
+      (volume / "0.txt").write_text("short now\n")
+      database, conn = ingest(volume, fake_model)
+      new_chunks = [r[0] for r in conn.execute(
+            "SELECT chunk.id FROM chunk JOIN file ON file.id = chunk.file_id "
+            "WHERE file.file_name = '0.txt'")]
+      n_chunks = conn.execute("SELECT COUNT(*) FROM chunk").fetchone()[0]
+      teardown(database, conn)
+
+      assert len(old_chunks) == 2
+      assert len(new_chunks) == 1
+      assert new_chunks[0] not in old_chunks
+      assert n_chunks == database.vectorindex.size()
+
+def test_scan_treats_files_deleted_since_the_walk_as_stale(fake_model, volume):
+      database, conn = ingest(volume, fake_model)
+      walked = list(database.walk())
+      file_id = conn.execute(
+            "SELECT id FROM file WHERE file_name = '2.txt'").fetchone()[0]
+
+      os.remove(volume / "2.txt")
+      database.walk = lambda: iter(walked)
+      entries, stale = database.scan(conn)
+      teardown(database, conn)
+
+      assert entries == []
+      assert stale == [file_id]
+
+def test_edit_during_extraction_is_found_by_next_scan(fake_model, volume):
+      encode = fake_model.encode.side_effect
+      path = volume / "0.txt"
+
+      def encode_and_edit(inputs, **kwargs):
+            # the file changes after it was scanned and extracted
+            if path.read_text() != "edited\n":
+                  path.write_text("edited\n")
+                  os.utime(path, ns=(0, 10**9))
+            return encode(inputs, **kwargs)
+      fake_model.encode.side_effect = encode_and_edit
+      database, conn = ingest(volume, fake_model)
+      fake_model.encode.side_effect = encode
+
+      entries, stale = database.scan(conn)
+      teardown(database, conn)
+
+      assert entries == [("0.txt", str(path))]
+      assert len(stale) == 1
+
+def test_add_volume_reports_counts(fake_model, volume):
+      database, conn = ingest(volume, fake_model)
+      counts = database.counts(conn)
+      teardown(database, conn)
+
+      assert sorted(counts) == [(str(volume / f"{i}.txt"), 2, 120)
+                                for i in range(3)]
+
+def test_rescan_with_hash_ignores_touched_files(fake_model, volume):
+      database, conn = ingest(volume, fake_model, hash_files=True)
+      calls = fake_model.encode.call_count
+      conn.close()
+
+      st = os.stat(volume / "1.txt")
+      os.utime(volume / "1.txt", ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+      database, conn = ingest(volume, fake_model, hash_files=True)
+      mtime = conn.execute(
+            "SELECT mtime FROM file WHERE file_name = '1.txt'").fetchone()[0]
+      teardown(database, conn)
+
+      assert fake_model.encode.call_count == calls
+      assert mtime == st.st_mtime_ns + 10**9
+
+def test_remove_file(fake_model, volume):
+      database, conn = ingest(volume, fake_model)
+      path = str(volume / "0.txt")
+      chunk_ids = [r[0] for r in conn.execute(
+            "SELECT chunk.id FROM chunk JOIN file ON file.id = chunk.file_id "
+            "WHERE file.path = ?", (path, ))]
+
+      removed = database.remove_file(path, conn)
+      removed_again = database.remove_file(path, conn)
+      files = conn.execute("SELECT path FROM file").fetchall()
+      n_chunks = conn.execute("SELECT COUNT(*) FROM chunk").fetchone()[0]
+      results = database.vectorindex.search(
+            np.ones(VECTOR_DIM, dtype="float32"), k=10)
+      teardown(database, conn)
+
+      assert removed and not removed_again
+      assert (path, ) not in files
+      assert n_chunks == database.vectorindex.size()
+      assert not set(chunk_ids) & {i for i, _ in results[0]}
+
+def test_update_file(fake_model, volume):
+      database, conn = ingest(volume, fake_model)
+      path = str(volume / "1.txt")
+
+      (volume / "1.txt").write_text("changed\n")
+      database.update_file(path, conn, fake_model)
+      n_chunks = conn.execute(
+            "SELECT COUNT(*) FROM chunk JOIN file ON file.id = chunk.file_id "
+            "WHERE file.path = ?", (path, )).fetchone()[0]
+      total_chunks = conn.execute("SELECT COUNT(*) FROM chunk").fetchone()[0]
+      teardown(database, conn)
+
+      assert n_chunks == 1
+      assert total_chunks == database.vectorindex.size()
+
+def test_rescan_removes_deleted_files(fake_model, volume):
+      database, conn = ingest(volume, fake_model)
+      conn.close()
+
+      os.remove(volume / "2.txt")
+      database, conn = ingest(volume, fake_model)
+      files = [r[0] for r in conn.execute("SELECT file_name FROM file")]
+      n_chunks = conn.execute("SELECT COUNT(*) FROM chunk").fetchone()[0]
+      teardown(database, conn)
+
+      assert sorted(files) == ["0.txt", "1.txt"]
+      assert n_chunks == database.vectorindex.size()
+
+def test_filter_ids(fake_model, volume):
+      os.utime(volume / "0.txt", (1_000_000_000, 1_000_000_000))
+      database, conn = ingest(volume, fake_model)
+      old = database.filter_ids(modified_before=1_500_000_000, conn=conn)
+      text = database.filter_ids(file_type="text", conn=conn)
+      one = database.filter_ids(path_prefix=str(volume / "1"), conn=conn)
+      images = database.filter_ids(file_type=["image", "PDF"], conn=conn)
+      chunks = dict(conn.execute(
+            "SELECT file.file_name, GROUP_CONCAT(chunk.id) FROM chunk "
+            "JOIN file ON file.id = chunk.file_id GROUP BY file.file_name"))
+      teardown(database, conn)
+
+      assert old.tolist() == [int(i) for i in chunks["0.txt"].split(",")]
+      assert one.tolist() == [int(i) for i in chunks["1.txt"].split(",")]
+      assert len(text) == 6 and list(text) == sorted(text)
+      assert len(images) == 0
+
+def test_full_text_match(tmp_path):
+      idx = Index(TEST_DIM, str(tmp_path / "test.idx"))
+      database = DataBase(str(tmp_path), str(tmp_path / "test.db"), idx,
+                          full_text=True)
+      conn = database.connect()
+      texts = [["boats in the harbor", "ERR_404 not found", "cargo ships"],
+               ["fast cars", "red cars"], ["boat engines", None]]
+      database.add_batch(TEST_VALUES_FILE_INPUT, TEST_CHUNK_EMBEDS, conn.cursor(),
+                         texts=texts)
+      conn.commit()
+
+      found = database.match(["err_404", "cars OR boats", "2", "!"], 5)
+      database.remove_file("data/file1", conn)
+      conn.commit()
+      after_remove = database.match(["ERR_404"], 5)
+      conn.close()
+
+      assert [i for i, _ in found[0]] == [2]
+      # query syntax is matched as text, any term matches
+      assert sorted(i for i, _ in found[1]) == [1, 4, 5]
+      assert {i for i, _ in found[2]} == {4, 5}
+      assert found[3] == []
+      assert after_remove == [[]]
+
+def test_full_text_on_existing_database_reingests_files(fake_model, volume):
+      database, conn = ingest(volume, fake_model)
+      calls = fake_model.encode.call_count
+      conn.close()
+
+      idx = Index(VECTOR_DIM, TEST_IDX, new=False)
+      database = DataBase(str(volume), TEST_DB, idx, full_text=True)
+      before = database.match(["number"], 10)
+      conn = database.connect()
+      database.add_volume(conn, fake_model, workers=0)
+      conn.commit()
+      found = database.match(["number"], 10)
+      n_chunks = conn.execute("SELECT COUNT(*) FROM chunk").fetchone()[0]
+      teardown(database, conn)
+
+      assert before == [[]]
+      assert fake_model.encode.call_count > calls
+      assert len(found[0]) == n_chunks == database.vectorindex.size() == 6
@@ -2,21 +2,11 @@ import pytest
 import numpy as np
 
 from processing import embeddings as em
-from unittest.mock import Mock
+from processing.cache import EmbeddingCache
+from PIL import Image
 
 from config import VECTOR_DIM
 
-@pytest.fixture
-def fake_model():
-    fake_model = Mock()
-
-    def fake_encode(inputs, convert_to_numpy=True, normalize_embeddings=True):
-        n = len(inputs)
-        return np.ones((n, VECTOR_DIM), dtype="float32")
-
-    fake_model.encode.side_effect = fake_encode
-    return fake_model
-
 @pytest.fixture
 def test_files():
     return [
@@ -53,4 +43,133 @@ def test_create_query_embeddings_correct_shape_and_dtype(fake_model):
 
     assert isinstance(vectors, np.ndarray)
     assert vectors.shape == (2, VECTOR_DIM)
-    assert vectors.dtype == np.float32
\ No newline at end of file
+    assert vectors.dtype == np.float32
+
+def test_embed_batch_scatters_per_file(fake_model, test_files):
+    results = em.embed_batch(test_files, fake_model)
+
+    assert len(results) == len(test_files)
+    for file, (filetype, embeddings) in zip(test_files, results):
+        expected_type, chunks = em.extract(file)
+        assert filetype == expected_type
+        assert embeddings.shape == (len(chunks), VECTOR_DIM)
+        assert embeddings.dtype == np.float32
+
+def test_encode_batch_one_call_per_modality(fake_model, test_files):
+    documents = [em.extract(f)[1] for f in test_files]
+
+    em.encode_batch(documents, fake_model)
+
+    # all text chunks in one call, all images in another
+    assert fake_model.encode.call_count == 2
+
+def test_encode_batch_empty_documents(fake_model):
+    embeddings = em.encode_batch([[], []], fake_model)
+
+    assert len(embeddings) == 2
+    assert embeddings[0].shape == (0, VECTOR_DIM)
+
+def test_chunk_cache_encodes_each_content_once(fake_model, monkeypatch, tmp_path):
+    monkeypatch.setattr(em.MODELS, "get", lambda name=None: fake_model)
+    cache = EmbeddingCache(max_size=10, path=str(tmp_path / "chunks.db"))
+    image = Image.new("RGB", (8, 8), "red")
+
+    first = em.encode_batch([["a", "b"], ["a", image]], cache=cache)
+    calls = [c.args[0] for c in fake_model.encode.call_args_list]
+    # same pixels as a different image object, e.g. a JPG and a PNG copy
+    again = em.encode_batch([[image.copy(), "b"]], cache=cache)
+    cache.close()
+    stored = EmbeddingCache(max_size=10, path=str(tmp_path / "chunks.db"))
+    em.encode_batch([["a"]], cache=stored)
+
+    assert calls == [["a", "b"], [image]]
+    assert fake_model.encode.call_count == 2
+    assert [e.shape for e in first] == [(2, VECTOR_DIM), (2, VECTOR_DIM)]
+    assert again[0].shape == (2, VECTOR_DIM)
+    assert cache.stats()["hits"] == 2
+    assert stored.stats()["disk_hits"] == 1
+
+def test_chunk_cache_skipped_for_model_objects(fake_model):
+    cache = EmbeddingCache(max_size=10)
+
+    em.encode_batch([["a"]], fake_model, cache=cache)
+    em.encode_batch([["a"]], fake_model, cache=cache)
+
+    assert fake_model.encode.call_count == 2
+    assert cache.stats()["size"] == 0
+
+def test_query_cache_encodes_only_misses(fake_model, monkeypatch):
+    monkeypatch.setattr(em.MODELS, "get", lambda name=None: fake_model)
+    cache = EmbeddingCache(max_size=10)
+
+    em.create_query_embeddings(["a cat", "a dog"], cache=cache)
+    vectors = em.create_query_embeddings(["a  cat ", "a bird", "a bird"],
+                                         cache=cache)
+
+    assert vectors.shape == (3, VECTOR_DIM)
+    assert fake_model.encode.call_args_list[-1].args[0] == ["a bird"]
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 4
+
+def test_query_cache_skipped_for_model_objects(fake_model):
+    cache = EmbeddingCache(max_size=10)
+
+    em.create_query_embeddings(["a cat"], fake_model, cache=cache)
+    em.create_query_embeddings(["a cat"], fake_model, cache=cache)
+
+    assert fake_model.encode.call_count == 2
+
+def test_text_chunks_are_clean_with_offsets(tmp_path):
+    path = tmp_path / "lines.txt"
+    path.write_bytes(b"one\ntwo\nthree\nfour\nfive")
+
+    chunks = list(em.text_chunks(str(path), chunk_size=2, overlap=1))
+    content = path.read_bytes()
+
+    assert [text for text, _ in chunks] == ["one\ntwo", "two\nthree",
+                                            "three\nfour", "four\nfive"]
+    assert [span[2:] for _, span in chunks] == [(1, 2), (2, 3), (3, 4), (4, 5)]
+    for text, (start, end, _, _) in chunks:
+        assert content[start:end].decode().strip() == text
+
+def test_extract_txt_has_no_list_artifacts():
+    _, chunks = em.extract("tests/data/docs/0.txt")
+
+    assert not any(c.startswith("[") or "\\n" in c for c in chunks)
+
+def test_extract_parts_streams_large_text(tmp_path):
+    path = tmp_path / "big.txt"
+    path.write_text("line\n" * 95)
+
+    parts = list(em.extract_parts(str(path), part_size=4))
+
+    assert [len(chunks) for _, chunks, _ in parts] == [4, 4, 2]
+    assert parts[-1][2][-1][2:] == (91, 95)
+
+def test_extract_parts_yields_empty_files(tmp_path):
+    path = tmp_path / "empty.txt"
+    path.write_text("")
+
+    assert [chunks for _, chunks, _ in em.extract_parts(str(path))] == [[]]
+
+def test_load_image_decodes_to_model_size(tmp_path):
+    path = str(tmp_path / "large.jpg")
+    Image.new("RGB", (3000, 2000), (200, 10, 10)).save(path)
+
+    img = em.load_image(path, size=224)
+
+    assert img.mode == "RGB"
+    assert img.size == (336, 224)
+
+def test_load_image_keeps_small_images(test_files):
+    img = em.load_image(test_files[4], size=1000)
+
+    assert img.size == Image.open(test_files[4]).size
+
+def test_load_image_applies_exif_orientation(tmp_path):
+    path = str(tmp_path / "rotated.jpg")
+    exif = Image.Exif()
+    exif[0x0112] = 6 # rotated 90 degrees clockwise
+    Image.new("RGB", (600, 300)).save(path, exif=exif)
+
+    assert em.load_image(path, size=224).size == (224, 448)
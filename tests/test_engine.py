@@ -0,0 +1,55 @@
+import asyncio
+import pytest
+
+import retrieval.search as rs
+from retrieval.engine import SearchEngine
+
+@pytest.fixture
+def batches(monkeypatch):
+      batches = []
+
+      def fake_search(database, queries, k=5, include_scores=False, **kwargs):
+            if "fail" in queries:
+                  raise RuntimeError("search failed")
+            batches.append(list(queries))
+            return [[f"{q}-{i}" for i in range(k)] for q in queries]
+
+      monkeypatch.setattr(rs, "search", fake_search)
+      return batches
+
+def run(engine: SearchEngine, searches):
+      async def main():
+            async with engine:
+                  return await asyncio.gather(*searches(engine),
+                                              return_exceptions=True)
+      return asyncio.run(main())
+
+def test_concurrent_queries_share_a_batch(batches):
+      engine = SearchEngine(None, max_batch=64, max_wait=0.05)
+
+      results = run(engine, lambda e: [e.search(f"q{i}", k=2) for i in range(10)])
+
+      assert batches == [[f"q{i}" for i in range(10)]]
+      assert results[3] == ["q3-0", "q3-1"]
+
+def test_full_batches_start_without_waiting(batches):
+      engine = SearchEngine(None, max_batch=4, max_wait=10)
+
+      run(engine, lambda e: [e.search(f"q{i}") for i in range(8)])
+
+      assert [len(b) for b in batches] == [4, 4]
+
+def test_batches_are_split_by_search_arguments(batches):
+      engine = SearchEngine(None, max_wait=0.05)
+
+      results = run(engine, lambda e: [e.search("a", k=1), e.search("b", k=3)])
+
+      assert sorted(batches) == [["a"], ["b"]]
+      assert [len(r) for r in results] == [1, 3]
+
+def test_errors_reach_every_caller_of_a_batch(batches):
+      engine = SearchEngine(None, max_wait=0.05)
+
+      results = run(engine, lambda e: [e.search("fail"), e.search("ok")])
+
+      assert all(isinstance(r, RuntimeError) for r in results)
@@ -0,0 +1,74 @@
+import os
+import pytest
+
+import numpy as np
+
+from infrastructure import metrics
+from infrastructure.vectorindex import Index
+
+from config import VECTOR_DIM
+
+TEST_PATH = "tests/data/test-index/metrics.index"
+
+@pytest.fixture
+def recorder():
+    previous = metrics.RECORDER
+    yield metrics.enable(metrics.Metrics())
+
+    metrics.RECORDER = previous
+
+def test_disabled_records_nothing():
+    null = metrics.NullMetrics()
+    with null.span("stage"):
+        null.count("calls")
+
+    assert null.snapshot() == {"counters": {}, "histograms": {}}
+    assert null.export() == ""
+
+def test_span_and_count(recorder):
+    with metrics.span("stage"):
+        metrics.count("calls", 3)
+    metrics.observe("stage", 20.0)
+
+    snapshot = metrics.snapshot()
+    assert snapshot["counters"] == {"calls": 3}
+    stage = snapshot["histograms"]["stage"]
+    assert stage["count"] == 2
+    assert stage["buckets"][0] == 1 # well below 0.5 ms
+    assert stage["buckets"][-1] == 1 # above the largest finite bound
+
+def test_export_prometheus_text(recorder):
+    metrics.count("search.queries", 2)
+    metrics.observe("index.search", 0.002)
+    text = metrics.export()
+
+    assert "# TYPE sre_search_queries_total counter" in text
+    assert "sre_search_queries_total 2" in text
+    assert 'sre_index_search_seconds_bucket{le="0.001"} 0' in text
+    assert 'sre_index_search_seconds_bucket{le="0.0025"} 1' in text
+    assert 'sre_index_search_seconds_bucket{le="+Inf"} 1' in text
+    assert "sre_index_search_seconds_count 1" in text
+
+def test_collect_returns_what_a_worker_recorded(recorder):
+    metrics.count("parent")
+    result, recorded = metrics.collect(True, lambda x: metrics.count("worker") or x, 5)
+
+    assert result == 5
+    assert recorded["counters"] == {"worker": 1}
+    assert metrics.RECORDER is recorder
+    recorder.merge(recorded)
+    assert metrics.snapshot()["counters"] == {"parent": 1, "worker": 1}
+    assert metrics.collect(False, abs, -1) == (1, None)
+
+def test_index_is_instrumented(recorder):
+    index = Index(VECTOR_DIM, TEST_PATH, new=True)
+    vectors = np.eye(3, VECTOR_DIM, dtype="float32")
+    index.add(vectors, np.array([1, 2, 3]))
+    index.search(vectors, 1)
+
+    snapshot = metrics.snapshot()
+    assert snapshot["counters"]["index.vectors"] == 3
+    assert snapshot["counters"]["index.queries"] == 3
+    assert {"index.add", "index.write", "index.search"} <= set(snapshot["histograms"])
+
+    os.remove(TEST_PATH)
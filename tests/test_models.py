@@ -0,0 +1,48 @@
+import threading
+import pytest
+
+from unittest.mock import Mock
+
+from processing.models import ModelManager
+
+@pytest.fixture
+def loader():
+    return Mock(side_effect=lambda name: f"model:{name}")
+
+def test_models_load_on_first_use(loader):
+    models = ModelManager("a", loader=loader)
+
+    assert loader.call_count == 0
+    assert models.get() == "model:a"
+    assert models.get("a") == "model:a"
+    assert models.get("b") == "model:b"
+    assert loader.call_count == 2
+    assert sorted(models.loaded()) == ["a", "b"]
+
+def test_concurrent_gets_load_once(loader):
+    models = ModelManager("a", loader=loader)
+    threads = [threading.Thread(target=models.get) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert loader.call_count == 1
+
+def test_warmup_and_unload(loader):
+    models = ModelManager("a", loader=loader)
+    models.warmup("a", "b")
+
+    assert models.unload("b")
+    assert not models.unload("b")
+    assert models.loaded() == ["a"]
+
+def test_unload_idle(loader):
+    models = ModelManager("a", idle_timeout=3600, loader=loader)
+    models.warmup()
+
+    assert models.unload_idle() == []
+    assert models.unload_idle(idle_timeout=0) == ["a"]
+    assert models.loaded() == []
+    models.get()
+    assert loader.call_count == 2
@@ -0,0 +1,81 @@
+import os
+import pytest
+import numpy as np
+
+from unittest.mock import Mock
+
+from processing.pipeline import Pipeline
+
+from config import VECTOR_DIM
+
+TEST_DOCS = "tests/data/docs"
+
+class RecordingDataBase:
+    def __init__(self):
+        self.files = []
+        self.embeds = []
+        self.continued = []
+
+    def add_batch(self, files, chunk_embeds, cursor, spans=None, continued=None,
+                  tokens=None, texts=None):
+        self.files.extend(files)
+        self.embeds.extend(chunk_embeds)
+        self.continued.extend(continued)
+
+@pytest.fixture
+def entries():
+    return [(f, os.path.join(TEST_DOCS, f)) for f in sorted(os.listdir(TEST_DOCS))]
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_pipeline_writes_every_file(fake_model, entries, workers):
+    db = RecordingDataBase()
+    pipeline = Pipeline(db, fake_model, workers=workers,
+                        queue_depth=2, batch_size=3)
+
+    pipeline.run(iter(entries), None)
+
+    assert [f[2] for f in db.files] == [path for _, path in entries]
+    for embeds in db.embeds:
+        assert embeds.shape[1] == VECTOR_DIM
+
+def test_pipeline_raises_extraction_errors(fake_model, entries):
+    db = RecordingDataBase()
+    pipeline = Pipeline(db, fake_model, workers=2, queue_depth=2, batch_size=3)
+    entries.append(("missing", os.path.join(TEST_DOCS, "missing.txt")))
+
+    with pytest.raises(Exception):
+        pipeline.run(iter(entries), None)
+
+def test_pipeline_raises_writer_errors(fake_model, entries):
+    db = Mock()
+    db.add_batch.side_effect = RuntimeError("disk full")
+    pipeline = Pipeline(db, fake_model, workers=0, queue_depth=1, batch_size=1)
+
+    with pytest.raises(RuntimeError):
+        pipeline.run(iter(entries), None)
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_pipeline_streams_text_files_in_parts(fake_model, tmp_path, workers):
+    path = tmp_path / "big.txt"
+    path.write_text("a line of text\n" * 95)
+    db = RecordingDataBase()
+    pipeline = Pipeline(db, fake_model, workers=workers, queue_depth=2,
+                        batch_size=3, part_size=4, pack=False)
+
+    pipeline.run(iter([("big.txt", str(path))]), None)
+
+    assert db.continued == [False, True, True]
+    assert [len(e) for e in db.embeds] == [4, 4, 2]
+
+def test_pipeline_packs_chunks_to_model_length(fake_model, tmp_path):
+    path = tmp_path / "lines.txt"
+    path.write_text("one two three four five\n" * 40 + "\n \n")
+    db = RecordingDataBase()
+    fake_model.max_seq_length = 52 # 50 tokens, 10 lines per chunk
+    pipeline = Pipeline(db, fake_model, workers=0, queue_depth=2, batch_size=3)
+
+    pipeline.run(iter([("lines.txt", str(path))]), None)
+
+    assert [len(e) for e in db.embeds] == [4]
+    texts = fake_model.encode.call_args_list[0].args[0]
+    assert texts[0] == "\n".join(["one two three four five"] * 10)
@@ -0,0 +1,52 @@
+import sqlite3
+import threading
+import pytest
+
+from infrastructure.pool import ConnectionPool
+
+@pytest.fixture
+def db(tmp_path):
+      path = str(tmp_path / "pool.db")
+      conn = sqlite3.connect(path)
+      conn.execute("PRAGMA journal_mode=WAL")
+      conn.execute("CREATE TABLE file (id INTEGER PRIMARY KEY, path TEXT)")
+      conn.execute("INSERT INTO file (path) VALUES ('a.txt')")
+      conn.commit()
+      conn.close()
+      return path
+
+def test_connections_are_reused(db):
+      pool = ConnectionPool(db, size=2)
+      with pool.connection() as first:
+            pass
+      with pool.connection() as second:
+            assert second is first
+      pool.close()
+
+      assert pool.created == 1
+
+def test_connections_are_read_only(db):
+      pool = ConnectionPool(db, size=1)
+      with pool.connection() as conn:
+            with pytest.raises(sqlite3.OperationalError):
+                  conn.execute("INSERT INTO file (path) VALUES ('b.txt')")
+      pool.close()
+
+def test_pool_is_bounded_and_shared_across_threads(db):
+      pool = ConnectionPool(db, size=2)
+      seen = []
+
+      def query():
+            for _ in range(20):
+                  with pool.connection() as conn:
+                        seen.append(conn.execute("SELECT path FROM file").fetchone())
+
+      threads = [threading.Thread(target=query) for _ in range(4)]
+      for t in threads:
+            t.start()
+      for t in threads:
+            t.join()
+      pool.close()
+
+      assert pool.created <= 2
+      assert seen == [("a.txt",)] * 80
@@ -1,10 +1,13 @@
 import os
 import pytest
 import sqlite3
+import numpy as np
 
 from infrastructure.database import DataBase
 from infrastructure.vectorindex import Index
+from retrieval.cache import ResultCache
 from retrieval.search import search
+import retrieval.search as rs
 
 from config import VECTOR_DIM
 
@@ -31,6 +34,150 @@ def conn(database: DataBase):
 
       conn.close()
 
+@pytest.fixture
+def small_database(tmp_path):
+      idx = Index(VECTOR_DIM, str(tmp_path / "test.idx"))
+      db = DataBase(str(tmp_path), str(tmp_path / "test.db"), idx)
+      conn = db.connect()
+      yield db, conn
+
+      conn.close()
+
+@pytest.fixture
+def encoded(monkeypatch):
+      encoded = []
+
+      def fake_embeddings(queries):
+            encoded.extend(queries)
+            return np.eye(len(queries), VECTOR_DIM, dtype="float32")
+
+      monkeypatch.setattr(rs, "create_query_embeddings", fake_embeddings)
+      return encoded
+
+def add_file(database: DataBase, conn: sqlite3.Connection, name: str, axis: int,
+             file_type: str = "ASCII"):
+      embeds = np.zeros((1, VECTOR_DIM), dtype="float32")
+      embeds[0, axis] = 1
+      database.add((name, file_type, name), embeds, conn.cursor())
+
+def test_result_cache_serves_repeated_queries(small_database, encoded):
+      database, conn = small_database
+      add_file(database, conn, "a.txt", 0)
+      cache = ResultCache(max_size=10)
+
+      first = search(database, ["a", "b"], conn, k=1, cache=cache)
+      again = search(database, ["a", " b "], conn, k=1, cache=cache)
+      other_k = search(database, "a", conn, k=2, cache=cache)
+
+      assert first == again == [["a.txt"], ["a.txt"]]
+      assert other_k == [["a.txt"]]
+      assert encoded == ["a", "b", "a"]
+
+def test_result_cache_invalidated_by_index_changes(small_database, encoded):
+      database, conn = small_database
+      add_file(database, conn, "a.txt", 0)
+      cache = ResultCache(max_size=10)
+
+      search(database, "a", conn, k=1, cache=cache)
+      add_file(database, conn, "b.txt", 0)
+      search(database, "a", conn, k=1, cache=cache)
+      database.remove_file("b.txt", conn)
+
+      assert search(database, "a", conn, k=1, cache=cache) == [["a.txt"]]
+      assert len(encoded) == 3
+
+def test_result_cache_invalidated_by_commits(small_database, encoded):
+      database, conn = small_database
+      add_file(database, conn, "a.txt", 0)
+      cache = ResultCache(max_size=10)
+
+      # pooled connections do not see the uncommitted chunk yet
+      assert search(database, "a", k=1, cache=cache) == [[]]
+      database.commit(conn)
+
+      assert search(database, "a", k=1, cache=cache) == [["a.txt"]]
+      assert len(encoded) == 2
+
+def test_search_ranks_files_with_scores(small_database, encoded):
+      database, conn = small_database
+      add_file(database, conn, "a.txt", 1)
+      add_file(database, conn, "b.txt", 0)
+
+      files = search(database, "a", conn, k=2, cache=None, include_scores=True)
+
+      assert [(path, score) for path, score, _ in files[0]] == [
+            ("b.txt", 1.0), ("a.txt", 0.0)]
+      assert files[0][0][2] == [(2, 1.0)]
+
+def test_search_filters_inside_the_index(small_database, encoded):
+      database, conn = small_database
+      add_file(database, conn, "docs/a.txt", 0)
+      add_file(database, conn, "docs/b.txt", 1)
+      add_file(database, conn, "photos/c.jpg", 2, "JPEG image data")
+      add_file(database, conn, "docs2/d.txt", 3)
+      conn.commit()
+      cache = ResultCache(max_size=10)
+
+      # "a" is closest to a.txt, the filters leave other files to return
+      assert search(database, "a", conn, k=1, cache=cache,
+                    file_type="image") == [["photos/c.jpg"]]
+      assert search(database, "a", conn, k=3, cache=cache,
+                    path_prefix="docs/") == [["docs/a.txt", "docs/b.txt"]]
+      assert search(database, "a", conn, k=1, cache=cache,
+                    path_prefix="docs2/") == [["docs2/d.txt"]]
+      assert search(database, "a", conn, k=1, cache=cache,
+                    modified_after=4e9) == [[]]
+      assert search(database, "a", conn, k=1, cache=cache) == [["docs/a.txt"]]
+
+@pytest.fixture
+def full_text_database(tmp_path):
+      idx = Index(VECTOR_DIM, str(tmp_path / "test.idx"))
+      db = DataBase(str(tmp_path), str(tmp_path / "test.db"), idx, full_text=True)
+      conn = db.connect()
+      for name, axis, text in [("a.txt", 0, "nothing special here"),
+                               ("b.txt", 1, "request failed with ERR_404")]:
+            embeds = np.zeros((1, VECTOR_DIM), dtype="float32")
+            embeds[0, axis] = 1
+            db.add_batch([(name, "ASCII", name)], [embeds], conn.cursor(),
+                         texts=[[text]])
+      conn.commit()
+      yield db, conn
+
+      conn.close()
+
+def test_hybrid_search_fuses_keyword_matches(full_text_database, encoded):
+      database, conn = full_text_database
+
+      # the query embedding is closest to a.txt, its keyword is in b.txt
+      vector = search(database, "ERR_404", conn, k=1, cache=None)
+      hybrid = search(database, "ERR_404", conn, k=2, cache=None,
+                      mode="hybrid", include_scores=True)
+
+      assert vector == [["a.txt"]]
+      assert [path for path, _, _ in hybrid[0]] == ["b.txt", "a.txt"]
+      assert hybrid[0][0][1] == pytest.approx(1 / 61 + 1 / 62)
+
+def test_prefilter_search_restricts_to_keyword_matches(full_text_database, encoded):
+      database, conn = full_text_database
+
+      assert search(database, ["ERR_404", "unknown"], conn, k=1, cache=None,
+                    mode="prefilter") == [["b.txt"], ["b.txt"]]
+      assert search(database, "unknown", conn, k=1, cache=None,
+                    mode="prefilter") == [["a.txt"]]
+      with pytest.raises(ValueError):
+            search(database, "a", conn, mode="keyword")
+
+def test_result_cache_evicts_least_recently_used():
+      cache = ResultCache(max_size=2)
+      cache.put(("a",), 0, ["a.txt"])
+      cache.put(("b",), 0, ["b.txt"])
+      cache.get(("a",), 0)
+      cache.put(("c",), 0, ["c.txt"])
+
+      assert cache.get(("b",), 0) is None
+      assert cache.get(("a",), 0) == ["a.txt"]
+      assert cache.get(("a",), 1) is None
+
 def test_query_batch(database: DataBase, conn: sqlite3.Connection):
     queries = ["airplane", "dog", "car"]
     database.add_volume(conn)
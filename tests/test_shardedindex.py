@@ -0,0 +1,163 @@
+import os
+import shutil
+import threading
+import pytest
+
+import numpy as np
+
+from infrastructure.shardedindex import ShardedIndex
+from infrastructure.vectorindex import Index
+
+from config import VECTOR_DIM
+
+TEST_DIR = "tests/data/test-shards"
+
+@pytest.fixture
+def vectors():
+    rng = np.random.default_rng(161)
+    vectors = rng.standard_normal((300, VECTOR_DIM)).astype("float32")
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+@pytest.fixture
+def shards():
+    created = []
+
+    def create(**args):
+        created.append(ShardedIndex(VECTOR_DIM, TEST_DIR, new=True, **args))
+        return created[-1]
+    yield create
+
+    # removes start background compactions that write into TEST_DIR
+    for sharded in created:
+        sharded.wait()
+    shutil.rmtree(TEST_DIR, ignore_errors=True)
+
+def test_search_merges_shards_into_global_top_k(shards, vectors):
+    sharded = shards(by="size", shard_size=100)
+    ids = np.arange(1, 301)
+    sharded.add(vectors, ids)
+    assert sorted(sharded.shards) == ["size-0", "size-1", "size-2"]
+    assert sharded.size() == 300
+
+    single = Index(VECTOR_DIM, f"{TEST_DIR}/single.index", new=True)
+    single.add(vectors, ids)
+    expected = single.search(vectors[:5], 10)
+    results = sharded.search(vectors[:5], 10)
+    assert [[i for i, _ in r] for r in results] == [[i for i, _ in r] for r in expected]
+    assert np.allclose([[d for _, d in r] for r in results],
+                       [[d for _, d in r] for r in expected], atol=1e-5)
+
+def test_search_during_adds_to_shards(shards, vectors):
+    many = np.tile(vectors, (20, 1))
+    sharded = shards(by="size", shard_size=2000)
+    sharded.add(many[:1], np.array([1]))
+    done = threading.Event()
+    errors = []
+
+    def searcher():
+        try:
+            while not done.is_set():
+                assert sharded.search(vectors[:20], 1)[0][0][0] == 1
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=searcher) for _ in range(4)]
+    for t in threads:
+        t.start()
+    with sharded:
+        for start in range(1, len(many), 100):
+            sharded.add(many[start:start + 100],
+                        np.arange(start + 1, min(start + 100, len(many)) + 1))
+    done.set()
+    for t in threads:
+        t.join()
+
+    assert errors == []
+    assert sharded.size() == len(many)
+
+def test_range_shards_route_adds_and_removes(shards, vectors):
+    sharded = shards(by="range", id_range=100)
+    sharded.add(vectors[:3], np.array([5, 150, 260]))
+    assert sorted(sharded.shards) == ["range-0", "range-1", "range-2"]
+
+    generation = sharded.generation
+    sharded.remove(np.array([150]))
+    assert sharded.generation > generation
+    assert sharded.shards["range-1"].size() == 0
+    assert sharded.size() == 2
+    assert 150 not in {i for i, _ in sharded.search(vectors[1], 3)[0]}
+
+def test_invalidate_bumps_generation(shards):
+    sharded = shards(by="size")
+    generation = sharded.generation
+    sharded.invalidate()
+    assert sharded.generation > generation
+
+def test_size_shards_remove_by_id_range(shards, vectors):
+    sharded = shards(by="size", shard_size=100)
+    sharded.add(vectors[:150], np.arange(1, 151))
+    sharded.remove(np.array([10, 120]))
+    assert sharded.shards["size-0"].size() == 99
+    assert sharded.shards["size-1"].size() == 49
+
+def test_drop_shard_keeps_the_others(shards, vectors):
+    sharded = shards(by="size", shard_size=100)
+    sharded.add(vectors[:200], np.arange(1, 201))
+    generation = sharded.generation
+    path = sharded.shards["size-0"].path
+    sharded.drop("size-0")
+
+    assert not os.path.exists(path)
+    assert sharded.generation > generation
+    assert sharded.size() == 100
+    assert all(i > 100 for i, _ in sharded.search(vectors[0], 5)[0])
+    # names are not reused, new vectors fill the open shard first
+    sharded.add(vectors[200:250], np.arange(201, 251))
+    assert sorted(sharded.shards) == ["size-1", "size-2"]
+
+def test_rebuild_one_shard(shards, vectors):
+    sharded = shards(by="size", shard_size=150)
+    sharded.add(vectors, np.arange(1, 301))
+    sharded.rebuild("size-1", "hnsw")
+    assert type(sharded.shards["size-1"].base_index()).__name__ == "IndexHNSWFlat"
+    assert type(sharded.shards["size-0"].base_index()).__name__ == "IndexFlat"
+    assert sharded.search(vectors[200], 1)[0][0][0] == 201
+
+def test_volume_shards_are_named_by_the_caller(shards, vectors):
+    sharded = shards(by="volume")
+    with pytest.raises(ValueError):
+        sharded.add(vectors[:1], np.array([1]))
+    sharded.shard("photos").add(vectors[:2], np.array([1, 2]))
+    sharded.shard("documents").add(vectors[2:4], np.array([1, 2]))
+
+    results = sharded.search_shards(vectors[2], 2)[0]
+    assert results[0][:2] == ("documents", 1)
+    with pytest.raises(ValueError):
+        sharded.search(vectors[2], 2)
+
+def test_shard_searches_use_the_query_thread_budget(shards, vectors, monkeypatch):
+    budgets = []
+    monkeypatch.setattr("infrastructure.shardedindex.set_threads", budgets.append)
+    sharded = shards(by="size", shard_size=100)
+    sharded.add(vectors[:200], np.arange(1, 201))
+
+    sharded.search(vectors[0], 1, threads=2)
+    assert budgets == [2, 2]
+
+def test_reopen_from_manifest(shards, vectors):
+    sharded = shards(by="size", shard_size=100)
+    sharded.add(vectors[:150], np.arange(1, 151))
+    sharded.flush()
+
+    reopened = ShardedIndex(VECTOR_DIM, TEST_DIR, new=False, shard_size=100)
+    assert reopened.size() == 150
+    reopened.add(vectors[150:200], np.arange(151, 201))
+    assert sorted(reopened.shards) == ["size-0", "size-1"]
+    reopened.remove(np.array([5]))
+    assert reopened.shards["size-0"].size() == 99
+
+def test_bulk_mode_reaches_new_shards(shards, vectors):
+    sharded = shards(by="range", id_range=100)
+    with sharded:
+        sharded.add(vectors[:2], np.array([1, 101]))
+        assert all(s.bulk_depth == 1 for s in sharded.shards.values())
+    assert all(s.bulk_depth == 0 for s in sharded.shards.values())
@@ -0,0 +1,27 @@
+import os
+import faiss
+import pytest
+
+from infrastructure.threads import set_threads
+
+@pytest.fixture
+def restore():
+    torch = pytest.importorskip("torch")
+    omp, intra_op = faiss.omp_get_max_threads(), torch.get_num_threads()
+    yield torch
+
+    faiss.omp_set_num_threads(omp)
+    torch.set_num_threads(intra_op)
+
+def test_set_threads_applies_budget(restore):
+    set_threads(2)
+
+    assert faiss.omp_get_max_threads() == 2
+    assert restore.get_num_threads() == 2
+
+def test_none_uses_all_cores(restore):
+    set_threads(1)
+    set_threads(None)
+
+    assert faiss.omp_get_max_threads() == os.cpu_count()
+    assert restore.get_num_threads() == os.cpu_count()
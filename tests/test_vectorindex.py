@@ -1,8 +1,11 @@
+import os
+import threading
 import pytest
 
 import numpy as np
+from faiss import read_index
 
-from infrastructure.vectorindex import Index
+from infrastructure.vectorindex import Index, id_selector
 
 from config import VECTOR_DIM
 
@@ -13,6 +16,29 @@ TEST_PATH_2 = "tests/data/test-index/test2.index"
 def index():
     return Index(VECTOR_DIM, TEST_PATH_1, new=True)
 
+@pytest.fixture
+def vectors():
+    rng = np.random.default_rng(161)
+    vectors = rng.standard_normal((400, VECTOR_DIM)).astype("float32")
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+@pytest.fixture
+def bulk_index():
+    idx = Index(VECTOR_DIM, TEST_PATH_2, new=True, flush_every=3)
+    yield idx
+
+    os.remove(TEST_PATH_2)
+    if os.path.exists(idx.deleted_path):
+        os.remove(idx.deleted_path)
+
+@pytest.fixture
+def stored_index():
+    idx = Index(VECTOR_DIM, TEST_PATH_2, new=True, keep_vectors=True)
+    yield idx
+
+    for path in (TEST_PATH_2, idx.store.vectors_path, idx.store.ids_path):
+        os.remove(path)
+
 def test_add_vectors(index: Index):
     ids = np.array([10, 11])
     vectors = np.ones((2, VECTOR_DIM), dtype="float32")
@@ -56,4 +82,346 @@ def test_search_returns_chunk_ids(index: Index):
 
     assert isinstance(results, list)
     assert isinstance(results[0][0][1], np.float32)
-    assert results[0][0][0] in ids
\ No newline at end of file
+    assert results[0][0][0] in ids
+
+def test_bulk_add_defers_write(bulk_index: Index):
+    vectors = np.ones((2, VECTOR_DIM), dtype="float32")
+
+    with bulk_index:
+        bulk_index.add(vectors, np.array([1, 2]))
+        assert read_index(TEST_PATH_2).ntotal == 0
+
+    assert read_index(TEST_PATH_2).ntotal == 2
+    assert not os.path.exists(f"{TEST_PATH_2}.tmp")
+
+def test_bulk_flushes_on_size_threshold(bulk_index: Index):
+    vectors = np.ones((2, VECTOR_DIM), dtype="float32")
+
+    bulk_index.begin()
+    bulk_index.add(vectors, np.array([1, 2]))
+    bulk_index.add(vectors, np.array([3, 4]))
+    assert read_index(TEST_PATH_2).ntotal == 4
+
+    bulk_index.add(vectors, np.array([5, 6]))
+    bulk_index.flush()
+    assert read_index(TEST_PATH_2).ntotal == 6
+    bulk_index.close()
+
+def test_nested_bulk_persists_on_outer_close(bulk_index: Index):
+    vectors = np.ones((1, VECTOR_DIM), dtype="float32")
+
+    with bulk_index:
+        with bulk_index:
+            bulk_index.add(vectors, np.array([1]))
+        assert read_index(TEST_PATH_2).ntotal == 0
+
+    assert read_index(TEST_PATH_2).ntotal == 1
+
+
+def test_removed_vectors_are_not_returned(bulk_index: Index):
+    bulk_index.compact_threshold = 1.0 # keep the tombstones
+    vectors = np.eye(3, VECTOR_DIM, dtype="float32")
+    bulk_index.add(vectors, np.array([1, 2, 3]))
+
+    bulk_index.remove(np.array([1]))
+    results = bulk_index.search(vectors[0], k=3)
+    reopened = Index(VECTOR_DIM, TEST_PATH_2, new=False)
+
+    assert 1 not in [i for i, _ in results[0]]
+    assert len(results[0]) == 2
+    assert bulk_index.size() == 2
+    assert reopened.size() == 2
+    assert 1 not in [i for i, _ in reopened.search(vectors[0], k=3)[0]]
+
+def test_compact_drops_tombstoned_vectors(bulk_index: Index):
+    bulk_index.compact_threshold = 1.0
+    vectors = np.eye(3, VECTOR_DIM, dtype="float32")
+    bulk_index.add(vectors, np.array([1, 2, 3]))
+    bulk_index.remove(np.array([1, 3]))
+
+    bulk_index.compact()
+
+    assert bulk_index.index.ntotal == 1
+    assert bulk_index.size() == 1
+    assert not os.path.exists(bulk_index.deleted_path)
+    assert bulk_index.search(vectors[1], k=1)[0][0][0] == 2
+
+def test_remove_past_threshold_compacts_in_background(bulk_index: Index):
+    bulk_index.compact_threshold = 0.5
+    vectors = np.eye(4, VECTOR_DIM, dtype="float32")
+    bulk_index.add(vectors, np.array([1, 2, 3, 4]))
+
+    bulk_index.remove(np.array([1]))
+    assert bulk_index.index.ntotal == 4
+
+    bulk_index.remove(np.array([2]))
+    bulk_index.wait()
+    assert bulk_index.index.ntotal == 2
+
+
+@pytest.mark.parametrize("spec", ["ivf", "hnsw", "IVF8,PQ16x4"])
+def test_rebuild_from_flat(bulk_index: Index, vectors, spec):
+    ids = np.arange(1000, 1400)
+    bulk_index.add(vectors, ids)
+
+    bulk_index.rebuild(spec)
+    results = bulk_index.search(vectors[:10], k=1, nprobe=64, ef_search=128)
+    reopened = Index(VECTOR_DIM, TEST_PATH_2, new=False)
+
+    assert bulk_index.size() == 400
+    assert reopened.size() == 400
+    assert type(reopened.base_index()) is type(bulk_index.base_index())
+    found = [r[0][0] for r in results]
+    if "PQ" in spec: # lossy codes, random vectors are not recalled exactly
+        assert set(found) <= set(ids)
+    else:
+        assert found == list(ids[:10])
+
+def test_untrained_index_rejects_adds(vectors):
+    index = Index(VECTOR_DIM, TEST_PATH_2, new=True, spec="IVF8,Flat")
+    ids = np.arange(400)
+
+    with pytest.raises(RuntimeError):
+        index.add(vectors, ids)
+    index.train(vectors)
+    index.add(vectors, ids)
+    size = index.size()
+    os.remove(TEST_PATH_2)
+
+    assert size == 400
+
+def test_compact_approximate_index(bulk_index: Index, vectors):
+    bulk_index.compact_threshold = 1.0
+    bulk_index.add(vectors, np.arange(400))
+    bulk_index.rebuild("hnsw")
+    bulk_index.remove(np.arange(100))
+
+    bulk_index.compact()
+    results = bulk_index.search(vectors[150], k=1)
+
+    assert bulk_index.index.ntotal == 300
+    assert results[0][0][0] == 150
+
+
+def test_rerank_restores_exact_scores(stored_index: Index, vectors):
+    stored_index.add(vectors, np.arange(400))
+    stored_index.rebuild("sq8")
+
+    exact = vectors[:5] @ vectors.T
+    results = stored_index.search(vectors[:5], k=3, rerank=20)
+
+    for x, r in enumerate(results):
+        assert [i for i, _ in r] == list(np.argsort(-exact[x])[:3])
+        assert np.allclose([d for _, d in r], np.sort(exact[x])[::-1][:3],
+                           atol=1e-5)
+
+def test_compressed_index_is_smaller_and_recall_is_reported(
+        stored_index: Index, vectors):
+    stored_index.add(vectors, np.arange(400))
+    flat_bytes = stored_index.nbytes()
+    flat_recall = stored_index.recall(vectors[:20], k=5)
+
+    stored_index.rebuild("sq8")
+
+    assert flat_recall == 1.0
+    assert stored_index.nbytes() < flat_bytes / 3
+    assert stored_index.recall(vectors[:20], k=5, rerank=50) == 1.0
+
+@pytest.mark.parametrize("spec", ["pq", "ivfpq"])
+def test_rebuild_needs_enough_vectors_to_train(bulk_index: Index, vectors, spec):
+    bulk_index.add(vectors[:100], np.arange(100))
+
+    with pytest.raises(ValueError):
+        bulk_index.rebuild(spec)
+    assert type(bulk_index.base_index()).__name__ == "IndexFlat"
+    assert bulk_index.size() == 100
+
+@pytest.mark.parametrize("spec", ["pq", "sq8"])
+def test_recall_of_compressed_index_needs_full_precision_vectors(
+        bulk_index: Index, vectors, spec):
+    bulk_index.add(vectors, np.arange(400))
+    ground_truth = bulk_index.vectors() # exact while the index is flat
+    assert bulk_index.recall(vectors[:20], k=5) == 1.0
+
+    bulk_index.rebuild(spec)
+
+    with pytest.raises(ValueError):
+        bulk_index.recall(vectors[:20], k=5)
+    recall = bulk_index.recall(vectors[:20], k=5, ground_truth=ground_truth)
+    if spec == "pq": # its own codes would have scored 1.0
+        assert recall < 1.0
+    assert 0.0 < recall <= 1.0
+
+def test_vector_store_follows_compaction_and_reopen(stored_index: Index, vectors):
+    stored_index.compact_threshold = 1.0
+    stored_index.add(vectors, np.arange(400))
+    stored_index.remove(np.arange(50))
+    stored_index.compact()
+
+    reopened = Index(VECTOR_DIM, TEST_PATH_2, new=False, keep_vectors=True)
+    ids, stored = reopened.vectors()
+
+    assert reopened.store.size() == 350
+    assert np.array_equal(ids, np.arange(50, 400))
+    assert np.array_equal(stored, vectors[50:])
+
+def test_read_only_index_is_mapped_and_rejects_changes(bulk_index: Index, vectors):
+    bulk_index.add(vectors, np.arange(400))
+    bulk_index.flush()
+
+    reader = Index(VECTOR_DIM, TEST_PATH_2, read_only=True)
+
+    assert reader.size() == 400
+    assert reader.search(vectors[7], k=1)[0][0][0] == 7
+    with pytest.raises(RuntimeError):
+        reader.add(vectors[:1], np.array([400]))
+    with pytest.raises(RuntimeError):
+        reader.remove(np.array([0]))
+
+def test_read_only_index_keeps_the_vector_store(stored_index: Index, vectors):
+    stored_index.add(vectors[:100], np.arange(100))
+    stored_index.flush()
+    sizes = [os.path.getsize(p) for p in (stored_index.store.vectors_path,
+                                          stored_index.store.ids_path)]
+
+    reader = Index(VECTOR_DIM, TEST_PATH_2, read_only=True, keep_vectors=True)
+
+    assert [os.path.getsize(p) for p in (stored_index.store.vectors_path,
+                                         stored_index.store.ids_path)] == sizes
+    assert reader.store.size() == 100
+    assert np.array_equal(reader.store.get(np.array([42])), vectors[42:43])
+
+def test_read_only_index_does_not_create_a_vector_store(bulk_index: Index, vectors):
+    bulk_index.add(vectors[:10], np.arange(10))
+    bulk_index.flush()
+
+    reader = Index(VECTOR_DIM, TEST_PATH_2, read_only=True, keep_vectors=True)
+
+    assert not os.path.exists(reader.store.vectors_path)
+    assert not os.path.exists(reader.store.ids_path)
+    assert reader.store.size() == 0
+
+def test_read_only_index_requires_file():
+    with pytest.raises(FileNotFoundError):
+        Index(VECTOR_DIM, "tests/data/test-index/missing.index", read_only=True)
+
+def test_reload_picks_up_published_index(bulk_index: Index, vectors):
+    bulk_index.add(vectors[:200], np.arange(200))
+    bulk_index.flush()
+    reader = Index(VECTOR_DIM, TEST_PATH_2, read_only=True)
+
+    assert not reader.reload()
+
+    bulk_index.add(vectors[200:], np.arange(200, 400))
+    bulk_index.remove(np.array([0]))
+    bulk_index.flush()
+
+    assert reader.reload()
+    assert reader.size() == 399
+    assert reader.search(vectors[300], k=1)[0][0][0] == 300
+    assert all(i != 0 for i, _ in reader.search(vectors[0], k=5)[0])
+
+def test_searches_run_safely_during_adds(tmp_path, vectors):
+    # adds reallocate the memory the searches read, unprotected this
+    # crashes the interpreter
+    many = np.tile(vectors, (25, 1))
+    idx = Index(VECTOR_DIM, str(tmp_path / "concurrent.index"),
+                flush_every=10**6)
+    idx.add(vectors[:1], np.array([0]))
+    done = threading.Event()
+    errors = []
+
+    def searcher():
+        try:
+            while not done.is_set():
+                assert idx.search(vectors[:20], k=1)[0][0][0] == 0
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=searcher) for _ in range(4)]
+    for t in threads:
+        t.start()
+    with idx:
+        for start in range(1, len(many), 100):
+            idx.add(many[start:start + 100],
+                    np.arange(start, min(start + 100, len(many))))
+        idx.remove(np.array([1, 2]))
+    done.set()
+    for t in threads:
+        t.join()
+
+    assert errors == []
+    assert idx.size() == len(many) - 2
+
+def test_rollback_undoes_changes_since_commit(bulk_index: Index, vectors):
+    bulk_index.track()
+    bulk_index.add(vectors[:10], np.arange(10))
+    bulk_index.commit()
+    bulk_index.add(vectors[10:20], np.arange(10, 20))
+    bulk_index.remove(np.array([0, 15]))
+
+    with pytest.raises(RuntimeError):
+        bulk_index.rebuild("hnsw")
+    bulk_index.rollback()
+
+    assert bulk_index.index.ntotal == 10
+    assert sorted(bulk_index.vectors()[0].tolist()) == list(range(10))
+    # the ids of rolled back adds can be used again
+    bulk_index.add(vectors[10:11], np.array([10]))
+    assert bulk_index.search(vectors[10], k=1)[0][0][0] == 10
+
+def test_readers_never_load_an_index_without_its_tombstones(bulk_index: Index,
+                                                             vectors):
+    bulk_index.add(vectors[:10], np.arange(10))
+    reader = Index(VECTOR_DIM, TEST_PATH_2, read_only=True)
+    write_deleted = bulk_index.write_deleted
+    removed = set()
+    served = set()
+
+    def write_deleted_then_read(deleted):
+        # a reader reloading between the writes of one flush
+        write_deleted(deleted)
+        reader.reload()
+        served.update(removed & {i for i, _ in reader.search(vectors[0], k=10)[0]})
+    bulk_index.write_deleted = write_deleted_then_read
+
+    removed.add(3)
+    bulk_index.remove(np.array([3]))
+    bulk_index.compact()
+    removed.add(5)
+    bulk_index.remove(np.array([5]))
+
+    assert served == set()
+    assert reader.reload()
+    assert reader.deleted == {5}
+
+def test_generation_counts_changes(bulk_index: Index, vectors):
+    start = bulk_index.generation
+    bulk_index.add(vectors[:10], np.arange(10))
+    bulk_index.remove(np.array([0]))
+    bulk_index.compact()
+
+    assert bulk_index.generation == start + 3
+    bulk_index.search(vectors[:1], k=1)
+    assert bulk_index.generation == start + 3
+
+@pytest.mark.parametrize("ids, kind", [
+    (np.arange(5, 9), "IDSelectorRange"),
+    (np.array([3, 4, 9, 12]), "IDSelectorBitmap"),
+    (np.array([2, 10_000]), "IDSelectorBatch"),
+    (np.array([], dtype="int64"), "IDSelectorRange")])
+def test_id_selector(ids, kind):
+    selector = id_selector(ids)[0]
+
+    assert type(selector).__name__ == kind
+    assert [i for i in range(10_001) if selector.is_member(i)] == ids.tolist()
+
+def test_search_allowed_ids(bulk_index: Index, vectors):
+    ids = np.arange(1000, 1400)
+    bulk_index.add(vectors, ids)
+    bulk_index.remove(np.array([1002]))
+
+    allowed = id_selector(np.array([1001, 1002, 1003, 1300]))
+    results = bulk_index.search(vectors[1], k=5, allowed=allowed)
+
+    assert results[0][0][0] == 1001
+    assert sorted(i for i, _ in results[0]) == [1001, 1003, 1300]
@@ -0,0 +1,40 @@
+import os
+import pytest
+
+import numpy as np
+
+from infrastructure.vectorstore import VectorStore
+
+TEST_PATH = "tests/data/test-index/store.index"
+
+@pytest.fixture
+def store():
+    store = VectorStore(4, TEST_PATH, new=True)
+    yield store
+
+    os.remove(store.vectors_path)
+    os.remove(store.ids_path)
+
+def test_get_returns_rows_by_id(store: VectorStore):
+    vectors = np.arange(12, dtype="float32").reshape(3, 4)
+    store.add(vectors, np.array([7, 3, 5]))
+
+    assert np.array_equal(store.get(np.array([5, 7])), vectors[[2, 0]])
+    with pytest.raises(KeyError):
+        store.get(np.array([4]))
+
+def test_ignores_rows_without_id(store: VectorStore):
+    store.add(np.ones((2, 4)), np.array([0, 1]))
+    with open(store.vectors_path, "ab") as f:
+        f.write(np.ones(4, dtype="float32").tobytes())
+
+    assert store.size() == 2
+
+def test_compact_drops_deleted(store: VectorStore):
+    vectors = np.arange(12, dtype="float32").reshape(3, 4)
+    store.add(vectors, np.array([0, 1, 2]))
+    store.compact({1})
+
+    ids, stored = VectorStore(4, TEST_PATH, new=False).all()
+    assert np.array_equal(ids, [0, 2])
+    assert np.array_equal(stored, vectors[[0, 2]])